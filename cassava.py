@@ -0,0 +1,114 @@
+""" Unified command line of the training, prediction and stacking scripts
+
+    python cassava.py train   [--set key=value ...]
+    python cassava.py predict --set device=cpu cpu_processes=8 submission=submission.csv
+    python cassava.py stack   --set create_data=True
+    python cassava.py bench   --arch resnest26d --image-size 512 --batch-size 16 --views identity hflip
+
+``train``, ``predict`` and ``stack`` run the entry scripts with their ``params`` updated
+by the ``--set`` values (Python literals, plain strings otherwise). Only the standard
+library is imported at start, every command imports what its code path needs.
+"""
+import argparse
+import ast
+import os
+import runpy
+import sys
+import time
+
+SCRIPTS = {
+    'train': 'cassava_classification_train_kfolds.py',
+    'predict': 'cassava_classification_pred_kfolds.py',
+    'stack': 'cassava_classification_stacking.py',
+}
+
+
+def parse_value(text):
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_overrides(items):
+    overrides = {}
+    for item in items:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--set expects key=value, got {item!r}")
+        overrides[key] = parse_value(value)
+    return overrides
+
+
+def run_script(command, overrides):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[command])
+    sys.argv = [path]
+    # the script runs as __main__ (spawned workers re-import it by its path), CLI_PARAMS
+    # is applied to its params dict
+    runpy.run_path(path, init_globals={'CLI_PARAMS': overrides}, run_name='__main__')
+
+
+def bench(args):
+    """ Start-up cost (imports, member build) and images/s of an InferenceEngine on random uint8 batches. """
+    timings = []
+    start = time.perf_counter()
+    import torch
+    timings.append(('import torch', time.perf_counter() - start))
+    start = time.perf_counter()
+    from utils import InferenceEngine
+    timings.append(('import utils.InferenceEngine', time.perf_counter() - start))
+    start = time.perf_counter()
+    import timm
+    timings.append(('import timm', time.perf_counter() - start))
+    start = time.perf_counter()
+    engine = InferenceEngine([(args.arch, args.checkpoint, args.image_size)], device=args.device,
+                             views=tuple(args.views), channels_last=args.channels_last)
+    timings.append(('build engine', time.perf_counter() - start))
+
+    images = torch.randint(0, 256, (args.batch_size, 3, args.image_size, args.image_size), dtype=torch.uint8)
+    if engine.device.type == 'cuda':
+        images = images.pin_memory()
+
+    def sync():
+        if engine.device.type == 'cuda':
+            torch.cuda.synchronize(engine.device)
+
+    for _ in range(args.warmup):
+        engine(images)
+    sync()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        engine(images)
+    sync()
+    elapsed = time.perf_counter() - start
+    for name, seconds in timings:
+        print(f'{name:<32}{seconds:>8.2f} s')
+    print(f'{"inference":<32}{args.steps * args.batch_size / elapsed:>8.1f} images/s '
+          f'({engine.num_views} views, batch {args.batch_size}, {args.device})')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cassava leaf classification")
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command, script in SCRIPTS.items():
+        sub = commands.add_parser(command, help=f'run {script}')
+        sub.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE', help='params overrides')
+    sub = commands.add_parser('bench', help='start-up time and inference throughput of one model')
+    sub.add_argument('--arch', default='resnest26d')
+    sub.add_argument('--checkpoint', default=None, help='training checkpoint or exported weights')
+    sub.add_argument('--image-size', type=int, default=512)
+    sub.add_argument('--batch-size', type=int, default=16)
+    sub.add_argument('--views', nargs='+', default=['identity'])
+    sub.add_argument('--device', default='cuda')
+    sub.add_argument('--channels-last', action='store_true')
+    sub.add_argument('--warmup', type=int, default=3)
+    sub.add_argument('--steps', type=int, default=20)
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        bench(args)
+    else:
+        run_script(args.command, parse_overrides(args.set))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,20 @@
 from collections import defaultdict
-import copy
 import random
 import numpy as np
 import os
-import shutil
-from urllib.request import urlretrieve
 import pandas as pd
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
-import cv2
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import torch
 import torch.backends.cudnn as cudnn
-import torch.nn as nn
 import torch.optim
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import torchvision.models as models
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import accuracy_score
-from sklearn.utils import resample
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as T
-from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts, CosineAnnealingLR, ReduceLROnPlateau
-import timm
-from timm.loss import JsdCrossEntropy
-from utils import Mixup, RandAugment, AsymmetricLossSingleLabel, SCELoss, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
-from utils import merge_data, balance_data, TrainDataset, TestDataset
-from PIL import Image
+from torch.utils.data import DataLoader, Subset
+from utils import balance_data, TestDataset, build_image_store, ImageStore, build_manifest
+from utils import split_normalize, TransformProfiler, BatchTTA, InferenceEngine, write_submission, write_predictions
+from utils import autotune_loader, classifier_pred_step, load_tuned, save_tuned, loader_kwargs, LOADER_KEYS
+from utils import PredictionCache, transform_signature, cached_logits, cpu_pool_predict, iter_cpu_pool
+from utils import read_weights, export_ensemble
 
 cudnn.benchmark = True
 SEED = 42
@@ -85,6 +71,8 @@ def declare_pred_model(name, load_pretrained=False, weight=None):
             num_classes=params["num_classes"],
             drop_rate=params["drop_rate"])
     model = model.to(params["device"])
+    if params["channels_last"]:
+        model = model.to(memory_format=torch.channels_last)
     
     if params["distributed"]:
         assert ValueError("No need to implement in a single machine")
@@ -92,88 +80,109 @@ def declare_pred_model(name, load_pretrained=False, weight=None):
         model = torch.nn.DataParallel(model) 
         
     if load_pretrained:
-        state_dict = torch.load(weight)
-        print(f"Load pretrained model: {name} ",state_dict["preds"])
-        model.load_state_dict(state_dict["model"])
-        best_acc = state_dict["preds"]   
+        # memory-mapped, training checkpoints and exported weight files alike
+        state_dict, meta = read_weights(weight)
+        print(f"Load pretrained model: {name} ",meta["accuracy"])
+        model.module.load_state_dict(state_dict)
     return model         
         
 def gmean(input_x, dim):
     log_x = torch.log(input_x)
     return torch.exp(torch.mean(log_x, dim=dim))
 
-def tta_validate(loader, model, params, fold_idx):
-    num_tta = len(test_transform_tta)
-    pred_list = {'image_id':[],
-                 'prob':[],}
+def adjust_predictions(probs):
+    """ Error-analysis rules: falls back to the 2nd class for the usual confusions (0/4, 3/2) and low confidence. """
+    rows = np.arange(len(probs))
+    top2 = np.argsort(-probs, axis=1)[:, :2]
+    first, second = top2[:, 0], top2[:, 1]
+    p1, p2 = probs[rows, first], probs[rows, second]
+    change = (((first == 0) & (second == 4) & (p2 > 0.2)) | ((first == 3) & (second == 2) & (p2 > 0.2))
+              | ((p1 < 0.45) & (p2 > 0.25)))
+    return np.where(change, second, first), int(change.sum())
 
-    incorrect_pred_list = {'image_id':[],
-                       'label':[],
-                       'pred':[],
-                       'prob':[]}
-    correct_pred_list = {'image_id':[],
-                       'label':[],
-                       'pred':[],
-                       'prob':[]}    
-    metric_monitor = MetricMonitor()
-    model.eval()
-    stream = tqdm(loader)
-    count_change = 0
+def tta_view_logits(dataset, model, params, tta):
+    """ (views, N, classes) logits of the whole dataset, sharded over CPU processes when params["cpu_processes"] > 0. """
+    if params["cpu_processes"] > 0:
+        # the model is shared by the processes, the five crops path takes the images uncropped
+        engine = InferenceEngine([(params["model"], getattr(model, 'module', model),
+                                   None if tta.five_crop else params["image_size"])],
+                                 device="cpu", views=tta.views, five_crop=tta.five_crop, normalize=tta.normalize,
+                                 num_classes=params["num_classes"])
+        return cpu_pool_predict(engine, dataset, num_processes=params["cpu_processes"],
+                                num_threads=params["cpu_threads"], batch_size=params["batch_size"])[0][0]
+    loader = DataLoader(dataset, shuffle=False, **loader_kwargs(params))
     with torch.no_grad():
-        for i, data in enumerate(stream, start=1):
-            tta_output = []   
-            for i, image in enumerate(data["images"]):
-                out = torch.softmax(model(image), dim=1)
-                tta_output.append(out)
-            output = gmean(torch.stack(tta_output, dim=0), dim = 0)
-#             output = torch.softmax(tta_output, dim=1)
-            pred = output.argmax(1)
+        return torch.cat([tta.view_logits(model, data["images"].to(params["device"], non_blocking=True)).float().cpu()
+                          for data in tqdm(loader, desc="TTA Validation")], dim=1)
 
-            # topk_output, topk_ids = torch.topk(output, params["num_classes"])
-            for i in range(len(data["labels"][0])):
-                if params["distill_soft_label"]:
-                    pred_list['image_id'].append(data["image_ids"][0][i])
-                    pred_list['prob'].append(output[i].cpu().numpy())
-                    
-                if params["error_analysis"]:
-                    ## adjust the output prediction
-                    max_1st = topk_ids[i][0]
-                    max_2nd = topk_ids[i][1]
-                    if  max_1st == 0 and max_2nd == 4 and output[i][max_2nd] > 0.2:
-                        pred[i] = max_2nd
-                        count_change+=1
-                    if max_1st == 3 and max_2nd == 2 and output[i][max_2nd] > 0.2:
-                        pred[i] = max_2nd
-                        count_change+=1
+def tta_probs(dataset, model, params, tta, cache=None, checkpoint=None, signature=None, image_hashes=None):
+    """ TTA probabilities of the whole dataset, only the images missing from the cache are predicted. """
+    if cache is not None:
+        logits = cached_logits(cache, [cache.checkpoint_hash(checkpoint)], image_hashes, signature,
+                               lambda rows, members: tta_view_logits(Subset(dataset, rows), model, params, tta)[None],
+                               tta.num_views, params["num_classes"])[0]
+    else:
+        logits = tta_view_logits(dataset, model, params, tta)
+    if tta.reduction == 'gmean':
+        probs = torch.log_softmax(logits, dim=2).mean(0).exp()
+    else:
+        probs = torch.softmax(logits, dim=2).mean(0)
+    image_ids = np.array([dataset.index.name(i) for i in range(len(dataset))], dtype=object)
+    return probs.numpy(), dataset.index.labels.astype(np.int64), image_ids
 
-                    if output[i][max_1st] < 0.45 and output[i][max_2nd] > 0.25:
-                        pred[i] = max_2nd
-                        count_change+=1
+def tta_validate(loader, model, params, fold_idx, tta, cache=None, checkpoint=None, signature=None, image_hashes=None):
+    model.eval()
+    if cache is not None or params["cpu_processes"] > 0:
+        probs, labels, image_ids = tta_probs(loader.dataset, model, params, tta, cache, checkpoint, signature,
+                                             image_hashes)
+        num_samples = len(probs)
+    else:
+        # filled with one device-to-host copy per batch, everything else is computed once at the end
+        num_samples = len(loader.dataset)
+        probs = np.zeros((num_samples, params["num_classes"]), dtype=np.float32)
+        labels = np.zeros(num_samples, dtype=np.int64)
+        image_ids = np.empty(num_samples, dtype=object)
+        stream = tqdm(loader, desc="TTA Validation")
+        offset = 0
+        with torch.no_grad():
+            for data in stream:
+                # all the views of the batch in one forward, geometric mean of the probabilities
+                output = tta(model, data["images"].to(params["device"], non_blocking=True))
+                n = len(output)
+                probs[offset:offset + n] = output.float().cpu().numpy()
+                labels[offset:offset + n] = np.asarray(data["labels"])
+                image_ids[offset:offset + n] = data["image_ids"]
+                offset += n
 
-                if data["labels"][0][i] != output.argmax(1).cpu()[i]:
-                    incorrect_pred_list['image_id'].append(data["image_ids"][0][i])                        
-                    incorrect_pred_list['label'].append(data["labels"][0][i].cpu().numpy())
-                    incorrect_pred_list['pred'].append(output.argmax(1).cpu()[i].cpu().numpy())
-                    incorrect_pred_list['prob'].append(output[i].cpu().numpy())
-                else:
-                    correct_pred_list['image_id'].append(data["image_ids"][0][i])                        
-                    correct_pred_list['label'].append(data["labels"][0][i].cpu().numpy())
-                    correct_pred_list['pred'].append(output.argmax(1).cpu()[i].cpu().numpy())
-                    correct_pred_list['prob'].append(output[i].cpu().numpy())   
-            accuracy = accuracy_score(pred.cpu(), data["labels"][0].cpu())
-            metric_monitor.update("Accuracy", accuracy)            
-            stream.set_description(
-                "TTA Validation. {metric_monitor}".format(metric_monitor=metric_monitor)
-            )
-        if params["distill_soft_label"]:
-            pred_val = pd.DataFrame(pred_list)
-            pred_val.to_csv(f'./error_analysis/val_{params["model"]}_{fold_idx}_pred.csv' ,index=False)
-        best_acc = metric_monitor.curr_acc
-        
-    print(f"Total output change: {count_change}")
-    return best_acc
+    preds = probs.argmax(1)
+    count_change = 0
+    if params["error_analysis"]:
+        adjusted, count_change = adjust_predictions(probs)
+    else:
+        adjusted = preds
+    accuracy = float((adjusted == labels).mean()) if num_samples else 0.
+    print(f"TTA Validation. Accuracy: {accuracy:.3f}")
+
+    if params["distill_soft_label"] or params["error_analysis"]:
+        os.makedirs('./error_analysis', exist_ok=True)
+    if params["distill_soft_label"]:
+        pred_val = pd.DataFrame({'image_id': image_ids, 'prob': [' '.join(map(str, p)) for p in probs]})
+        pred_val.to_csv(f'./error_analysis/val_{params["model"]}_{fold_idx}_pred.csv' ,index=False)
+    if params["error_analysis"]:
+        correct = preds == labels
+        for name, mask in (('correct', correct), ('incorrect', ~correct)):
+            pd.DataFrame({'image_id': image_ids[mask], 'label': labels[mask], 'pred': preds[mask],
+                          'prob': [' '.join(map(str, p)) for p in probs[mask]]}).to_csv(
+                f'./error_analysis/val_{params["model"]}_{fold_idx}_{name}.csv', index=False)
+        print(f"Total output change: {count_change}")
+    return accuracy
 
 if __name__ == "__main__":
+    # model, fold split and metric libraries, imported here so that DataLoader workers
+    # started with "spawn" (which re-import this file) do not pay for them
+    import timm
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.metrics import accuracy_score
 
     root = os.path.join(os.environ["HOME"], "Workspace/datasets/taiyoyuden/cassava")
     train = pd.read_csv(f'{root}/train.csv')
@@ -221,6 +230,20 @@ if __name__ == "__main__":
     ]
     model_index = 3
     ckpt_index = 1
+    # backbone -> (image size, fold checkpoints) of the test ensemble written by params["submission"]
+    SUBMISSION_ENSEMBLE = {
+        "resnest26d": (512, [
+            "./weights/resnest26d/resnest26d_fold1_best_epoch_7_final_2nd.pth",
+            "./weights/resnest26d/resnest26d_fold2_best_epoch_4_final_2nd.pth",
+        ]),
+        "resnest50d": (512, [
+            "./weights/resnest50d/resnest50d_fold0_best_epoch_10_final_3rd.pth",
+            "./weights/resnest50d/resnest50d_fold1_best_epoch_8_final_5th_pseudo.pth",
+            "./weights/resnest50d/resnest50d_fold2_best_epoch_22_final_2nd.pth",
+            "./weights/resnest50d/resnest50d_fold3_best_epoch_1_final_3rd.pth",
+            "./weights/resnest50d/resnest50d_fold4_best_epoch_15_final_3rd.pth",
+        ]),
+    }
 
     params = {
         "visualize": False,
@@ -242,7 +265,43 @@ if __name__ == "__main__":
         "kfold_pred":True,
         "ensemble": True,
         "error_analysis":False,
+        # writes the out-of-fold probabilities used as soft labels by the training script
+        "distill_soft_label": False,
+        # pre-decoded image store folder, None decodes the JPEG files on every pass
+        "image_store": None,
+        "image_store_size": None,
+        # crop/resize fused into a reduced-resolution JPEG decode, see utils/decode.py
+        "fast_decode": False,
+        # persisted manifest (folds, image sizes, hashes), None recomputes the folds
+        "manifest": None,
+        # datasets return uint8 tensors, normalized on the device after the transfer
+        "uint8_transfer": False,
+        "channels_last": False,
+        # per-transform call rate and time of the prediction pipeline, printed every fold
+        "profile_transforms": False,
+        # JSON file of tuned loader settings, probed on the first fold when it has no entry
+        # for this model, image size and TTA setting
+        "autotune": None,
+        "prefetch_factor": 2,
+        "pin_memory": True,
+        # submission file of the SUBMISSION_ENSEMBLE on the test images, written after the CV
+        # validation (only the submission is written when "fold" is empty)
+        "submission": None,
+        "submission_chunk_size": 1024,
+        # sqlite cache of the per-view logits keyed by image, checkpoint and transform hashes,
+        # a swapped checkpoint is the only model that predicts again
+        "prediction_cache": None,
+        # CPU-only boxes ("device": "cpu"): validation and submission sharded over this many
+        # processes that share the weights, each pinned to cpu_threads cores (0: single process)
+        "cpu_processes": 0,
+        "cpu_threads": 4,
+        # folder of the weight-only (fp16 if export_half) copies of the SUBMISSION_ENSEMBLE
+        # checkpoints, made once and loaded memory-mapped, None loads the training checkpoints
+        "export_weights": None,
+        "export_half": False,
     }
+    # overrides of the unified CLI: python cassava.py <command> --set key=value
+    params.update(globals().get("CLI_PARAMS", {}))
 
     val_transform = A.Compose(
         [
@@ -252,73 +311,59 @@ if __name__ == "__main__":
             ToTensorV2(),
         ]
     )
-    transform_tta0 = A.Compose(
+    ##### Five crops of the full image, normalized as the torchvision crop TTA
+    crop_transform = A.Compose(
         [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),    
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),   
-            ToTensorV2()
-        ]
-        )
-
-    transform_tta1 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.HorizontalFlip(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),   
-            ToTensorV2()
-        ]
-    )
-    transform_tta2 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.VerticalFlip(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
+            A.Resize(600, 800),
+            A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)),
             ToTensorV2(),
         ]
     )
-    transform_tta3 = A.Compose(
-        [
-            # A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.RandomRotate90(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),     
-            ToTensorV2(),
-        ]
-    )
-
-    ##### Test TTA with Five Crops
-    transform_crop_tta0 = T.Compose([
-                    T.FiveCrop(params["image_size"]),
-                    T.Lambda(lambda crops: ([T.ToTensor()(crop) for crop in crops])),
-                    T.Lambda(lambda norms: torch.stack([T.Normalize(mean=[0.5], std=[0.5])(norm) for norm in norms]))
-            ]
-    )
-        
-    transform_crop_tta1 = T.Compose([
-                    T.FiveCrop(params["image_size"]),
-                    T.Lambda(lambda crops: ([T.ToTensor()(crop) for crop in crops])),
-                    T.Lambda(lambda flips: ([T.RandomHorizontalFlip(p=1.)(flip) for flip in flips])),
-                    T.Lambda(lambda norms: torch.stack([T.Normalize(mean=[0.5], std=[0.5])(norm) for norm in norms]))
-        ]
-    )
-    transform_crop_tta2 = T.Compose([
-                    T.FiveCrop(params["image_size"]),
-                    T.Lambda(lambda crops: ([T.ToTensor()(crop) for crop in crops])),
-                    T.Lambda(lambda flips: ([T.RandomVerticalFlip(p=1.)(flip) for flip in flips])),
-                    T.Lambda(lambda norms: torch.stack([T.Normalize(mean=[0.5], std=[0.5])(norm) for norm in norms]))
-        ]
-    )
-    test_transform_tta = [transform_tta0, transform_tta1, transform_tta2, transform_tta3]
-    test_transform_tta_crops = [transform_crop_tta0, transform_crop_tta1, transform_crop_tta2]
+    device_normalize, crop_normalize = None, None
+    if params["uint8_transfer"]:
+        val_transform, device_normalize = split_normalize(val_transform, channels_last=params["channels_last"])
+        crop_transform, crop_normalize = split_normalize(crop_transform)
+        device_normalize = device_normalize.to(params["device"])
+        crop_normalize = crop_normalize.to(params["device"])
+    # TTA views are made on the device from one decoded, resized image per sample
+    tta = BatchTTA(("identity", "hflip", "vflip", "rot90") if params["tta"] else ("identity",),
+                   normalize=device_normalize, channels_last=params["channels_last"])
+    crops_tta = BatchTTA(("identity", "hflip", "vflip"), five_crop=params["image_size"],
+                         normalize=crop_normalize, channels_last=params["channels_last"])
+    transform_profiler = None
+    if params["profile_transforms"]:
+        transform_profiler = TransformProfiler(val_transform)
+        val_transform = transform_profiler.transform
   
-    folds = train.copy()
-    Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
-    for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
-        folds.loc[val_index, 'fold'] = int(n)
-    folds['fold'] = folds['fold'].astype(int)
+    if params["manifest"] is not None:
+        manifest = build_manifest({'train': (train, f'{root}/train_images')}, params["manifest"], seed=SEED)
+        folds = manifest[manifest['source'] == 'train'].reset_index(drop=True)
+    else:
+        folds = train.copy()
+        Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
+        for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
+            folds.loc[val_index, 'fold'] = int(n)
+        folds['fold'] = folds['fold'].astype(int)
+
+    val_image_store, test_image_store = None, None
+    if params["image_store"] is not None:
+        build_image_store(train, f'{root}/train_images', params["image_store"],
+                          sizes=(params["image_store_size"],), num_workers=params["num_workers"])
+        build_image_store(test, f'{root}/test_images', f'{params["image_store"]}/test',
+                          sizes=(params["image_store_size"],), num_workers=params["num_workers"])
+        val_image_store = ImageStore(params["image_store"], params["image_store_size"])
+        test_image_store = ImageStore(f'{params["image_store"]}/test', params["image_store_size"])
+    prediction_cache = PredictionCache(params["prediction_cache"]) if params["prediction_cache"] is not None else None
+    cache_signature = None
+    if prediction_cache is not None:
+        # everything between the JPEG file and the logits of a checkpoint
+        store_size = params["image_store_size"] if params["image_store"] is not None else None
+        if params["crops_tta"]:
+            cache_signature = transform_signature(crop_transform, crops_tta.views, crops_tta.five_crop,
+                                                  params["uint8_transfer"], store_size)
+        else:
+            cache_signature = transform_signature(val_transform, tta.views, params["uint8_transfer"],
+                                                  params["fast_decode"], store_size)
     cv_acc = 0.
     for i, fold_idx in enumerate(params["fold"]):
         print(f"Validate Fold: {fold_idx}")
@@ -333,29 +378,64 @@ if __name__ == "__main__":
             train_folds = balance_data(train_folds, mode="undersampling")    
             val_folds = balance_data(val_folds, mode="undersampling", val=True)
 
-        if params["tta"]:
-            val_pred_dataset = TestDataset(val_folds, root, transform=test_transform_tta, valid_test=True)
-            test_pred_dataset = TestDataset(test, root, transform=test_transform_tta)
-        else:
-            val_pred_dataset = TestDataset(val_folds, root, transform=val_transform, valid_test=True)
-            test_pred_dataset = TestDataset(test, root, transform=val_transform)
+        val_pred_dataset = TestDataset(val_folds, root, transform=val_transform, valid_test=True,
+                                       image_store=val_image_store, fast_decode=params["fast_decode"])
+        val_pred_dataset_crops = TestDataset(val_folds, root, transform=crop_transform, valid_test=True,
+                                             image_store=val_image_store)
 
-        val_pred_dataset_crops = TestDataset(val_folds, root, transform=test_transform_tta_crops,valid_test=True, fcrops=True)
+        if params["autotune"] is not None:
+            tune_key = f'pred/{params["model"]}/{params["image_size"]}/{"tta" if params["tta"] else "single"}'
+            tuned = load_tuned(params["autotune"], tune_key)
+            if tuned is None:
+                tune_model = declare_pred_model(params["model"])
+                tuned = autotune_loader(val_pred_dataset, classifier_pred_step(tune_model, params["device"], tta=tta),
+                                        device=params["device"])
+                save_tuned(params["autotune"], tune_key, tuned)
+                del tune_model
+            params.update({k: tuned[k] for k in LOADER_KEYS})
 
-        val_pred_loader = DataLoader(
-            val_pred_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=2, pin_memory=True,
-        )
-        val_pred_loader_crop = DataLoader(
-            val_pred_dataset_crops, batch_size=params['batch_size'], shuffle=False, num_workers=2, pin_memory=True,
-        )
-        test_pred_loader = DataLoader(
-            test_pred_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=2, pin_memory=True,
-        )
+        val_pred_loader = DataLoader(val_pred_dataset, shuffle=False, **loader_kwargs(params))
+        val_pred_loader_crop = DataLoader(val_pred_dataset_crops, shuffle=False, **loader_kwargs(params))
         
         model  = declare_pred_model(params["model"], load_pretrained=params["load_pretrained"], weight=WEIGHTS[i])
-        cv_acc += tta_validate(val_pred_loader, model, params, fold_idx)
+        image_hashes = None
+        if prediction_cache is not None:
+            image_hashes = prediction_cache.frame_hashes(val_folds, f'{root}/train_images')
+        cache_args = dict(cache=prediction_cache, checkpoint=WEIGHTS[i], signature=cache_signature,
+                          image_hashes=image_hashes)
+        if params["crops_tta"]:
+            cv_acc += tta_validate(val_pred_loader_crop, model, params, fold_idx, crops_tta, **cache_args)
+        else:
+            cv_acc += tta_validate(val_pred_loader, model, params, fold_idx, tta, **cache_args)
+        if transform_profiler is not None:
+            transform_profiler.report()
         
         del model
         
     num_fold_train = len(params["fold"])            
-    print(f"Done CV validation with  {num_fold_train} folds, Accuracy: {round(cv_acc/num_fold_train,4)}")
\ No newline at end of file
+    if num_fold_train > 0:
+        print(f"Done CV validation with  {num_fold_train} folds, Accuracy: {round(cv_acc/num_fold_train,4)}")
+
+    if params["submission"] is not None:
+        # uint8 decode only: the engine crops each resolution and normalizes on the device
+        test_size = max(size for size, _ in SUBMISSION_ENSEMBLE.values())
+        test_transform = A.Compose([A.CenterCrop(height=test_size, width=test_size, p=1), ToTensorV2()])
+        test_dataset = TestDataset(test, root, transform=test_transform, image_store=test_image_store,
+                                   fast_decode=params["fast_decode"])
+        test_loader = DataLoader(test_dataset, shuffle=False, **loader_kwargs(params))
+        members = [(arch, ckpt, size) for arch, (size, ckpts) in SUBMISSION_ENSEMBLE.items() for ckpt in ckpts]
+        if params["export_weights"] is not None:
+            members = export_ensemble(members, params["export_weights"], half=params["export_half"])
+        engine = InferenceEngine(members,
+                                 device=params["device"], views=tta.views, num_classes=params["num_classes"],
+                                 channels_last=params["channels_last"])
+        if params["cpu_processes"] > 0:
+            shards = ((logits, image_ids) for logits, _, image_ids in iter_cpu_pool(
+                engine, test_dataset, num_processes=params["cpu_processes"], num_threads=params["cpu_threads"],
+                batch_size=params["batch_size"], desc="Submission"))
+            num_rows = write_predictions(shards, engine.names, params["submission"],
+                                         chunk_size=params["submission_chunk_size"])
+        else:
+            num_rows = write_submission(engine, test_loader, params["submission"],
+                                        chunk_size=params["submission_chunk_size"])
+        print(f"Wrote {num_rows} predictions of {len(engine.models)} models to {params['submission']}")
\ No newline at end of file
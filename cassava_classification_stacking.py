@@ -1,38 +1,25 @@
 from collections import defaultdict
-import copy
 import random
 import numpy as np
 import os
-import shutil
-from urllib.request import urlretrieve
 import pandas as pd
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import cv2
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.optim
 from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import torchvision.models as models
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import accuracy_score
-from sklearn.utils import resample
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as T
-cudnn.benchmark = True
-from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts, CosineAnnealingLR, ReduceLROnPlateau
-import timm
-from timm.loss import JsdCrossEntropy
-from utils import Mixup, RandAugment, AsymmetricLossSingleLabel, SCELoss, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
-from PIL import Image
-from utils import merge_data, balance_data, TrainDataset
-import h5py
+from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
+from utils import Mixup, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
+from utils import build_manifest
+from utils import load_tuned, loader_kwargs, LOADER_KEYS, InferenceEngine, PredictionCache, transform_signature
+from utils import export_ensemble
 import torch.nn.functional as F
 
+cudnn.benchmark = True
 SEED = 42
 
 def seed_everything(SEED):
@@ -180,71 +167,10 @@ class MetricMonitor:
             ]
         )
 
-def declare_pred_model(name, weight):
-    if "efficientnet" in name:
-        model = timm.create_model(
-                name,
-                pretrained=False,
-                num_classes=5, 
-                drop_rate=0.2, 
-                drop_path_rate=0.3)
-    else:
-        model = timm.create_model(
-                name,
-                pretrained=False,
-                num_classes=5,
-                drop_rate=0.2)
-
-    model = model.to(params["device"])
-    model = torch.nn.DataParallel(model) 
-    state_dict = torch.load(weight)
-    print(f"Load pretrained model: {name} ",state_dict["preds"])
-    model.load_state_dict(state_dict["model"])
-    best_acc = state_dict["preds"]   
-    return model.eval() 
-
-
 def gmean(input_x, dim):
     log_x = torch.log(input_x)
     return torch.exp(torch.mean(log_x, dim=dim))     
 
-def tta_stack_validate(loader, model, params, fold_idx, gen_prob, tta):
-    model.eval()
-    stream = tqdm(loader)
-    preds = []
-    gts = []
-    image_ids = []
-    probs = []            
-    with torch.no_grad():
-        for i, data in enumerate(stream, start=1):
-            tta_output = []
-            tta_prob_output = []
-            if tta:
-                for i, image in enumerate(data["images"]):
-                    image = image.to(params["device"], non_blocking=True)
-                    logit = model(image)
-                    tta_output.append(logit)
-                    if gen_prob:
-                        tta_prob_output.append(torch.softmax(logit, dim=1))
-                # tta_output = torch.stack(tta_output, dim=0).mean(dim=0)
-                prob_output = torch.stack(tta_prob_output, dim=0).mean(dim=0)
-                output = torch.cat(tta_output, dim=0)
-                label = data["labels"][0]
-                img_id = data["image_ids"][0]
-            else:
-                logit = model(data["images"].to(params["device"], non_blocking=True))
-                prob_output = torch.softmax(logit, dim=1)
-                output = logit
-                label = data["labels"]
-                img_id = data["image_ids"]
-                
-            probs.append(prob_output)
-            preds.append(output)
-            gts.append(label)
-            image_ids.extend(img_id)
-    return torch.stack(preds, dim=0), torch.cat(gts), image_ids, torch.cat(probs).cpu().numpy()
-
-
 def train_epoch(train_loader, model, criterion, optimizer, epoch, params):
     metric_monitor = MetricMonitor()
     model.train()
@@ -325,6 +251,10 @@ def validate(val_loader, model, criterion, optimizer, epoch, params, fold, best_
     return best_acc
 
 if __name__ == "__main__":
+    # fold split and metric libraries, imported here so that DataLoader workers
+    # started with "spawn" (which re-import this file) do not pay for them
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.metrics import accuracy_score
     
     root = os.path.join(os.environ["HOME"], "Workspace/datasets/taiyoyuden/cassava")
     train = pd.read_csv(f'{root}/train.csv')
@@ -384,8 +314,25 @@ if __name__ == "__main__":
         "create_data": False,
         "gen_prob": True,
         "smooth_label": 0.1,
-        "gradient_accumulation_steps":1
+        "gradient_accumulation_steps":1,
+        # persisted manifest (folds, image sizes, hashes), None recomputes the folds
+        "manifest": None,
+        "channels_last": False,
+        # JSON file of tuned loader settings written by the prediction script, the level 1
+        # loader reuses the settings tuned for the largest model
+        "autotune": None,
+        "prefetch_factor": 2,
+        "pin_memory": True,
+        # sqlite cache of the level 1 logits keyed by image, checkpoint and transform hashes,
+        # only the missing (model, image) pairs are predicted again
+        "prediction_cache": None,
+        # folder of the weight-only (fp16 if export_half) copies of the level 1 checkpoints,
+        # made once and loaded memory-mapped, None loads the training checkpoints
+        "export_weights": None,
+        "export_half": False,
     }
+    # overrides of the unified CLI: python cassava.py <command> --set key=value
+    params.update(globals().get("CLI_PARAMS", {}))
     ## stack model transform 
     train_transform = A.Compose(
     [
@@ -397,55 +344,32 @@ if __name__ == "__main__":
         ToTensorV2(),
     ])
 
-    ## Level 1 model prediction transform
+    ## Level 1 models: every image is decoded and centre-cropped once, the uint8 batch is
+    ## normalized, augmented and fanned out to all the models on the device (utils/inference.py)
     pred_transform = A.Compose(
     [
-        A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),    
-        A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-        A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),   
+        A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
         ToTensorV2(),
     ])
-    
-    transform_tta0 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),    
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),   
-            ToTensorV2()
-        ])
-
-    transform_tta1 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.HorizontalFlip(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),   
-            ToTensorV2()
-        ])
-    transform_tta2 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.VerticalFlip(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
-            ToTensorV2(),
-        ])
-    transform_tta3 = A.Compose(
-        [
-            A.CenterCrop(height=params["image_size"], width=params["image_size"], p=1),
-            A.Resize(height=params["image_size"], width=params["image_size"], p=1),
-            A.RandomRotate90(p=1.),
-            A.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),     
-            ToTensorV2(),
-        ])
-    test_transform_tta = [transform_tta0, transform_tta1, transform_tta2, transform_tta3]
+    level1_views = ("identity", "hflip", "vflip", "rot90") if params["tta"] else ("identity",)
+    prediction_cache = PredictionCache(params["prediction_cache"]) if params["prediction_cache"] is not None else None
+    if params["create_data"] and params["export_weights"] is not None:
+        WEIGHTS_26, WEIGHTS_50, WEIGHTS_b4, WEIGHTS_se26 = [
+            [ckpt for _, ckpt, _ in export_ensemble([(arch, w, params["image_size"]) for w in weights],
+                                                    params["export_weights"], half=params["export_half"])]
+            for arch, weights in zip(models_name, (WEIGHTS_26, WEIGHTS_50, WEIGHTS_b4, WEIGHTS_se26))]
+    level1_signature = transform_signature(pred_transform, level1_views)
     mixup_fn = Mixup(mixup_alpha=1.,label_smoothing=params["smooth_label"], num_classes=params["num_classes"])
 
-    folds = train.copy()
-    Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
-    for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
-        folds.loc[val_index, 'fold'] = int(n)
-    folds['fold'] = folds['fold'].astype(int)
+    if params["manifest"] is not None:
+        manifest = build_manifest({'train': (train, f'{root}/train_images')}, params["manifest"], seed=SEED)
+        folds = manifest[manifest['source'] == 'train'].reset_index(drop=True)
+    else:
+        folds = train.copy()
+        Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
+        for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
+            folds.loc[val_index, 'fold'] = int(n)
+        folds['fold'] = folds['fold'].astype(int)
     cv_acc = 0.
 
     # outputs_r26_h5f = h5py.File('../data/result_r26.h5', 'w')
@@ -490,55 +414,42 @@ if __name__ == "__main__":
             # train_folds = folds.loc[train_idx].reset_index(drop=True)
             val_folds = folds.loc[val_idx].reset_index(drop=True)
             print(f"************** Create stacking data on valid Fold: {fold_idx} **************\n")
-            if params["tta"]:
-                val_pred_dataset = TestDataset(val_folds, root, transform=test_transform_tta, valid_test=True)
-            else:
-                val_pred_dataset = TestDataset(val_folds, root, transform=pred_transform, valid_test=True)
-            val_pred_loader = DataLoader(
-                val_pred_dataset, batch_size=params['batch_size'], shuffle=False, num_workers=2, pin_memory=True,
-            )
-            r26_model = declare_pred_model(models_name[0], WEIGHTS_26[fold_idx])
-            r50_model = declare_pred_model(models_name[1], WEIGHTS_50[fold_idx])
-            eb4_model = declare_pred_model(models_name[2], WEIGHTS_b4[fold_idx])
-            se26_model = declare_pred_model(models_name[3], WEIGHTS_se26[fold_idx])
-
-            r26_outputs = tta_stack_validate(val_pred_loader, r26_model, params, fold_idx, params["gen_prob"], params["tta"])
-            r26_logit_preds["logits"].append(r26_outputs[0])
-            r26_logit_preds["targets"].append(r26_outputs[1])
-            r26_logit_preds["image_ids"].append(r26_outputs[2])
-            print(f"Check target r26 fold {fold_idx}: {accuracy_score(val_folds['label'],r26_outputs[1].cpu().numpy())}")
-            #
-            stack_probs["m1"].append(r26_outputs[3])
-            stack_probs["image_ids"].extend(r26_outputs[2])
-            stack_probs["targets"].append(r26_outputs[1])
-            if params["tta"]:
-                print(f"TTA ACC r26 fold {fold_idx}: {accuracy_score(val_folds['label'],r26_outputs[3].argmax(1))}")
-            else:
-                print(f"ACC r26 fold {fold_idx}: {accuracy_score(val_folds['label'],r26_outputs[3].argmax(1))}")
-
-            r50_outputs = tta_stack_validate(val_pred_loader, r50_model, params, fold_idx, params["gen_prob"], params["tta"])
-            r50_logit_preds["logits"].append(r50_outputs[0])
-            r50_logit_preds["targets"].append(r50_outputs[1])
-            r50_logit_preds["image_ids"].append(r50_outputs[2])
-            print(f"Check ACC r50 fold {fold_idx}: {accuracy_score(val_folds['label'],r50_outputs[3].cpu().numpy())}")
-            #
-            stack_probs["m2"].append(r50_outputs[3])
-
-            eb4_outputs = tta_stack_validate(val_pred_loader, eb4_model, params, fold_idx, params["gen_prob"], params["tta"])
-            eb4_logit_preds["logits"].append(eb4_outputs[0])
-            eb4_logit_preds["targets"].append(eb4_outputs[1])
-            eb4_logit_preds["image_ids"].append(eb4_outputs[2])
-            print(f"Check ACC eb4 fold {fold_idx}: {accuracy_score(val_folds['label'],eb4_outputs[3].cpu().numpy())}")
-            #
-            stack_probs["m3"].append(eb4_outputs[3])
-
-            se26_outputs = tta_stack_validate(val_pred_loader, se26_model, params, fold_idx, params["gen_prob"], params["tta"])
-            se26_logit_preds["logits"].append(se26_outputs[0])
-            se26_logit_preds["targets"].append(se26_outputs[1])
-            se26_logit_preds["image_ids"].append(se26_outputs[2])
-            print(f"Check ACC se26 fold {fold_idx}: {accuracy_score(val_folds['label'],se26_outputs[3].cpu().numpy())}")
-            #
-            stack_probs["m4"].append(se26_outputs[3])
+            tuned = load_tuned(params["autotune"],
+                               f'pred/{models_name[2]}/{params["image_size"]}/{"tta" if params["tta"] else "single"}')
+            if tuned is not None:
+                params.update({k: tuned[k] for k in LOADER_KEYS})
+
+            def make_loader(df):
+                return DataLoader(TestDataset(df, root, transform=pred_transform, valid_test=True),
+                                  shuffle=False, **loader_kwargs(params))
+            image_hashes = None
+            if prediction_cache is not None:
+                image_hashes = prediction_cache.frame_hashes(val_folds, f'{root}/train_images')
+            engine = InferenceEngine([(models_name[0], WEIGHTS_26[fold_idx], params["image_size"]),
+                                      (models_name[1], WEIGHTS_50[fold_idx], params["image_size"]),
+                                      (models_name[2], WEIGHTS_b4[fold_idx], params["image_size"]),
+                                      (models_name[3], WEIGHTS_se26[fold_idx], params["image_size"])],
+                                     device=params["device"], views=level1_views,
+                                     num_classes=params["num_classes"], channels_last=params["channels_last"])
+            # (models, views, N, classes) from a single pass over the images
+            # served from the prediction cache when it is set, only the new checkpoints run
+            logits, targets, image_ids = engine.predict_cached(val_folds, make_loader, prediction_cache,
+                                                               level1_signature, image_hashes,
+                                                               desc=f"Level 1 fold {fold_idx}")
+            del engine
+            stack_probs["image_ids"].extend(image_ids)
+            stack_probs["targets"].append(targets)
+            for key, name, logit_preds, model_logits in zip(
+                    ("m1", "m2", "m3", "m4"), ("r26", "r50", "eb4", "se26"),
+                    (r26_logit_preds, r50_logit_preds, eb4_logit_preds, se26_logit_preds), logits):
+                # per-view logits are the stacking features, (N, views, classes)
+                logit_preds["logits"].append(model_logits.transpose(0, 1))
+                logit_preds["targets"].append(targets)
+                logit_preds["image_ids"].append(image_ids)
+                probs = torch.softmax(model_logits, dim=2).mean(dim=0).numpy()
+                stack_probs[key].append(probs)
+                prefix = "TTA ACC" if params["tta"] else "ACC"
+                print(f"{prefix} {name} fold {fold_idx}: {accuracy_score(val_folds['label'], probs.argmax(1))}")
 
         else:
             r26_data = torch.load(f'results/result_r26_5folds.pth')
@@ -1,35 +1,25 @@
 from collections import defaultdict
-import copy
 import random
 import numpy as np
 import os
-import shutil
-from urllib.request import urlretrieve
 import pandas as pd
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
-import cv2
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.optim
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-import torchvision.models as models
+from torch.utils.data import DataLoader, RandomSampler
 from  torch.cuda.amp import autocast, GradScaler
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import accuracy_score
-from sklearn.utils import resample
-from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts, CosineAnnealingLR, ReduceLROnPlateau
-import timm
-from timm.loss import JsdCrossEntropy
-from utils import Mixup, RandAugment, AsymmetricLossSingleLabel, SCELoss, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy, fmix, RAdam
-from utils import merge_data, balance_data, TrainDataset, TestDataset
-from PIL import Image
-from torchcontrib.optim import SWA
-from apex import amp
+from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
+from utils import Mixup, AsymmetricLossSingleLabel, SCELoss, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy, fmix
+from utils import merge_data, balance_data, TrainDataset, build_image_store, ImageStore
+from utils import pack_shards, ShardDataset, build_soft_label_store, SoftLabelStore, build_manifest
+from utils import autotune_loader, classifier_train_step, load_tuned, save_tuned, loader_kwargs, LOADER_KEYS
+from utils import ClassBalancedSampler, RepeatedViewSampler, split_normalize, Prefetcher, BatchAugment, FMixMaskBank, TransformProfiler
+# apex.amp, imported in __main__ when params["fp16"]
+amp = None
 
 cudnn.benchmark = True
 SEED = 42
@@ -82,6 +72,7 @@ class MetricMonitor:
         )
 
 def update_hard_sample(train_loader, model, val_criterion, thres):
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots(nrows=1, ncols=3, figsize=(12, 6))
     train_loss_list = {'image_id':[],
                        'label':[],
@@ -93,6 +84,10 @@ def update_hard_sample(train_loader, model, val_criterion, thres):
         for i, (images, target, name) in enumerate(stream, start=1):
             images = images.to(params["device"], non_blocking=True)
             target = target.to(params["device"], non_blocking=True)#.view(-1,params['batch_size'])
+            if batch_augment is not None:
+                images = batch_augment(images)
+            if device_normalize is not None:
+                images = device_normalize(images)
             output = model(images)
             loss = val_criterion(output, target)
             if loss > thres:
@@ -154,20 +149,24 @@ def declare_model(params, load_pretrained=False, weight=None):
 def train_epoch(train_loader, model, criterion, optimizer, epoch, params):
     metric_monitor = MetricMonitor()
     model.train()
-    if params["hard_negative_sample"]:
-        stream = tqdm(update_train_loader)
-    else:
-        stream = tqdm(train_loader)
+    loader = update_train_loader if params["hard_negative_sample"] else train_loader
+    if params["prefetch"] > 0:
+        loader = Prefetcher(loader, params["device"], depth=params["prefetch"])
+    stream = tqdm(loader)
     for i, (images, target, _, _) in enumerate(stream, start=1):
 #         with autocast():
         images = images.to(params["device"]) #, non_blocking=True)
         target = target.to(params["device"]) #, non_blocking=True) #.view(-1,params['batch_size'])
+        if batch_augment is not None:
+            images = batch_augment(images)
+        if device_normalize is not None:
+            images = device_normalize(images)
         if params["mix_up"]:
             images , mtarget = mixup_fn(images, target)
         if epoch > 10 and params["fmix"]:
             images , ftarget = fmix(images, target, alpha=1., decay_power=5.,
                         shape=(params["image_size"],params["image_size"]),
-                        device=params["device"])      
+                        device=params["device"], bank=fmix_bank)      
             
             
         output = model(images)
@@ -175,7 +174,8 @@ def train_epoch(train_loader, model, criterion, optimizer, epoch, params):
             output = output[0]
             
         if epoch > 10 and params["fmix"]:
-            loss = criterion_fmix(output, ftarget[0]) * ftarget[2] + criterion_fmix(output, ftarget[1]) * (1. - ftarget[2])
+            # one lam per sample, criterion_fmix keeps the per-sample losses
+            loss = (criterion_fmix(output, ftarget[0]) * ftarget[2] + criterion_fmix(output, ftarget[1]) * (1. - ftarget[2])).mean()
             
         else:
             loss = criterion(output, mtarget)
@@ -197,15 +197,21 @@ def train_epoch(train_loader, model, criterion, optimizer, epoch, params):
         stream.set_description(
             "Epoch: {epoch}. Train.      {metric_monitor}".format(epoch=epoch, metric_monitor=metric_monitor)
         )
+    if isinstance(loader, Prefetcher):
+        print(f"Epoch: {epoch}. Train data wait: {loader.data_wait:.1f}s ({100 * loader.wait_ratio:.1f}%)")
             
 def validate(val_loader, model, criterion, optimizer, epoch, params, fold, best_acc):
     metric_monitor = MetricMonitor()
     model.eval()
+    if params["prefetch"] > 0:
+        val_loader = Prefetcher(val_loader, params["device"], depth=params["prefetch"])
     stream = tqdm(val_loader)
     with torch.no_grad():
         for i, (images, target, _,_) in enumerate(stream, start=1):
             images = images.to(params["device"], non_blocking=True)
             target = target.to(params["device"], non_blocking=True)#.view(-1,params['batch_size'])
+            if device_normalize is not None:
+                images = device_normalize(images)
             output = model(images)
             loss = val_criterion(output, target)
             output = torch.softmax(output, dim = 1)
@@ -216,6 +222,8 @@ def validate(val_loader, model, criterion, optimizer, epoch, params, fold, best_
             )           
             metric_monitor.update("Loss", loss.item())
             metric_monitor.update("Accuracy", accuracy)
+        if isinstance(val_loader, Prefetcher):
+            print(f"Epoch: {epoch}. Validation data wait: {val_loader.data_wait:.1f}s ({100 * val_loader.wait_ratio:.1f}%)")
             
         #to save weight
         if (metric_monitor.curr_acc > best_acc): # or epoch == params["epochs"]:
@@ -294,6 +302,11 @@ def train_epoch_bak(train_loader, model, criterion, optimizer, epoch, params, sc
             )
 
 if __name__ == "__main__":
+    # model, fold split and metric libraries, imported here so that DataLoader workers
+    # started with "spawn" (which re-import this file) do not pay for them
+    import timm
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.metrics import accuracy_score
 
     root = os.path.join(os.environ["HOME"], "Workspace/datasets/taiyoyuden/cassava")
     train = pd.read_csv(f'{root}/train.csv')
@@ -370,15 +383,53 @@ if __name__ == "__main__":
         "cutmix":True,
         "fmix":True,
         "smooth_label": 0.1,
-        "rand_aug": False,
+        "rand_aug": True,
         "local_rank":0,
         "distributed": False,
         "hard_negative_sample": False,
         "tta": True,
         "train_phase":True,
         "balance_data":False,
-        "kfold_pred":False
+        "kfold_pred":False,
+        # pre-decoded image store folder, None decodes the JPEG files every epoch
+        # a reduced store size changes what CenterCrop sees in val_transform
+        "image_store": None,
+        "image_store_size": None,
+        # crop/resize fused into a reduced-resolution JPEG decode, see utils/decode.py
+        "fast_decode": False,
+        # packed-shard folder, the training set is then streamed sequentially from large files
+        "shards": None,
+        # shared-memory budget (MB) for the uint8 output of val_transform, 0 disables the cache
+        "val_cache_mb": 0,
+        # persisted manifest (folds, image sizes, hashes), None recomputes the folds
+        "manifest": None,
+        # datasets return uint8 tensors, normalized on the device after the transfer
+        "uint8_transfer": False,
+        "channels_last": False,
+        # number of batches staged on the device ahead of the current step, 0 disables the prefetcher
+        "prefetch": 2,
+        # train augmentations applied per batch on the device instead of per image in the workers
+        "batch_augment": False,
+        # number of precomputed fmix masks kept by a background thread, 0 generates them per batch
+        "fmix_bank": 256,
+        # per-transform call rate and time of train_transform, printed every epoch
+        "profile_transforms": False,
+        # augmented views drawn from every decoded training image, in the same batch or spread
+        # over batches of the same worker. With keep_length an epoch keeps its number of steps and
+        # covers only 1 / repeat_views of the images, otherwise it is repeat_views times longer
+        "repeat_views": 1,
+        "repeat_views_spread": False,
+        "repeat_views_keep_length": True,
+        # JSON file of tuned loader settings (batch_size, num_workers, prefetch_factor, pin_memory),
+        # probed on the first fold when the file has no entry for this model and image size
+        "autotune": None,
+        "prefetch_factor": 2,
+        "pin_memory": True,
     }
+    # overrides of the unified CLI: python cassava.py <command> --set key=value
+    params.update(globals().get("CLI_PARAMS", {}))
+    if params["fp16"]:
+        from apex import amp
     scaler = GradScaler()   
 
         
@@ -411,6 +462,23 @@ if __name__ == "__main__":
             ToTensorV2(),
         ]
     )
+    device_normalize = None
+    if params["uint8_transfer"] or params["batch_augment"]:
+        train_transform, device_normalize = split_normalize(train_transform, channels_last=params["channels_last"])
+        val_transform, _ = split_normalize(val_transform)
+        device_normalize = device_normalize.to(params["device"])
+    batch_augment = None
+    if params["batch_augment"]:
+        # workers only decode, train_transform runs on whole batches on the device. Images are
+        # collated at the 600x800 of most of them, others are resized on their shorter side and
+        # padded / center cropped instead of being squashed
+        batch_augment = BatchAugment(params["image_size"])
+        train_transform = A.Compose([A.SmallestMaxSize(600), A.PadIfNeeded(600, 800), A.CenterCrop(600, 800),
+                                     ToTensorV2()])
+    transform_profiler = None
+    if params["profile_transforms"]:
+        transform_profiler = TransformProfiler(train_transform)
+        train_transform = transform_profiler.transform
     if params["cutmix"]:
         mixup_fn = Mixup(mixup_alpha=1., cutmix_alpha=1., label_smoothing=params["smooth_label"], num_classes=params["num_classes"])
     else:
@@ -418,7 +486,12 @@ if __name__ == "__main__":
 
         
     val_criterion = nn.CrossEntropyLoss().to(params["device"])
-    criterion_fmix = nn.CrossEntropyLoss().to(params["device"])
+    criterion_fmix = nn.CrossEntropyLoss(reduction='none').to(params["device"])
+    # masks are generated in the background once fmix kicks in, the thread is stopped after every fold
+    fmix_bank = None
+    if params["fmix"] and params["fmix_bank"] > 0:
+        fmix_bank = FMixMaskBank(params["fmix_bank"], alpha=1., decay_power=5.,
+                                 shape=(params["image_size"], params["image_size"]))
     criterion = LabelSmoothingCrossEntropy().to(params["device"])
     if params["mix_up"]:
         criterion = SoftTargetCrossEntropy().to(params["device"])
@@ -426,11 +499,29 @@ if __name__ == "__main__":
     symetric_criterion = SCELoss(smooth_label=params["smooth_label"]).to(params["device"])
         
      # model = getattr(models, params["model"])(pretrained=False, num_classes=5)
-    folds = train.copy()
-    Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
-    for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
-        folds.loc[val_index, 'fold'] = int(n)
-    folds['fold'] = folds['fold'].astype(int)
+    if params["manifest"] is not None:
+        manifest = build_manifest({'train': (train, f'{root}/train_images'),
+                                   'external': (train_external, f'{root}/train_images'),
+                                   'pseudo': (test_external_pseudo, f'{root}/train_images')},
+                                  params["manifest"], seed=SEED, num_workers=params["num_workers"])
+        folds = manifest[manifest['source'] == 'train'].reset_index(drop=True)
+        train_external = manifest[manifest['source'] == 'external'].reset_index(drop=True)
+        test_external_pseudo = manifest[manifest['source'] == 'pseudo'].reset_index(drop=True)
+    else:
+        folds = train.copy()
+        Fold = StratifiedKFold(n_splits=5, shuffle=True, random_state=SEED)
+        for n, (train_index, val_index) in enumerate(Fold.split(folds, folds['label'])):
+            folds.loc[val_index, 'fold'] = int(n)
+        folds['fold'] = folds['fold'].astype(int)
+
+    image_store = None
+    if params["image_store"] is not None:
+        build_image_store(merge_data(merge_data(train, train_external), test_external_pseudo), f'{root}/train_images',
+                          params["image_store"], sizes=(params["image_store_size"],), num_workers=params["num_workers"])
+        image_store = ImageStore(params["image_store"], params["image_store_size"])
+    if params["shards"] is not None:
+        pack_shards(merge_data(merge_data(train, train_external), test_external_pseudo), f'{root}/train_images',
+                    params["shards"])
     
     for i, fold_idx in enumerate(params["fold"]):
         print(f"Train Fold: {fold_idx}")
@@ -442,9 +533,7 @@ if __name__ == "__main__":
         train_folds = folds.loc[train_idx].reset_index(drop=True)
         val_folds = folds.loc[val_idx].reset_index(drop=True)
         
-        for idx,label in enumerate(train_external['label']):
-            train_external.loc[idx,'fold'] = fold
-        train_external['fold'] = train_external['fold'].astype(int)
+        train_external['fold'] = fold
         
         if params["train_external"]:
             train_folds = merge_data(train_folds, train_external)
@@ -458,37 +547,91 @@ if __name__ == "__main__":
             train_folds = merge_data(train_folds, test_external_pseudo)
             params["distill_soft_label"] = False
             
+        train_sampler = None
         if params["balance_data"]:
-            train_folds = balance_data(train_folds, mode="undersampling")    
+            # the train set is rebalanced per epoch by the sampler, without copying rows
+            train_sampler = ClassBalancedSampler(train_folds['label'].values, mode="undersampling", seed=SEED)
             val_folds = balance_data(val_folds, mode="undersampling", val=True)
             params["distill_soft_label"] = False
         
         # for distillation using soft label    
         if params["distill_soft_label"]:
-            soft_target_list = set(params["fold"]) - set([fold_idx])
-            for k, f in enumerate(soft_target_list):
-                if k == 0:
-                    soft_target_distill = pd.read_csv(f'./error_analysis/val_{params["model"]}_{f}_pred.csv')
-                else:
-                    soft_target_distill = merge_data(soft_target_distill,  pd.read_csv(f'./error_analysis/val_{params["model"]}_{f}_pred.csv'))
-            soft_target_distill = soft_target_distill.reset_index(drop=True)
-            soft_target_distill = soft_target_distill.set_index('image_id').sort_index().values
-            train_dataset = TrainDataset(train_folds, root, transform=train_transform, soft_df=soft_target_distill)
+            soft_target_list = sorted(set(params["fold"]) - set([fold_idx]))
+            soft_target_path = build_soft_label_store(
+                [f'./error_analysis/val_{params["model"]}_{f}_pred.csv' for f in soft_target_list],
+                f'./error_analysis/soft_{params["model"]}_{"".join(map(str, soft_target_list))}')
+            train_dataset = TrainDataset(train_folds, root, transform=train_transform,
+                                         soft_labels=SoftLabelStore(soft_target_path),
+                                         image_store=image_store, fast_decode=params["fast_decode"],
+                                         rand_aug=params["rand_aug"], repeat_views=params["repeat_views"])
+        elif params["shards"] is not None:
+            assert train_sampler is None, "balance_data needs a map-style dataset, unset shards"
+            train_dataset = ShardDataset(params["shards"], train_folds, transform=train_transform)
         else:
-            train_dataset = TrainDataset(train_folds, root, transform=train_transform)            
-        val_dataset = TrainDataset(val_folds, root, transform=val_transform)
+            train_dataset = TrainDataset(train_folds, root, transform=train_transform, image_store=image_store,
+                                         fast_decode=params["fast_decode"], rand_aug=params["rand_aug"],
+                                         repeat_views=params["repeat_views"])
+        val_dataset = TrainDataset(val_folds, root, transform=val_transform, image_store=image_store,
+                                   fast_decode=params["fast_decode"], cache_mb=params["val_cache_mb"])
+
+        if params["autotune"] is not None:
+            tune_key = f'train/{params["model"]}/{params["image_size"]}'
+            tuned = load_tuned(params["autotune"], tune_key)
+            if tuned is None:
+                # probed on a throwaway model, the training run starts from fresh weights
+                tune_model = timm.create_model(params["model"], pretrained=False,
+                                               num_classes=params["num_classes"]).to(params["device"])
+                if params["channels_last"]:
+                    tune_model = tune_model.to(memory_format=torch.channels_last)
+                def tune_mix(images, target):
+                    # the mixing of the late epochs (mixup, then fmix after epoch 10) as in train_epoch
+                    if params["mix_up"]:
+                        images, target = mixup_fn(images, target)
+                    if params["fmix"]:
+                        images, target = fmix(images, target, alpha=1., decay_power=5.,
+                                              shape=(params["image_size"], params["image_size"]),
+                                              device=params["device"], bank=fmix_bank)
+                    return images, target
+
+                def tune_criterion(output, target):
+                    if isinstance(target, tuple):
+                        return (criterion_fmix(output, target[0]) * target[2]
+                                + criterion_fmix(output, target[1]) * (1. - target[2])).mean()
+                    return criterion(output, target)
+
+                tune_step = classifier_train_step(tune_model, torch.optim.Adam(tune_model.parameters()),
+                                                  tune_criterion, params["device"],
+                                                  normalize=device_normalize, channels_last=params["channels_last"],
+                                                  augment=batch_augment,
+                                                  mix=tune_mix if params["mix_up"] or params["fmix"] else None)
+                tuned = autotune_loader(train_dataset, tune_step, device=params["device"])
+                save_tuned(params["autotune"], tune_key, tuned)
+                del tune_model, tune_step
+                if fmix_bank is not None:
+                    fmix_bank.close()
+            params.update({k: tuned[k] for k in LOADER_KEYS})
+
+        if params["repeat_views"] > 1 and not params["hard_negative_sample"]:
+            assert not isinstance(train_dataset, ShardDataset), "repeat_views needs a map-style dataset, unset shards"
+            base_sampler = train_sampler if train_sampler is not None else RandomSampler(train_dataset)
+            train_sampler = RepeatedViewSampler(base_sampler, params["repeat_views"], params["batch_size"],
+                                                params["num_workers"], spread=params["repeat_views_spread"],
+                                                keep_length=params["repeat_views_keep_length"], seed=SEED)
 
         if params["hard_negative_sample"]:
             train_loader = DataLoader(
-                train_dataset, batch_size=1, shuffle=True, num_workers=params["num_workers"], pin_memory=True,
+                train_dataset, batch_size=1, shuffle=not isinstance(train_dataset, ShardDataset),
+                num_workers=params["num_workers"],
+                pin_memory=params["pin_memory"],
             )
         else:
+            # an iterable dataset shuffles itself, the balanced sampler shuffles its draws
             train_loader = DataLoader(
-                train_dataset, batch_size=params["batch_size"], shuffle=True, num_workers=params["num_workers"], pin_memory=True,
+                train_dataset, sampler=train_sampler,
+                shuffle=train_sampler is None and not isinstance(train_dataset, ShardDataset),
+                **loader_kwargs(params),
             )
-        val_loader = DataLoader(
-            val_dataset, batch_size=params["batch_size"], shuffle=False, num_workers=params["num_workers"], pin_memory=True,
-        )
+        val_loader = DataLoader(val_dataset, shuffle=False, **loader_kwargs(params))
     
         # model declaration
         if "efficientnet" in params["model"]:
@@ -506,6 +649,8 @@ if __name__ == "__main__":
                 #drop_block_rate=params["drop_block"])    
     
         model = model.to(params["device"])
+        if params["channels_last"]:
+            model = model.to(memory_format=torch.channels_last)
         optimizer = torch.optim.Adam(model.parameters(), lr=params["lr"])
         # scheduler = CosineAnnealingLR(optimizer, T_max=10, eta_min=params["lr_min"], last_epoch=-1)
         scheduler = CosineAnnealingWarmRestarts(optimizer, T_0=10, T_mult=1, eta_min=params["lr_min"], last_epoch=-1)
@@ -536,17 +681,24 @@ if __name__ == "__main__":
                 visualize_class_dis(update_train_folds, params["fold"])
 
                 #update the training set
-                update_train_dataset = TrainDataset(update_train_folds, transform=train_transform)
-                update_train_loader = DataLoader(
-                    update_train_dataset, batch_size=params["batch_size"], shuffle=True, num_workers=params["num_workers"], pin_memory=True,
-                )                
+                update_train_dataset = TrainDataset(update_train_folds, root, transform=train_transform,
+                                                    rand_aug=params["rand_aug"])
+                update_train_loader = DataLoader(update_train_dataset, shuffle=True, **loader_kwargs(params))                
         else:
             best_acc = 0.83   
         
         # trainning process    
         for epoch in range(1, params["epochs"] + 1):
+            if isinstance(train_dataset, ShardDataset):
+                train_dataset.set_epoch(epoch)
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
             train_epoch(train_loader, model, criterion, optimizer, epoch, params)
+            if transform_profiler is not None:
+                transform_profiler.report(epoch)
             best_acc = validate(val_loader, model, criterion, optimizer ,epoch, params, fold, best_acc)
+        if fmix_bank is not None:
+            fmix_bank.close()
         
         del model
             
\ No newline at end of file
@@ -0,0 +1,68 @@
+""" The NumPy ops of ``NAME_TO_NP_OP`` against the PIL ops of ``NAME_TO_OP``. """
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+from utils.auto_augment import NAME_TO_OP, NAME_TO_NP_OP
+
+LUT_OPS = [
+    ('AutoContrast', ()),
+    ('Equalize', ()),
+    ('Invert', ()),
+    ('Posterize', (3,)),
+    ('Posterize', (8,)),
+    ('Solarize', (100,)),
+    ('SolarizeAdd', (60,)),
+    ('Contrast', (1.6,)),
+    ('Contrast', (0.3,)),
+    ('Brightness', (0.6,)),
+    ('Brightness', (1.4,)),
+    ('Color', (1.5,)),
+    ('Sharpness', (1.7,)),
+]
+
+AFFINE_OPS = [
+    ('ShearX', (0.2,)),
+    ('ShearY', (-0.2,)),
+    ('TranslateX', (7,)),
+    ('TranslateY', (-5,)),
+    ('TranslateXRel', (0.1,)),
+    ('TranslateYRel', (-0.1,)),
+    ('Rotate', (20,)),
+    ('Rotate', (-13,)),
+]
+
+INTERPOLATIONS = [Image.NEAREST, Image.BILINEAR, Image.BICUBIC]
+
+
+def random_image(smooth=False):
+    img = np.random.RandomState(0).randint(0, 256, (40, 56, 3)).astype(np.uint8)
+    # the affine ops are compared on a smooth image, PIL and cv2 interpolate with different precisions
+    return cv2.GaussianBlur(img, (7, 7), 3) if smooth else img
+
+
+def apply_both(name, args, img, resample):
+    kwargs = dict(fillcolor=(128, 128, 128), resample=resample)
+    expected = np.asarray(NAME_TO_OP[name](Image.fromarray(img), *args, **dict(kwargs)))
+    return NAME_TO_NP_OP[name](img, *args, **dict(kwargs)), expected
+
+
+def test_every_op_has_a_numpy_version():
+    assert set(NAME_TO_OP) == set(NAME_TO_NP_OP)
+
+
+@pytest.mark.parametrize('name, args', LUT_OPS)
+def test_lut_ops_match_pil(name, args):
+    out, expected = apply_both(name, args, random_image(), Image.BILINEAR)
+    assert out.dtype == np.uint8
+    np.testing.assert_array_equal(out, expected)
+
+
+@pytest.mark.parametrize('resample', INTERPOLATIONS)
+@pytest.mark.parametrize('name, args', AFFINE_OPS)
+def test_affine_ops_match_pil(name, args, resample):
+    out, expected = apply_both(name, args, random_image(smooth=True), resample)
+    assert out.shape == expected.shape and out.dtype == np.uint8
+    diff = np.abs(out.astype(np.int64) - expected)
+    assert diff.mean() < 1.
+    assert (diff > 8).mean() < 0.02
@@ -0,0 +1,19 @@
+import albumentations as A
+import cv2
+import numpy as np
+import pandas as pd
+from utils import TrainDataset
+
+
+def test_repeated_views_get_their_own_crop(tmp_path):
+    (tmp_path / 'train_images').mkdir()
+    image = np.random.RandomState(0).randint(0, 256, (60, 80, 3)).astype(np.uint8)
+    cv2.imwrite(str(tmp_path / 'train_images' / 'a.jpg'), image)
+    df = pd.DataFrame({'image_id': ['a.jpg'], 'label': [1]})
+    transform = A.Compose([A.RandomResizedCrop(16, 16)])
+    dataset = TrainDataset(df, str(tmp_path), transform=transform, fast_decode=True, repeat_views=4)
+    # the shared decode is uncropped, the crop stays in the per-view transform
+    assert dataset.load_image(0).shape == (60, 80, 3)
+    views = [dataset[0][0] for _ in range(4)]
+    assert all(v.shape == (16, 16, 3) for v in views)
+    assert any((v != views[0]).any() for v in views[1:])
@@ -0,0 +1,59 @@
+import time
+import numpy as np
+import pytest
+import torch
+from utils.fmix import binarise_masks, sample_masks, FMixMaskBank
+
+
+@pytest.mark.parametrize('size', [64, 63])
+def test_binarise_masks_keeps_lam(size):
+    torch.manual_seed(0)
+    masks = torch.randn(16, size)
+    lam = torch.rand(16)
+    out = binarise_masks(masks, lam)
+    assert set(out.unique().tolist()) <= {0., 1.}
+    # ceil or floor of lam * size pixels are kept, the largest ones
+    kept = out.sum(1)
+    assert ((kept == torch.floor(lam * size)) | (kept == torch.ceil(lam * size))).all()
+    for row, mask in zip(masks, out):
+        if 0 < mask.sum() < size:
+            assert row[mask.bool()].min() >= row[~mask.bool()].max()
+
+
+def test_binarise_masks_soft_ramp():
+    torch.manual_seed(0)
+    masks = torch.randn(8, 100)
+    lam = torch.full((8,), 0.5)
+    out = binarise_masks(masks, lam, max_soft=0.1)
+    assert ((out >= 0) & (out <= 1)).all()
+    # 40 pixels are fully kept, 40 fully dropped and the 20 in between are ramped
+    assert ((out == 1).sum(1) >= 40).all() and ((out == 0).sum(1) >= 40).all()
+    assert (out.sum(1) - 50).abs().max() <= 11
+
+
+def test_sample_masks_shapes():
+    np.random.seed(0)
+    lam, masks = sample_masks(4, 1., 3., (16, 24))
+    assert lam.shape == (4,) and masks.shape == (4, 1, 16, 24)
+    np.testing.assert_allclose(masks.mean((1, 2, 3)).numpy(), lam.numpy(), atol=1. / (16 * 24))
+
+
+def test_mask_bank_draws_filled_masks():
+    np.random.seed(0)
+    bank = FMixMaskBank(8, 1., 3., 16, chunk=4)
+    # the thread starts with the first draw
+    assert bank.thread is None
+    try:
+        deadline = time.time() + 30
+        drawn = None
+        while drawn is None and time.time() < deadline:
+            drawn = bank.draw(6, 'cpu')
+            time.sleep(0.01)
+        assert drawn is not None
+        lam, masks = drawn
+        assert lam.shape == (6,) and masks.shape == (6, 1, 16, 16)
+        np.testing.assert_allclose(masks.mean((1, 2, 3)).numpy(), lam.numpy(), atol=1. / 256)
+        thread = bank.thread
+    finally:
+        bank.close()
+    assert not thread.is_alive() and bank.thread is None and bank.filled == 0
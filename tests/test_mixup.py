@@ -0,0 +1,92 @@
+""" The batched 'elem' and 'pair' Mixup against the per-element loops they replaced. """
+import numpy as np
+import pytest
+import torch
+from utils import Mixup
+
+
+def record_params(mixer):
+    """ Keeps a copy of the lam / use_cutmix draws and of the cutmix boxes of the next call. """
+    record = {}
+    params_per_elem, cutmix_boxes = mixer._params_per_elem, mixer._cutmix_boxes
+
+    def _params_per_elem(batch_size):
+        lam, use_cutmix = params_per_elem(batch_size)
+        record.update(lam=lam.copy(), use_cutmix=use_cutmix.copy())
+        return lam, use_cutmix
+
+    def _cutmix_boxes(img_shape, lam_batch, use_cutmix):
+        boxes, lam = cutmix_boxes(img_shape, lam_batch, use_cutmix)
+        record.update(boxes=boxes.copy(), lam_cut=lam.copy())
+        return boxes, lam
+
+    mixer._params_per_elem, mixer._cutmix_boxes = _params_per_elem, _cutmix_boxes
+    return record
+
+
+def reference_elem(x, record):
+    batch_size = len(x)
+    lam_batch, use_cutmix = record['lam'].copy(), record['use_cutmix']
+    x_orig = x.clone()
+    for i in range(batch_size):
+        j = batch_size - i - 1
+        lam = lam_batch[i]
+        if lam != 1.:
+            if use_cutmix[i]:
+                yl, yh, xl, xh = record['boxes'][i]
+                x[i][:, yl:yh, xl:xh] = x_orig[j][:, yl:yh, xl:xh]
+                lam_batch[i] = record['lam_cut'][i]
+            else:
+                x[i] = x[i] * lam + x_orig[j] * (1 - lam)
+    return x, torch.tensor(lam_batch).unsqueeze(1)
+
+
+def reference_pair(x, record):
+    batch_size = len(x)
+    lam_batch, use_cutmix = record['lam'].copy(), record['use_cutmix']
+    x_orig = x.clone()
+    for i in range(batch_size // 2):
+        j = batch_size - i - 1
+        lam = lam_batch[i]
+        if lam != 1.:
+            if use_cutmix[i]:
+                yl, yh, xl, xh = record['boxes'][i]
+                x[i][:, yl:yh, xl:xh] = x_orig[j][:, yl:yh, xl:xh]
+                x[j][:, yl:yh, xl:xh] = x_orig[i][:, yl:yh, xl:xh]
+                lam_batch[i] = record['lam_cut'][i]
+            else:
+                x[i] = x[i] * lam + x_orig[j] * (1 - lam)
+                x[j] = x[j] * lam + x_orig[i] * (1 - lam)
+    # the middle element of an odd batch is not mixed
+    lam_batch = np.concatenate((lam_batch, np.ones(batch_size % 2, dtype=np.float32), lam_batch[::-1]))
+    return x, torch.tensor(lam_batch).unsqueeze(1)
+
+
+@pytest.mark.parametrize('mode, reference', [('elem', reference_elem), ('pair', reference_pair)])
+@pytest.mark.parametrize('batch_size', [8, 9])
+def test_batched_mix_matches_loop(mode, reference, batch_size):
+    np.random.seed(3)
+    torch.manual_seed(3)
+    mixer = Mixup(mixup_alpha=1., cutmix_alpha=1., prob=0.8, mode=mode, label_smoothing=0.1, num_classes=5)
+    record = record_params(mixer)
+    x = torch.rand(batch_size, 3, 24, 32)
+    target = torch.randint(0, 5, (batch_size,))
+
+    mixed, mixed_target = mixer(x.clone(), target)
+    expected, lam = reference(x.clone(), record)
+
+    active = record['lam'] != 1.
+    # the draw mixes cutmix and mixup elements in the same batch
+    assert (record['use_cutmix'] & active).any() and (~record['use_cutmix'] & active).any()
+    torch.testing.assert_close(mixed, expected)
+    off = 0.1 / 5
+    y1 = torch.full((batch_size, 5), off).scatter_(1, target.view(-1, 1), 1. - 0.1 + off)
+    torch.testing.assert_close(mixed_target, y1 * lam + y1.flip(0) * (1. - lam))
+
+
+def test_disabled_mixup_keeps_batch():
+    mixer = Mixup(mixup_alpha=1., cutmix_alpha=1., mode='elem', num_classes=5)
+    mixer.mixup_enabled = False
+    x = torch.rand(5, 3, 8, 8)
+    mixed, _ = mixer(x.clone(), torch.zeros(5, dtype=torch.long))
+    torch.testing.assert_close(mixed, x)
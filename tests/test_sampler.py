@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from utils.sampler import balance_rates, ClassBalancedSampler
+
+LABELS = np.repeat(np.arange(5), [40, 90, 100, 300, 60])
+
+
+def test_balance_rates():
+    np.testing.assert_allclose(balance_rates(LABELS, "undersampling"), [1., 0.7, 1., 2. / 3., 1.3])
+    # up-sampling targets are fractions of the size of class 3
+    rates = balance_rates(LABELS, "upsampling")
+    np.testing.assert_allclose(rates * np.bincount(LABELS), 300 * np.array([1 / 4, 1 / 3, 1 / 3, 1., 1 / 3]))
+
+
+@pytest.mark.parametrize('mode', ["undersampling", "upsampling"])
+def test_sampler_draws_rate_times_count(mode):
+    sampler = ClassBalancedSampler(LABELS, mode=mode, num_replicas=1, rank=0)
+    indices = list(sampler)
+    assert len(indices) == len(sampler)
+    counts = np.bincount(LABELS[indices], minlength=5)
+    np.testing.assert_array_equal(counts, (np.bincount(LABELS) * balance_rates(LABELS, mode)).astype(int))
+    # rates of 1 and above keep every sample of the class
+    for c in np.flatnonzero(balance_rates(LABELS, mode) >= 1.):
+        assert set(np.flatnonzero(LABELS == c)) <= set(indices)
+
+
+def test_sampler_epochs():
+    sampler = ClassBalancedSampler(LABELS, num_replicas=1, rank=0, seed=1)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+    sampler.set_rates({1: 0.5})
+    assert np.bincount(LABELS[list(sampler)], minlength=5)[1] == 45
+
+
+def test_sampler_replicas_split_the_epoch():
+    shards = [list(ClassBalancedSampler(LABELS, num_replicas=3, rank=r)) for r in range(3)]
+    full = list(ClassBalancedSampler(LABELS, num_replicas=1, rank=0))
+    assert len({len(s) for s in shards}) == 1
+    merged = [i for group in zip(*shards) for i in group]
+    # the replicas interleave the same draw, padded to a multiple of num_replicas
+    assert merged[:len(full)] == full
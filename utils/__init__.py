@@ -1,18 +1,99 @@
-from .augmentation import *
-from .auto_augment import *
-from .radam import *
-from .evonorm2d import *
-from .custom_loss import *
-from .util import *
-from .dataset import *
-from .fmix import fmix
-from .sam import SAM
-from .bi_tempered_loss import bi_tempered_logistic_loss
+""" Package namespace, imported lazily
+
+``import utils`` only builds the name -> submodule table below; a submodule, and the
+heavy dependencies it pulls in (scipy, albumentations, sklearn, ...), is imported the
+first time one of its names is used, so short inference jobs and DataLoader workers
+started with "spawn" only pay for what they touch.
+"""
+import importlib
+
+# submodule -> public names
+_SUBMODULES = {
+    "augmentation": ("one_hot", "mixup_target", "rand_bbox", "rand_bbox_minmax",
+        "cutmix_bbox_and_lam", "Mixup"),
+    "auto_augment": ("shear_x", "shear_y", "translate_x_rel", "translate_y_rel",
+        "translate_x_abs", "translate_y_abs", "rotate", "auto_contrast", "invert", "equalize",
+        "solarize", "solarize_add", "posterize", "contrast", "color", "brightness", "sharpness",
+        "shear_x_np", "shear_y_np", "translate_x_rel_np", "translate_y_rel_np",
+        "translate_x_abs_np", "translate_y_abs_np", "rotate_np", "auto_contrast_np",
+        "invert_np", "equalize_np", "solarize_np", "solarize_add_np", "posterize_np",
+        "contrast_np", "color_np", "brightness_np", "sharpness_np", "AugmentOp",
+        "auto_augment_policy_v0", "auto_augment_policy_v0r", "auto_augment_policy_original",
+        "auto_augment_policy_originalr", "auto_augment_policy", "AutoAugment",
+        "auto_augment_transform", "rand_augment_ops", "RandAugment", "rand_augment_transform",
+        "augmix_ops", "AugMixAugment", "augment_and_mix_transform", "LEVEL_TO_ARG",
+        "NAME_TO_OP", "NAME_TO_NP_OP"),
+    "radam": ("RAdam", "PlainRAdam", "AdamW"),
+    "evonorm2d": ("SwishImplementation", "MemoryEfficientSwish", "instance_std", "group_std",
+        "EvoNorm2D"),
+    "custom_loss": ("LabelSmoothingCrossEntropy", "SoftTargetCrossEntropy", "VarifocalLoss",
+        "SCELoss", "AsymmetricLossSingleLabel", "FocalCosineLoss"),
+    "util": ("repeat_weight", "weight_score", "optimize_weight"),
+    "dataset": ("merge_data", "balance_data", "TrainDataset", "TestDataset"),
+    "image_store": ("build_image_store", "ImageStore"),
+    "decode": ("ImageDecoder", "read_jpeg_size", "measure_decode_tolerance"),
+    "shards": ("pack_shards", "ShardDataset"),
+    "transform_cache": ("TransformCache", "is_deterministic"),
+    "soft_labels": ("build_soft_label_store", "SoftLabelStore"),
+    "manifest": ("build_manifest", "load_manifest", "file_hash"),
+    "sampler": ("ClassBalancedSampler", "RepeatedViewSampler", "balance_rates"),
+    "data_index": ("DataIndex", "default_roots"),
+    "device_normalize": ("DeviceNormalize", "split_normalize"),
+    "prefetcher": ("Prefetcher",),
+    "batch_augment": ("BatchAugment",),
+    "fmix": ("fmix", "FMixMaskBank"),
+    "transform_profiler": ("TransformProfiler",),
+    "tta": ("BatchTTA", "five_crop"),
+    "inference": ("InferenceEngine", "load_member", "load_members", "load_state_dict"),
+    "checkpoint_store": ("export_weights", "export_ensemble", "read_weights", "read_meta"),
+    "submission": ("write_submission", "write_predictions", "reduce_ensemble"),
+    "prediction_cache": ("PredictionCache", "cached_logits", "transform_signature"),
+    "cpu_pool": ("cpu_pool_predict", "iter_cpu_pool"),
+    "autotune": ("autotune_loader", "probe_loader", "classifier_train_step",
+        "classifier_pred_step", "load_tuned", "save_tuned", "loader_kwargs", "LOADER_KEYS"),
+    "sam": ("SAM",),
+    "bi_tempered_loss": ("bi_tempered_logistic_loss",),
+}
+_LAZY = {name: module for module, names in _SUBMODULES.items() for name in names}
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    mod = importlib.import_module(f'.{module}', __name__)
+    # binds every name of the submodule, so that e.g. the fmix function shadows the fmix submodule
+    for n in _SUBMODULES[module]:
+        globals()[n] = getattr(mod, n)
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
 
 __all__ = ["TrainDataset", "TestDataset", "balance_data", "merge_data",
            "Mixup", "RandAugment", "AutoAugment",
            "RAdam", "EvoNorm2D", 
            "SCELoss", "VarifocalSmoothLoss", "AsymmetricLossSingleLabel", 
-           "LabelSmoothingCrossEntropy", "SoftTargetCrossEntropy", "fmix",
-           "optimize_weight", "SAM", "bi_tempered_logistic_loss"
+           "LabelSmoothingCrossEntropy", "SoftTargetCrossEntropy", "fmix", "FMixMaskBank",
+           "optimize_weight", "SAM", "bi_tempered_logistic_loss",
+           "build_image_store", "ImageStore",
+           "ImageDecoder", "read_jpeg_size", "measure_decode_tolerance",
+           "pack_shards", "ShardDataset",
+           "TransformCache", "is_deterministic",
+           "build_soft_label_store", "SoftLabelStore",
+           "build_manifest", "load_manifest", "file_hash",
+           "ClassBalancedSampler", "RepeatedViewSampler", "balance_rates",
+           "DataIndex", "default_roots",
+           "DeviceNormalize", "split_normalize",
+           "Prefetcher", "BatchAugment",
+           "TransformProfiler", "BatchTTA", "five_crop",
+           "InferenceEngine", "load_member", "load_members", "load_state_dict",
+           "export_weights", "export_ensemble", "read_weights", "read_meta",
+           "write_submission", "write_predictions", "reduce_ensemble",
+           "PredictionCache", "cached_logits", "transform_signature",
+           "cpu_pool_predict", "iter_cpu_pool",
+           "autotune_loader", "probe_loader", "classifier_train_step", "classifier_pred_step",
+           "load_tuned", "save_tuned", "loader_kwargs", "LOADER_KEYS"
            ]
\ No newline at end of file
@@ -6,12 +6,14 @@ Hacked together by / Copyright 2020 Ross Wightman'''
 import numpy as np
 import torch
 
-def one_hot(x, num_classes, on_value=1., off_value=0., device='cuda'):
-    x = x.long().view(-1, 1)
+def one_hot(x, num_classes, on_value=1., off_value=0., device=None):
+    device = x.device if device is None else device
+    x = x.long().view(-1, 1).to(device)
     return torch.full((x.size()[0], num_classes), off_value, device=device).scatter_(1, x, on_value)
 
 
-def mixup_target(target, num_classes, lam=1., smoothing=0.0, device='cuda'):
+def mixup_target(target, num_classes, lam=1., smoothing=0.0, device=None):
+    device = target.device if device is None else device
     off_value = smoothing / num_classes
     on_value = 1. - smoothing + off_value
     y1 = one_hot(target, num_classes, on_value=on_value, off_value=off_value, device=device)
@@ -32,8 +34,9 @@ def rand_bbox(img_shape, lam, margin=0., count=None):
     """
     ratio = np.sqrt(1 - lam)
     img_h, img_w = img_shape[-2:]
-    cut_h, cut_w = int(img_h * ratio), int(img_w * ratio)
-    margin_y, margin_x = int(margin * cut_h), int(margin * cut_w)
+    # lam may be an array with one value per box
+    cut_h, cut_w = (img_h * ratio).astype(np.int64), (img_w * ratio).astype(np.int64)
+    margin_y, margin_x = (margin * cut_h).astype(np.int64), (margin * cut_w).astype(np.int64)
     cy = np.random.randint(0 + margin_y, img_h - margin_y, size=count)
     cx = np.random.randint(0 + margin_x, img_w - margin_x, size=count)
     yl = np.clip(cy - cut_h // 2, 0, img_h)
@@ -112,7 +115,7 @@ class Mixup:
 
     def _params_per_elem(self, batch_size):
         lam = np.ones(batch_size, dtype=np.float32)
-        use_cutmix = np.zeros(batch_size, dtype=np.bool)
+        use_cutmix = np.zeros(batch_size, dtype=bool)
         if self.mixup_enabled:
             if self.mixup_alpha > 0. and self.cutmix_alpha > 0.:
                 use_cutmix = np.random.rand(batch_size) < self.switch_prob
@@ -123,7 +126,7 @@ class Mixup:
             elif self.mixup_alpha > 0.:
                 lam_mix = np.random.beta(self.mixup_alpha, self.mixup_alpha, size=batch_size)
             elif self.cutmix_alpha > 0.:
-                use_cutmix = np.ones(batch_size, dtype=np.bool)
+                use_cutmix = np.ones(batch_size, dtype=bool)
                 lam_mix = np.random.beta(self.cutmix_alpha, self.cutmix_alpha, size=batch_size)
             else:
                 assert False, "One of mixup_alpha > 0., cutmix_alpha > 0., cutmix_minmax not None should be true."
@@ -148,42 +151,54 @@ class Mixup:
             lam = float(lam_mix)
         return lam, use_cutmix
 
-    def _mix_elem(self, x):
-        batch_size = len(x)
-        lam_batch, use_cutmix = self._params_per_elem(batch_size)
-        x_orig = x.clone()  # need to keep an unmodified original for mixing source
-        for i in range(batch_size):
-            j = batch_size - i - 1
-            lam = lam_batch[i]
-            if lam != 1.:
-                if use_cutmix[i]:
-                    (yl, yh, xl, xh), lam = cutmix_bbox_and_lam(
-                        x[i].shape, lam, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam)
-                    x[i][:, yl:yh, xl:xh] = x_orig[j][:, yl:yh, xl:xh]
-                    lam_batch[i] = lam
-                else:
-                    x[i] = x[i] * lam + x_orig[j] * (1 - lam)
+    def _cutmix_boxes(self, img_shape, lam_batch, use_cutmix):
+        """ One cutmix box per element, lam is corrected where cutmix is used. """
+        (yl, yh, xl, xh), lam_cut = cutmix_bbox_and_lam(
+            img_shape, lam_batch, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam, count=len(lam_batch))
+        lam_batch = np.where(use_cutmix & (lam_batch != 1.), lam_cut, lam_batch).astype(np.float32)
+        return np.stack([yl, yh, xl, xh], axis=1), lam_batch
+
+    def _mix_with(self, x, lam_batch, use_cutmix, boxes):
+        """ Mixes every element i with element len(x) - i - 1, the whole batch in one blend. """
+        active = lam_batch != 1.
+        if not active.any():
+            return torch.ones(len(x), 1, device=x.device, dtype=x.dtype)
+        use_cutmix = use_cutmix & active
+        # weight of the mixing source: 1 - lam for mixup, 1 inside the cutmix box
+        weight = torch.as_tensor(np.where(use_cutmix, 0., 1. - lam_batch), device=x.device, dtype=x.dtype)
+        weight = weight.view(-1, *([1] * (x.dim() - 1)))
+        if use_cutmix.any():
+            bounds = torch.as_tensor(boxes, device=x.device)
+            rows = torch.arange(x.shape[-2], device=x.device)[None]
+            cols = torch.arange(x.shape[-1], device=x.device)[None]
+            rows = (rows >= bounds[:, 0:1]) & (rows < bounds[:, 1:2])
+            rows &= torch.as_tensor(use_cutmix, device=x.device)[:, None]
+            cols = (cols >= bounds[:, 2:3]) & (cols < bounds[:, 3:4])
+            inside = torch.bmm(rows.to(x.dtype)[:, :, None], cols.to(x.dtype)[:, None, :])
+            weight = weight + inside[:, None]
+        x_orig = x.flip(0)  # a copy, the unmodified mixing source
+        x.lerp_(x_orig, weight)
         return torch.tensor(lam_batch, device=x.device, dtype=x.dtype).unsqueeze(1)
 
+    def _mix_elem(self, x):
+        lam_batch, use_cutmix = self._params_per_elem(len(x))
+        boxes = None
+        if use_cutmix.any():
+            boxes, lam_batch = self._cutmix_boxes(x.shape, lam_batch, use_cutmix)
+        return self._mix_with(x, lam_batch, use_cutmix, boxes)
+
     def _mix_pair(self, x):
         batch_size = len(x)
         lam_batch, use_cutmix = self._params_per_elem(batch_size // 2)
-        x_orig = x.clone()  # need to keep an unmodified original for mixing source
-        for i in range(batch_size // 2):
-            j = batch_size - i - 1
-            lam = lam_batch[i]
-            if lam != 1.:
-                if use_cutmix[i]:
-                    (yl, yh, xl, xh), lam = cutmix_bbox_and_lam(
-                        x[i].shape, lam, ratio_minmax=self.cutmix_minmax, correct_lam=self.correct_lam)
-                    x[i][:, yl:yh, xl:xh] = x_orig[j][:, yl:yh, xl:xh]
-                    x[j][:, yl:yh, xl:xh] = x_orig[i][:, yl:yh, xl:xh]
-                    lam_batch[i] = lam
-                else:
-                    x[i] = x[i] * lam + x_orig[j] * (1 - lam)
-                    x[j] = x[j] * lam + x_orig[i] * (1 - lam)
-        lam_batch = np.concatenate((lam_batch, lam_batch[::-1]))
-        return torch.tensor(lam_batch, device=x.device, dtype=x.dtype).unsqueeze(1)
+        boxes = np.zeros((batch_size // 2, 4), dtype=np.int64)
+        if use_cutmix.any():
+            boxes, lam_batch = self._cutmix_boxes(x.shape, lam_batch, use_cutmix)
+        # both elements of a pair share lam and the box, the middle element of an odd batch is kept
+        middle = batch_size % 2
+        lam_batch = np.concatenate((lam_batch, np.ones(middle, dtype=np.float32), lam_batch[::-1]))
+        use_cutmix = np.concatenate((use_cutmix, np.zeros(middle, dtype=bool), use_cutmix[::-1]))
+        boxes = np.concatenate((boxes, np.zeros((middle, 4), dtype=boxes.dtype), boxes[::-1]))
+        return self._mix_with(x, lam_batch, use_cutmix, boxes)
 
     def _mix_batch(self, x):
         lam, use_cutmix = self._params_per_batch()
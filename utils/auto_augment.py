@@ -23,6 +23,7 @@ import re
 from PIL import Image, ImageOps, ImageEnhance, ImageChops
 import PIL
 import numpy as np
+import cv2
 
 
 _PIL_VER = tuple([int(x) for x in PIL.__version__.split('.')[:2]])
@@ -172,6 +173,141 @@ def sharpness(img, factor, **__):
     return ImageEnhance.Sharpness(img).enhance(factor)
 
 
+# NumPy versions of the ops above, on HWC uint8 RGB arrays. The colour ops are
+# lookup tables applied with cv2.LUT and the geometric ops a single cv2.warpAffine,
+# both follow the PIL rounding closely enough to be interchangeable.
+
+_CV2_INTERPOLATION = {Image.NEAREST: cv2.INTER_NEAREST, Image.BILINEAR: cv2.INTER_LINEAR,
+                      Image.BICUBIC: cv2.INTER_CUBIC}
+
+_IDENTITY_LUT = np.arange(256, dtype=np.float32)
+
+
+def _warp_np(img, matrix, **kwargs):
+    # PIL samples the input at matrix @ (x + .5, y + .5) - .5, cv2 at matrix @ (x, y)
+    (a, b, c, d, e, f) = matrix
+    m = np.array([[a, b, c + 0.5 * (a + b - 1)], [d, e, f + 0.5 * (d + e - 1)]], dtype=np.float64)
+    fill = kwargs.get('fillcolor', _FILL)
+    flags = _CV2_INTERPOLATION[_interpolation(kwargs)] | cv2.WARP_INVERSE_MAP
+    return cv2.warpAffine(img, m, (img.shape[1], img.shape[0]), flags=flags,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=tuple(fill))
+
+
+def _lut_np(img, lut):
+    # lut is (256,) for all channels or (channels, 256) per channel
+    lut = np.clip(lut, 0, 255).astype(np.uint8)
+    if lut.ndim == 2:
+        lut = np.ascontiguousarray(lut.T).reshape(256, 1, -1)
+    return cv2.LUT(img, lut)
+
+
+def _gray_np(img):
+    # same fixed point coefficients as PIL's convert("L")
+    gray = img.astype(np.uint32) @ np.array([19595, 38470, 7471], dtype=np.uint32)
+    return ((gray + 0x8000) >> 16).astype(np.uint8)
+
+
+def _blend_np(degenerate, img, factor):
+    # Image.blend truncates degenerate + factor * (img - degenerate)
+    out = cv2.addWeighted(img, factor, degenerate, 1. - factor, 0., dtype=cv2.CV_32F)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def shear_x_np(img, factor, **kwargs):
+    return _warp_np(img, (1, factor, 0, 0, 1, 0), **kwargs)
+
+
+def shear_y_np(img, factor, **kwargs):
+    return _warp_np(img, (1, 0, 0, factor, 1, 0), **kwargs)
+
+
+def translate_x_rel_np(img, pct, **kwargs):
+    return _warp_np(img, (1, 0, pct * img.shape[1], 0, 1, 0), **kwargs)
+
+
+def translate_y_rel_np(img, pct, **kwargs):
+    return _warp_np(img, (1, 0, 0, 0, 1, pct * img.shape[0]), **kwargs)
+
+
+def translate_x_abs_np(img, pixels, **kwargs):
+    return _warp_np(img, (1, 0, pixels, 0, 1, 0), **kwargs)
+
+
+def translate_y_abs_np(img, pixels, **kwargs):
+    return _warp_np(img, (1, 0, 0, 0, 1, pixels), **kwargs)
+
+
+def rotate_np(img, degrees, **kwargs):
+    # counter-clockwise around the image centre, as Image.rotate
+    h, w = img.shape[:2]
+    angle = math.radians(degrees)
+    cos, sin = math.cos(angle), math.sin(angle)
+    cx, cy = w / 2.0, h / 2.0
+    return _warp_np(img, (cos, -sin, cx - cos * cx + sin * cy, sin, cos, cy - sin * cx - cos * cy), **kwargs)
+
+
+def auto_contrast_np(img, **__):
+    lo = img.reshape(-1, img.shape[2]).min(0).astype(np.float32)
+    hi = img.reshape(-1, img.shape[2]).max(0).astype(np.float32)
+    scale = np.where(hi > lo, 255. / np.maximum(hi - lo, 1.), 1.)
+    offset = np.where(hi > lo, -lo * scale, 0.)
+    return _lut_np(img, np.trunc(_IDENTITY_LUT * scale[:, None] + offset[:, None]))
+
+
+def invert_np(img, **__):
+    return _lut_np(img, 255. - _IDENTITY_LUT)
+
+
+def equalize_np(img, **__):
+    luts = []
+    for c in range(img.shape[2]):
+        hist = np.bincount(img[..., c].ravel(), minlength=256)
+        nonzero = hist[hist > 0]
+        step = (nonzero.sum() - nonzero[-1]) // 255
+        if len(nonzero) <= 1 or not step:
+            luts.append(_IDENTITY_LUT)
+            continue
+        cum = np.concatenate([[0], np.cumsum(hist)[:-1]])
+        luts.append((step // 2 + cum) // step)
+    return _lut_np(img, np.stack(luts))
+
+
+def solarize_np(img, thresh, **__):
+    return _lut_np(img, np.where(_IDENTITY_LUT < thresh, _IDENTITY_LUT, 255. - _IDENTITY_LUT))
+
+
+def solarize_add_np(img, add, thresh=128, **__):
+    return _lut_np(img, np.where(_IDENTITY_LUT < thresh, np.minimum(255., _IDENTITY_LUT + add), _IDENTITY_LUT))
+
+
+def posterize_np(img, bits_to_keep, **__):
+    if bits_to_keep >= 8:
+        return img
+    mask = ~(2 ** (8 - bits_to_keep) - 1)
+    return _lut_np(img, np.arange(256) & mask)
+
+
+def contrast_np(img, factor, **__):
+    mean = int(_gray_np(img).mean() + 0.5)
+    return _lut_np(img, np.trunc(mean + factor * (_IDENTITY_LUT - mean)))
+
+
+def color_np(img, factor, **__):
+    return _blend_np(cv2.cvtColor(_gray_np(img), cv2.COLOR_GRAY2RGB), img, factor)
+
+
+def brightness_np(img, factor, **__):
+    return _lut_np(img, np.trunc(factor * _IDENTITY_LUT))
+
+
+def sharpness_np(img, factor, **__):
+    # ImageFilter.SMOOTH, the border pixels are left as they are
+    kernel = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13.
+    degenerate = img.copy()
+    degenerate[1:-1, 1:-1] = cv2.filter2D(img, -1, kernel)[1:-1, 1:-1]
+    return _blend_np(degenerate, img, factor)
+
+
 def _randomly_negate(v):
     """With 50% prob, negate the value"""
     return -v if random.random() > 0.5 else v
@@ -314,11 +450,41 @@ NAME_TO_OP = {
 }
 
 
+NAME_TO_NP_OP = {
+    'AutoContrast': auto_contrast_np,
+    'Equalize': equalize_np,
+    'Invert': invert_np,
+    'Rotate': rotate_np,
+    'Posterize': posterize_np,
+    'PosterizeIncreasing': posterize_np,
+    'PosterizeOriginal': posterize_np,
+    'Solarize': solarize_np,
+    'SolarizeIncreasing': solarize_np,
+    'SolarizeAdd': solarize_add_np,
+    'Color': color_np,
+    'ColorIncreasing': color_np,
+    'Contrast': contrast_np,
+    'ContrastIncreasing': contrast_np,
+    'Brightness': brightness_np,
+    'BrightnessIncreasing': brightness_np,
+    'Sharpness': sharpness_np,
+    'SharpnessIncreasing': sharpness_np,
+    'ShearX': shear_x_np,
+    'ShearY': shear_y_np,
+    'TranslateX': translate_x_abs_np,
+    'TranslateY': translate_y_abs_np,
+    'TranslateXRel': translate_x_rel_np,
+    'TranslateYRel': translate_y_rel_np,
+}
+
+
 class AugmentOp:
+    """ Applies op ``name`` with probability ``prob``, to a PIL image or a HWC uint8 RGB array. """
 
     def __init__(self, name, prob=0.5, magnitude=10, hparams=None):
         hparams = hparams or _HPARAMS_DEFAULT
         self.aug_fn = NAME_TO_OP[name]
+        self.np_aug_fn = NAME_TO_NP_OP[name]
         self.level_fn = LEVEL_TO_ARG[name]
         self.prob = prob
         self.magnitude = magnitude
@@ -342,7 +508,8 @@ class AugmentOp:
             magnitude = random.gauss(magnitude, self.magnitude_std)
         magnitude = min(_MAX_LEVEL, max(0, magnitude))  # clip to valid range
         level_args = self.level_fn(magnitude, self.hparams) if self.level_fn is not None else tuple()
-        return self.aug_fn(img, *level_args, **self.kwargs)
+        aug_fn = self.np_aug_fn if isinstance(img, np.ndarray) else self.aug_fn
+        return aug_fn(img, *level_args, **self.kwargs)
 
 
 def auto_augment_policy_v0(hparams):
@@ -739,14 +906,15 @@ class AugMixAugment:
             img_aug = img_orig  # no ops are in-place, deep copy not necessary
             for op in ops:
                 img_aug = op(img_aug)
-            img = Image.blend(img, img_aug, w)
+            img = _blend_np(img, img_aug, w) if isinstance(img, np.ndarray) else Image.blend(img, img_aug, w)
         return img
 
     def _apply_basic(self, img, mixing_weights, m):
         # This is a literal adaptation of the paper/official implementation without normalizations and
         # PIL <-> Numpy conversions between every op. It is still quite CPU compute heavy compared to the
         # typical augmentation transforms, could use a GPU / Kornia implementation.
-        img_shape = img.size[0], img.size[1], len(img.getbands())
+        is_array = isinstance(img, np.ndarray)
+        img_shape = img.shape if is_array else (img.size[1], img.size[0], len(img.getbands()))
         mixed = np.zeros(img_shape, dtype=np.float32)
         for mw in mixing_weights:
             depth = self.depth if self.depth > 0 else np.random.randint(1, 4)
@@ -754,8 +922,14 @@ class AugMixAugment:
             img_aug = img  # no ops are in-place, deep copy not necessary
             for op in ops:
                 img_aug = op(img_aug)
-            mixed += mw * np.asarray(img_aug, dtype=np.float32)
+            if is_array:
+                # accumulated in place, without a float copy of every chain
+                cv2.addWeighted(img_aug, float(mw), mixed, 1., 0., dst=mixed, dtype=cv2.CV_32F)
+            else:
+                mixed += mw * np.asarray(img_aug, dtype=np.float32)
         np.clip(mixed, 0, 255., out=mixed)
+        if is_array:
+            return _blend_np(img, mixed.astype(np.uint8), m)
         mixed = Image.fromarray(mixed.astype(np.uint8))
         return Image.blend(img, mixed, m)
 
@@ -0,0 +1,227 @@
+""" DataLoader and batch-size auto-tuner
+
+Runs short probes of the real dataset, transforms and model step and picks the fastest
+(batch_size, num_workers, prefetch_factor, pin_memory) that fits the memory budget. The
+search is in two stages: the batch sizes with the largest worker count, then the loader
+settings at the best batch size. Results are stored in a small JSON file, keyed by entry
+point, model and image size, so later runs and the other scripts reuse them:
+
+    tuned = load_tuned(params["autotune"], key)
+    if tuned is None:
+        tuned = autotune_loader(train_dataset, classifier_train_step(model, optimizer, criterion, device))
+        save_tuned(params["autotune"], key, tuned)
+    params.update(tuned)
+    train_loader = DataLoader(train_dataset, shuffle=True, **loader_kwargs(params))
+
+Peak device memory is measured on CUDA. Host memory is estimated from the size of a
+batch and the number of batches in flight (workers * prefetch_factor, twice when pinned).
+"""
+import itertools
+import json
+import os
+import time
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+LOADER_KEYS = ("batch_size", "num_workers", "prefetch_factor", "pin_memory")
+
+
+def loader_kwargs(config):
+    """ DataLoader keyword arguments of a tuned config (or of the script params). """
+    kwargs = dict(batch_size=config["batch_size"], num_workers=config["num_workers"],
+                  pin_memory=config.get("pin_memory", True))
+    if config["num_workers"] > 0:
+        kwargs["prefetch_factor"] = config.get("prefetch_factor", 2)
+    return kwargs
+
+
+def _images_target(batch):
+    # TrainDataset returns tuples, TestDataset dicts
+    if isinstance(batch, dict):
+        return batch["images"], batch.get("labels")
+    return batch[0], batch[1]
+
+
+def _nbytes(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.nelement()
+    if isinstance(batch, dict):
+        return sum(_nbytes(v) for v in batch.values())
+    if isinstance(batch, (list, tuple)):
+        return sum(_nbytes(v) for v in batch)
+    return 0
+
+
+def classifier_train_step(model, optimizer, criterion, device, normalize=None, channels_last=False,
+                          augment=None, mix=None):
+    """ Forward, backward and optimizer step of a classifier on one batch, under autocast.
+
+    ``augment(images)`` (e.g. a ``BatchAugment``) runs on the device batch before ``normalize``
+    and ``mix(images, target)`` (mixup / fmix) after it, it returns the images and the target
+    passed to ``criterion``, so the probe pays for the same device work as the training loop.
+    """
+    def step(batch):
+        images, target = _images_target(batch)
+        images = images.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        if augment is not None:
+            images = augment(images)
+        if normalize is not None:
+            images = normalize(images)
+        if mix is not None:
+            images, target = mix(images, target)
+        if channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(torch.device(device).type, enabled=torch.device(device).type == 'cuda'):
+            loss = criterion(model(images), target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.train()
+    return step
+
+
+def classifier_pred_step(model, device, normalize=None, tta=None):
+    """ Softmax of a classifier on one batch (or on every TTA view of it, see ``BatchTTA``). """
+    def step(batch):
+        images, _ = _images_target(batch)
+        with torch.no_grad():
+            if tta is not None:
+                tta(model, images.to(device, non_blocking=True))
+                return
+            for image in images if isinstance(images, (list, tuple)) else [images]:
+                image = image.to(device, non_blocking=True)
+                if normalize is not None:
+                    image = normalize(image)
+                torch.softmax(model(image), dim=1)
+    model.eval()
+    return step
+
+
+def _is_oom(e):
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def probe_loader(dataset, step_fn, config, device='cuda', num_batches=8, warmup=2):
+    """ Times ``num_batches`` steps of ``step_fn`` fed by a DataLoader built from ``config``.
+
+    Returns the config with ``samples_per_s``, ``data_wait`` (fraction of the time spent
+    waiting for the loader), ``device_mb``, ``host_mb`` and ``fits`` (False on OOM).
+    """
+    on_cuda = torch.device(device).type == 'cuda' and torch.cuda.is_available()
+    result = dict(config, samples_per_s=0., data_wait=0., device_mb=0., host_mb=0., fits=True)
+    loader = DataLoader(dataset, shuffle=not isinstance(dataset, IterableDataset), drop_last=True,
+                        **loader_kwargs(config))
+    if on_cuda:
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    it = iter(loader)
+    try:
+        wait, start, done = 0., None, 0
+        for i in range(warmup + num_batches):
+            t0 = time.perf_counter()
+            batch = next(it, None)
+            if batch is None:
+                break
+            if i >= warmup:
+                wait += time.perf_counter() - t0
+            if i == 0:
+                in_flight = max(1, config["num_workers"] * config.get("prefetch_factor", 2)) + 1
+                pinned = 2 if config.get("pin_memory", True) else 1
+                result["host_mb"] = _nbytes(batch) * in_flight * pinned / 2**20
+            step_fn(batch)
+            if on_cuda:
+                torch.cuda.synchronize(device)
+            if i + 1 == warmup:
+                start = time.perf_counter()
+            elif i >= warmup:
+                done += 1
+        if start is not None and done > 0:
+            elapsed = time.perf_counter() - start
+            result["samples_per_s"] = done * config["batch_size"] / elapsed
+            result["data_wait"] = wait / elapsed
+    except RuntimeError as e:
+        if not _is_oom(e):
+            raise
+        result["fits"] = False
+    finally:
+        del it
+        if on_cuda:
+            result["device_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+            torch.cuda.empty_cache()
+    return result
+
+
+def autotune_loader(dataset, step_fn, device='cuda', batch_sizes=(8, 16, 32, 64), num_workers=(2, 4, 8),
+                    prefetch_factors=(2, 4), pin_memory=(True, False), memory_budget_mb=None,
+                    host_budget_mb=None, num_batches=8, warmup=2, verbose=True):
+    """ Fastest loader config of ``dataset`` + ``step_fn`` within the memory budgets.
+
+    Args:
+        dataset (Dataset): the real dataset with its transforms
+        step_fn (callable): runs the model on one batch, see ``classifier_train_step``
+        memory_budget_mb (float): device memory budget, 90% of the device if None
+        host_budget_mb (float): budget for the batches in flight on the host, unlimited if None
+
+    Returns the best config (``LOADER_KEYS``) with its probe measurements.
+    """
+    on_cuda = torch.device(device).type == 'cuda' and torch.cuda.is_available()
+    if memory_budget_mb is None and on_cuda:
+        memory_budget_mb = 0.9 * torch.cuda.get_device_properties(device).total_memory / 2**20
+    num_workers = [w for w in num_workers if w <= (os.cpu_count() or 1)] or [min(num_workers)]
+
+    def fits(r):
+        return (r["fits"] and r["samples_per_s"] > 0
+                and (memory_budget_mb is None or r["device_mb"] <= memory_budget_mb)
+                and (host_budget_mb is None or r["host_mb"] <= host_budget_mb))
+
+    def run(config):
+        r = probe_loader(dataset, step_fn, config, device, num_batches, warmup)
+        if verbose:
+            print(f'autotune bs={r["batch_size"]} workers={r["num_workers"]} prefetch={r["prefetch_factor"]} '
+                  f'pin={r["pin_memory"]}: {r["samples_per_s"]:.1f} samples/s, data wait {100 * r["data_wait"]:.0f}%, '
+                  f'device {r["device_mb"]:.0f}MB, host {r["host_mb"]:.0f}MB{"" if fits(r) else " (does not fit)"}')
+        return r
+
+    results = []
+    # stage 1: batch size, stops at the first one over budget
+    for bs in sorted(batch_sizes):
+        r = run(dict(batch_size=bs, num_workers=max(num_workers), prefetch_factor=min(prefetch_factors),
+                     pin_memory=pin_memory[0]))
+        results.append(r)
+        if not fits(r):
+            break
+    fitting = [r for r in results if fits(r)]
+    assert fitting, "No batch size fits the memory budget"
+    best_bs = max(fitting, key=lambda r: r["samples_per_s"])["batch_size"]
+    # stage 2: loader settings at that batch size
+    for w, pf, pin in itertools.product(num_workers, prefetch_factors, pin_memory):
+        if any((r["batch_size"], r["num_workers"], r["prefetch_factor"], r["pin_memory"]) == (best_bs, w, pf, pin)
+               for r in results):
+            continue
+        results.append(run(dict(batch_size=best_bs, num_workers=w, prefetch_factor=pf, pin_memory=pin)))
+    best = max((r for r in results if fits(r)), key=lambda r: r["samples_per_s"])
+    if verbose:
+        print(f'autotune best: bs={best["batch_size"]} workers={best["num_workers"]} '
+              f'prefetch={best["prefetch_factor"]} pin={best["pin_memory"]}, {best["samples_per_s"]:.1f} samples/s')
+    return best
+
+
+def load_tuned(path, key):
+    """ Config stored under ``key`` in the JSON file ``path``, None if there is none. """
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(key)
+
+
+def save_tuned(path, key, config):
+    tuned = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+    tuned[key] = {k: v for k, v in config.items() if k != "fits"}
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(tuned, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
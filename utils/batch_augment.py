@@ -0,0 +1,242 @@
+""" Batched tensor-space version of the training augmentations
+
+The per-image ``train_transform`` (RandomResizedCrop, RandomRotate90 / ShiftScaleRotate,
+flips, IAAAffine, CoarseDropout, MedianBlur, Equalize, GridDistortion) keeps every
+DataLoader worker busy, so throughput is capped by the number of CPU cores.
+``BatchAugment`` applies the same ops to a whole collated NCHW batch on the device of
+the batch, with random parameters drawn per sample:
+
+    * all geometric ops (crop + resize, rot90, shift/scale/rotate, flips, affine, grid
+      distortion) are folded into one sampling grid per sample and one ``grid_sample``,
+    * CoarseDropout holes are built as one boolean mask for the batch,
+    * MedianBlur and Equalize run on the selected samples only, MedianBlur on chunks of them.
+
+The batch holds pixel values in [0, 255] (uint8, or float before normalization) and is
+returned with the same dtype, so it sits between the transfer and ``DeviceNormalize``:
+
+    images = device_normalize(batch_augment(images.to(params["device"])))
+
+GridDistortion is applied with the other geometric ops, i.e. before the dropout
+holes rather than after, which keeps the holes rectangular.
+"""
+import math
+import torch
+import torch.nn.functional as F
+from .decode import sample_resized_crop
+
+
+def _uniform(n, low, high, device):
+    return torch.rand(n, device=device) * (high - low) + low
+
+
+class BatchAugment:
+    """ Per-sample random augmentations of a batch, defaults follow ``train_transform``.
+
+    Args:
+        size (int or tuple): output (height, width) of the random resized crop
+        scale (tuple): RandomResizedCrop area range
+        ratio (tuple): RandomResizedCrop aspect ratio range
+        rot90_p (float): weight of RandomRotate90 in its OneOf (p=1) with ShiftScaleRotate, the
+            picked op is always applied
+        ssr_p (float): weight of ShiftScaleRotate in the same OneOf
+        shift_limit, scale_limit, rotate_limit: ShiftScaleRotate ranges
+        hflip_p, vflip_p (float): flip probabilities
+        affine_p (float): probability of the IAAAffine rotate / shear (degrees)
+        dropout_p (float): CoarseDropout probability
+        max_holes, min_holes (int): number of dropout holes, min_holes defaults to max_holes
+        hole_size (int): side of a dropout hole, defaults to height / 15
+        median_p (float): MedianBlur probability, the kernel is an odd size in [3, blur_limit]
+        median_budget (int): max number of elements of the unfolded neighborhoods computed at once
+        equalize_p (float): per-channel histogram equalization probability
+        grid_p (float): GridDistortion probability
+        num_steps, distort_limit: GridDistortion parameters
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), rot90_p=0.5, ssr_p=0.5,
+                 shift_limit=0.05, scale_limit=0.05, rotate_limit=15, hflip_p=0.5, vflip_p=0.5,
+                 affine_p=0.5, affine_rotate=0.2, affine_shear=0.2, dropout_p=0.5, max_holes=20, min_holes=None,
+                 hole_size=None, median_p=0.5, blur_limit=7, median_budget=2**27, equalize_p=0.2, grid_p=0.2, num_steps=5,
+                 distort_limit=0.3):
+        self.size = (size, size) if isinstance(size, int) else tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.rot90_p = rot90_p
+        self.ssr_p = ssr_p
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.hflip_p = hflip_p
+        self.vflip_p = vflip_p
+        self.affine_p = affine_p
+        self.affine_rotate = affine_rotate
+        self.affine_shear = affine_shear
+        self.dropout_p = dropout_p
+        self.max_holes = max_holes
+        self.min_holes = max_holes if min_holes is None else min_holes
+        self.hole_size = hole_size or int(self.size[0] / 15)
+        self.median_p = median_p
+        self.blur_limit = blur_limit
+        self.median_budget = median_budget
+        self.equalize_p = equalize_p
+        self.grid_p = grid_p
+        self.num_steps = num_steps
+        self.distort_limit = distort_limit
+
+    def __call__(self, images):
+        dtype = images.dtype
+        x = images.float()
+        x = self.geometric(x)
+        x = self.coarse_dropout(x)
+        x = self.median_blur(x)
+        x = self.equalize(x)
+        if dtype == torch.uint8:
+            return x.round_().clamp_(0, 255).to(torch.uint8)
+        return x.to(dtype)
+
+    # geometry ---------------------------------------------------------------------------
+    def _crop_matrix(self, n, in_h, in_w, device):
+        """ Output -> input normalized coordinates of the random resized crops. """
+        boxes = torch.tensor([sample_resized_crop(in_h, in_w, self.scale, self.ratio) for _ in range(n)],
+                             dtype=torch.float32, device=device)
+        y, x, ch, cw = boxes.unbind(1)
+        m = torch.zeros(n, 3, 3, device=device)
+        m[:, 0, 0] = cw / in_w
+        m[:, 0, 2] = (2 * x + cw) / in_w - 1
+        m[:, 1, 1] = ch / in_h
+        m[:, 1, 2] = (2 * y + ch) / in_h - 1
+        m[:, 2, 2] = 1
+        return m
+
+    def _pixel_affine(self, angle, scale, shear, tx, ty):
+        """ Sampling matrices of rotations / shears defined in pixel space, in normalized coordinates. """
+        n, device = len(angle), angle.device
+        h, w = self.size
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        m = torch.zeros(n, 3, 3, device=device)
+        # inverse of a rotation + scale combined with a shear, in pixel units centered on the image
+        m[:, 0, 0] = cos / scale
+        m[:, 0, 1] = (-sin + cos * torch.tan(shear)) / scale
+        m[:, 1, 0] = sin / scale
+        m[:, 1, 1] = (cos + sin * torch.tan(shear)) / scale
+        m[:, 2, 2] = 1
+        to_pixel = torch.diag(torch.tensor([w / 2., h / 2., 1.], device=device))
+        to_norm = torch.diag(torch.tensor([2. / w, 2. / h, 1.], device=device))
+        m = to_norm @ m @ to_pixel
+        # shifts are a fraction of the image size, i.e. twice that in normalized units
+        shift = torch.stack([tx, ty], dim=1)[..., None] * 2
+        m[:, :2, 2:] = -m[:, :2, :2] @ shift
+        return m
+
+    def _view_matrix(self, n, device):
+        """ rot90 / ShiftScaleRotate (one of), flips and the small affine, composed. """
+        eye = torch.eye(3, device=device).repeat(n, 1, 1)
+        # OneOf picks by the normalized weights and applies the picked op with force_apply
+        pick_rot90 = torch.rand(n, device=device) < self.rot90_p / (self.rot90_p + self.ssr_p)
+        # RandomRotate90, out(x, y) = in(-y, x) for every quarter turn
+        k = torch.randint(0, 4, (n,), device=device)
+        k = torch.where(pick_rot90, k, torch.zeros_like(k))
+        angle = k.float() * (math.pi / 2)
+        rot90 = eye.clone()
+        rot90[:, 0, 0], rot90[:, 0, 1] = torch.cos(angle).round(), -torch.sin(angle).round()
+        rot90[:, 1, 0], rot90[:, 1, 1] = torch.sin(angle).round(), torch.cos(angle).round()
+
+        use_ssr = ~pick_rot90
+        zero = torch.zeros(n, device=device)
+        ssr = self._pixel_affine(
+            torch.where(use_ssr, _uniform(n, -self.rotate_limit, self.rotate_limit, device) * math.pi / 180, zero),
+            torch.where(use_ssr, 1 + _uniform(n, -self.scale_limit, self.scale_limit, device), zero + 1),
+            zero,
+            torch.where(use_ssr, _uniform(n, -self.shift_limit, self.shift_limit, device), zero),
+            torch.where(use_ssr, _uniform(n, -self.shift_limit, self.shift_limit, device), zero))
+
+        flip = eye.clone()
+        flip[:, 0, 0] = torch.where(torch.rand(n, device=device) < self.hflip_p, -1., 1.)
+        flip[:, 1, 1] = torch.where(torch.rand(n, device=device) < self.vflip_p, -1., 1.)
+
+        use_affine = torch.rand(n, device=device) < self.affine_p
+        affine = self._pixel_affine(
+            torch.where(use_affine, _uniform(n, -self.affine_rotate, self.affine_rotate, device) * math.pi / 180, zero),
+            zero + 1,
+            torch.where(use_affine, _uniform(n, -self.affine_shear, self.affine_shear, device) * math.pi / 180, zero),
+            zero, zero)
+        # sampling matrices compose in the order the ops are applied
+        return rot90 @ ssr @ flip @ affine
+
+    def _axis_warp(self, n, length, device):
+        """ GridDistortion of one axis: piecewise linear warp with random step sizes. """
+        centers = (torch.arange(length, device=device, dtype=torch.float32) * 2 + 1) / length - 1
+        centers = centers.expand(n, length)
+        use = torch.rand(n, 1, device=device) < self.grid_p
+        steps = 1 + _uniform(n * self.num_steps, -self.distort_limit, self.distort_limit, device)
+        steps = torch.where(use, steps.view(n, self.num_steps), torch.ones(n, self.num_steps, device=device))
+        knots = torch.cat([torch.zeros(n, 1, device=device), steps.cumsum(1)], dim=1)
+        knots = knots / knots[:, -1:] * 2 - 1
+        pos = (centers + 1) / 2 * self.num_steps
+        idx = pos.floor().clamp(0, self.num_steps - 1).long()
+        frac = pos - idx.float()
+        return knots.gather(1, idx) * (1 - frac) + knots.gather(1, idx + 1) * frac
+
+    def geometric(self, x):
+        n, _, in_h, in_w = x.shape
+        h, w = self.size
+        m = self._crop_matrix(n, in_h, in_w, x.device) @ self._view_matrix(n, x.device)
+        gx = self._axis_warp(n, w, x.device)[:, None, :].expand(n, h, w)
+        gy = self._axis_warp(n, h, x.device)[:, :, None].expand(n, h, w)
+        grid = torch.stack([gx, gy, torch.ones_like(gx)], dim=-1) @ m[:, :2, :].transpose(1, 2)[:, None]
+        return F.grid_sample(x, grid.view(n, h, w, 2), mode='bilinear', padding_mode='reflection',
+                             align_corners=False)
+
+    # pixel ops --------------------------------------------------------------------------
+    def coarse_dropout(self, x):
+        n, _, h, w = x.shape
+        k, size, device = self.max_holes, self.hole_size, x.device
+        if self.dropout_p <= 0 or k == 0:
+            return x
+        use = torch.rand(n, 1, device=device) < self.dropout_p
+        num_holes = torch.randint(self.min_holes, self.max_holes + 1, (n, 1), device=device)
+        active = use & (torch.arange(k, device=device)[None] < num_holes)
+        y1 = torch.randint(0, h - size + 1, (n, k, 1), device=device)
+        x1 = torch.randint(0, w - size + 1, (n, k, 1), device=device)
+        rows = torch.arange(h, device=device)[None, None]
+        cols = torch.arange(w, device=device)[None, None]
+        rows = ((rows >= y1) & (rows < y1 + size) & active[..., None]).float()
+        cols = ((cols >= x1) & (cols < x1 + size)).float()
+        mask = torch.bmm(rows.transpose(1, 2), cols) > 0
+        return x.masked_fill(mask[:, None], 0.)
+
+    def median_blur(self, x):
+        if self.median_p <= 0:
+            return x
+        n = len(x)
+        use = torch.rand(n, device=x.device) < self.median_p
+        ksizes = torch.randint(0, (self.blur_limit - 3) // 2 + 1, (n,), device=x.device) * 2 + 3
+        x = x.clone()
+        for ksize in ksizes[use].unique().tolist():
+            pad = ksize // 2
+            # the unfolded k*k neighborhoods are large, the samples go by chunks of median_budget elements
+            step = max(1, self.median_budget // (x[0].numel() * ksize * ksize))
+            for chunk in torch.nonzero(use & (ksizes == ksize))[:, 0].split(step):
+                patch = F.pad(x[chunk], (pad, pad, pad, pad), mode='replicate')
+                patch = patch.unfold(2, ksize, 1).unfold(3, ksize, 1)
+                x[chunk] = patch.reshape(*patch.shape[:4], -1).median(dim=-1).values
+        return x
+
+    def equalize(self, x):
+        """ cv2.equalizeHist on every channel of the selected samples. """
+        if self.equalize_p <= 0:
+            return x
+        use = torch.rand(len(x), device=x.device) < self.equalize_p
+        if not use.any():
+            return x
+        sel = x[use]
+        n, c, h, w = sel.shape
+        values = sel.round().clamp(0, 255).long().view(n * c, -1)
+        hist = torch.zeros(n * c, 256, device=x.device).scatter_add_(1, values, torch.ones_like(values, dtype=torch.float))
+        cdf = hist.cumsum(1)
+        cdf_min = cdf.masked_fill(cdf == 0, float(h * w)).min(dim=1, keepdim=True).values
+        lut = ((cdf - cdf_min).clamp(min=0) * 255 / (h * w - cdf_min).clamp(min=1)).round()
+        # constant channels are left unchanged
+        identity = torch.arange(256, device=x.device, dtype=torch.float).expand_as(lut)
+        lut = torch.where(cdf_min == h * w, identity, lut)
+        x = x.clone()
+        x[use] = lut.gather(1, values).view(n, c, h, w)
+        return x
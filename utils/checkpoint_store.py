@@ -0,0 +1,107 @@
+""" Inference-only checkpoint store
+
+Training checkpoints bundle the DataParallel ``module.`` weights with the optimizer (and
+amp) state and the last loss. ``export_weights`` keeps only the model weights, with the
+prefix removed and optionally in fp16, plus the metadata the inference code needs:
+
+    {'meta': {'format', 'arch', 'fold', 'accuracy', 'image_size', 'dtype', 'source'},
+     'state_dict': {name: tensor}}
+
+``read_weights`` memory-maps exported files and training checkpoints alike, so loading
+reads only the pages of the weights, and ``init_empty`` builds the model on the meta
+device and assigns the loaded tensors, skipping the random init they would overwrite:
+
+    members = export_ensemble([(arch, ckpt, 512) for ckpt in WEIGHTS], 'weights/export', half=True)
+    state_dict, meta = read_weights(members[0][1])
+"""
+import os
+import re
+import itertools
+import torch
+
+FORMAT = 'cassava-weights-1'
+
+
+def torch_load(path, map_location='cpu', mmap=True):
+    """ ``torch.load`` memory-mapped when the torch version and the file format allow it. """
+    if mmap:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except (TypeError, RuntimeError):
+            # torch < 2.1 has no mmap, legacy (non zip) files cannot be mapped
+            pass
+    return torch.load(path, map_location=map_location)
+
+
+def _strip_prefix(state_dict):
+    return {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+
+
+def _parse_fold(checkpoint):
+    match = re.search(r'fold(\d+)', os.path.basename(checkpoint))
+    return int(match.group(1)) if match else None
+
+
+def read_weights(checkpoint, map_location='cpu', mmap=True):
+    """ (state_dict, meta) of an exported file or of a training checkpoint. """
+    state = torch_load(checkpoint, map_location, mmap)
+    if isinstance(state, dict) and state.get('meta', {}).get('format') == FORMAT:
+        return state['state_dict'], state['meta']
+    accuracy = state.get('preds') if isinstance(state, dict) else None
+    meta = dict(format=None, arch=None, fold=_parse_fold(checkpoint), image_size=None, dtype=None,
+                accuracy=None if accuracy is None else float(accuracy), source=os.path.basename(checkpoint))
+    return _strip_prefix(state.get('model', state)), meta
+
+
+def export_weights(checkpoint, out_path, arch, image_size=None, fold=None, half=False):
+    """ Writes the weight-only file of a training checkpoint at ``out_path``, returns its metadata. """
+    state_dict, meta = read_weights(checkpoint, mmap=False)
+    state_dict = {k: (v.half() if half and v.is_floating_point() else v).contiguous() for k, v in state_dict.items()}
+    meta.update(format=FORMAT, arch=arch, image_size=image_size, dtype='float16' if half else 'float32',
+                fold=meta['fold'] if fold is None else fold)
+    dirname = os.path.dirname(out_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = f'{out_path}.tmp'
+    torch.save({'meta': meta, 'state_dict': state_dict}, tmp)
+    os.replace(tmp, out_path)
+    return meta
+
+
+def export_ensemble(members, out_dir, half=False, overwrite=False):
+    """ Exports the checkpoints of ``(arch, checkpoint, image_size)`` members into ``out_dir/arch/``.
+
+    Files that are newer than their checkpoint are kept. Returns the members with the
+    exported paths.
+    """
+    exported = []
+    for arch, checkpoint, image_size in members:
+        out_path = os.path.join(out_dir, arch, os.path.basename(checkpoint))
+        if (overwrite or not os.path.exists(out_path)
+                or os.path.getmtime(out_path) < os.path.getmtime(checkpoint)):
+            export_weights(checkpoint, out_path, arch, image_size, half=half)
+        exported.append((arch, out_path, image_size))
+    return exported
+
+
+def read_meta(checkpoint):
+    return read_weights(checkpoint)[1]
+
+
+def init_empty(create_fn, state_dict):
+    """ ``create_fn()`` with the weights of ``state_dict``, built without initializing them.
+
+    Falls back to a regular build on torch versions without meta-device construction
+    and for models that have buffers outside of their state dict.
+    """
+    try:
+        with torch.device('meta'):
+            model = create_fn()
+        model.load_state_dict(state_dict, assign=True)
+        if not any(t.is_meta for t in itertools.chain(model.parameters(), model.buffers())):
+            return model
+    except (AttributeError, TypeError, RuntimeError, NotImplementedError):
+        pass
+    model = create_fn()
+    model.load_state_dict(state_dict)
+    return model
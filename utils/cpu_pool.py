@@ -0,0 +1,99 @@
+""" Multi-process CPU inference with shared model weights
+
+One PyTorch process saturates only a few cores on a CPU box: the convolutions scale
+poorly past a handful of threads and the JPEG decode runs on the same cores. Here the
+members of an ``InferenceEngine`` are moved to shared memory once in the main process,
+every worker process maps the same weights (no per-process copy), pins itself to its own
+block of ``num_threads`` cores, decodes and predicts shards of the dataset, and the
+shards are gathered back in dataset order:
+
+    engine = InferenceEngine(members, device="cpu", views=("identity", "hflip"))
+    logits, labels, image_ids = cpu_pool_predict(engine, dataset, num_processes=8, num_threads=4)
+
+The output matches ``engine.predict`` on a loader of ``dataset``.
+"""
+import os
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+# engine, dataset and batch size of the worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(engine, dataset, batch_size, num_threads, pin_cores):
+    rank = mp.current_process()._identity[0] - 1 if mp.current_process()._identity else 0
+    if pin_cores and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[(rank * num_threads + t) % len(cores)] for t in range(num_threads)})
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # already set, forked workers inherit the setting of the main process
+        pass
+    _worker.update(engine=engine, dataset=dataset, batch_size=batch_size)
+
+
+def _predict_shard(shard):
+    shard_id, indices = shard
+    loader = DataLoader(Subset(_worker["dataset"], indices), batch_size=_worker["batch_size"], shuffle=False)
+    logits, labels, image_ids = [], [], []
+    for data in loader:
+        logits.append(_worker["engine"](data["images"]))
+        labels.append(torch.as_tensor(data["labels"]))
+        image_ids.extend(data["image_ids"])
+    return shard_id, torch.cat(logits, dim=2).numpy(), torch.cat(labels).numpy(), image_ids
+
+
+def default_processes(num_threads=4):
+    """ Number of processes of ``num_threads`` threads that fill the cores of this process. """
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    return max(1, cores // num_threads)
+
+
+def iter_cpu_pool(engine, dataset, num_processes=None, num_threads=4, batch_size=16, shard_size=None,
+                  pin_cores=True, start_method='spawn', desc="CPU inference"):
+    """ Yields the (models, views, n, classes) logits, labels and image ids of the shards, in order.
+
+    Args:
+        engine (InferenceEngine): CPU engine, its weights are shared by all the processes
+        dataset (Dataset): TestDataset returning single images
+        num_processes (int): worker processes, as many as fit the cores if None
+        num_threads (int): intra-op threads (and pinned cores) of every process
+        batch_size (int): batch size of every process
+        shard_size (int): images per task, about 4 tasks per process if None
+        pin_cores (bool): pins every process to its own block of cores
+        start_method (str): multiprocessing start method, "spawn" or "fork"
+    """
+    assert engine.device.type == 'cpu', "cpu_pool_predict needs an engine on the CPU"
+    num_processes = num_processes or default_processes(num_threads)
+    num_samples = len(dataset)
+    if shard_size is None:
+        shard_size = max(batch_size, -(-num_samples // (4 * num_processes)))
+    shards = [(i, list(range(start, min(start + shard_size, num_samples))))
+              for i, start in enumerate(range(0, num_samples, shard_size))]
+    engine.eval().share_memory()
+    ctx = mp.get_context(start_method)
+    with ctx.Pool(num_processes, initializer=_init_worker,
+                  initargs=(engine, dataset, batch_size, num_threads, pin_cores)) as pool:
+        # imap returns the shards in order, while later shards are still running
+        for _, logits, labels, image_ids in tqdm(pool.imap(_predict_shard, shards), total=len(shards), desc=desc):
+            yield torch.from_numpy(logits), torch.from_numpy(labels), image_ids
+
+
+def cpu_pool_predict(engine, dataset, **kwargs):
+    """ ``engine.predict`` of ``dataset`` sharded over a pool of CPU processes, see ``iter_cpu_pool``.
+
+    Returns (models, views, N, classes) logits, labels and image ids in dataset order.
+    """
+    logits, labels, image_ids = [], [], []
+    for shard_logits, shard_labels, shard_ids in iter_cpu_pool(engine, dataset, **kwargs):
+        logits.append(shard_logits)
+        labels.append(shard_labels)
+        image_ids.extend(shard_ids)
+    if not logits:
+        return (torch.zeros(len(engine.models), engine.num_views, 0, engine.num_classes),
+                torch.zeros(0, dtype=torch.long), [])
+    return torch.cat(logits, dim=2), torch.cat(labels), image_ids
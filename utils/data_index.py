@@ -0,0 +1,67 @@
+""" Compact dataset index
+
+``TrainDataset`` and ``TestDataset`` used to keep the fold DataFrame and were pickled
+with it into every DataLoader worker of every fold. ``DataIndex`` keeps only what the
+datasets read per item, in a few flat numpy arrays:
+
+    names       unique file names (fixed width unicode, pickled as one buffer)
+    file_ids    int32 position of every item in ``names``
+    sources     int8 position of every item in ``roots``
+    labels      int8 label, -1 for unlabeled test images
+    soft_labels float32 (N, num_classes) distillation targets or None
+
+Items come from the ``source`` column of the frame (e.g. a manifest) or from the
+``source`` argument, each source has one image folder in ``roots``.
+"""
+import os
+import numpy as np
+
+
+def default_roots(root):
+    """ Image folder of every source used by the scripts. """
+    return {'train': f'{root}/train_images', 'external': f'{root}/train_images',
+            'pseudo': f'{root}/train_images', 'test': f'{root}/test_images'}
+
+
+class DataIndex:
+    """ File names, image folders, labels and soft labels of the dataset items.
+
+    Args:
+        df (DataFrame): ``image_id`` and optional ``label`` / ``source`` columns
+        roots (dict): source name -> image folder, see ``default_roots``
+        source (str): source of the rows when ``df`` has no ``source`` column
+        soft_labels (SoftLabelStore): distillation targets, gathered once into memory
+    """
+    __slots__ = ('roots', 'names', 'file_ids', 'sources', 'labels', 'soft_labels')
+
+    def __init__(self, df, roots, source='train', soft_labels=None):
+        source_names = list(roots)
+        self.roots = tuple(roots[s] for s in source_names)
+        self.names, file_ids = np.unique(df['image_id'].values.astype(str), return_inverse=True)
+        self.file_ids = file_ids.astype(np.int32)
+        if 'source' in df:
+            codes = {s: i for i, s in enumerate(source_names)}
+            self.sources = np.array([codes[s] for s in df['source'].values], dtype=np.int8)
+        else:
+            self.sources = np.full(len(df), source_names.index(source), dtype=np.int8)
+        if 'label' in df:
+            self.labels = df['label'].values.astype(np.int8)
+        else:
+            self.labels = np.full(len(df), -1, dtype=np.int8)
+        self.soft_labels = None
+        if soft_labels is not None:
+            rows = soft_labels.rows(self.names[self.file_ids])
+            self.soft_labels = np.zeros((len(rows), soft_labels.num_classes), dtype=np.float32)
+            self.soft_labels[rows >= 0] = soft_labels.data[rows[rows >= 0]]
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def name(self, idx):
+        return self.names[self.file_ids[idx]]
+
+    def path(self, idx):
+        return os.path.join(self.roots[self.sources[idx]], self.names[self.file_ids[idx]])
+
+    def label(self, idx):
+        return int(self.labels[idx])
@@ -1,33 +1,19 @@
-from collections import defaultdict
-import copy
-import random
-import numpy as np
-import os
-import shutil
-from urllib.request import urlretrieve
+from collections import OrderedDict
 import pandas as pd
-import albumentations as A
-from albumentations.pytorch import ToTensorV2
 import cv2
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 import torch
-import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as transforms
-from sklearn.model_selection import StratifiedKFold
-from sklearn.metrics import accuracy_score
-from sklearn.utils import resample
-from torch.utils.data import Dataset, DataLoader
-import torchvision.transforms as T
-from utils import Mixup, RandAugment, AsymmetricLossSingleLabel, SCELoss, LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
-from PIL import Image
+from torch.utils.data import Dataset
+from .auto_augment import RandAugment
+from .decode import ImageDecoder
+from .transform_cache import TransformCache, is_deterministic
+from .data_index import DataIndex, default_roots
 
 def merge_data(df1, df2):
     merge_df = pd.concat([df1, df2], axis=0) #,how ='outer', on ='image_id')
     return merge_df
 
 def balance_data(df, mode="undersampling", val=False):
+    from sklearn.utils import resample
     class_0 = df[df.label==0]
     class_1 = df[df.label==1]
     class_2 = df[df.label==2]
@@ -73,93 +59,114 @@ def balance_data(df, mode="undersampling", val=False):
 
 # Dataset
 class TrainDataset(Dataset):
-    def __init__(self, df, root, transform=None, mosaic_mix = False, soft_df = None):
-        self.df = df
-        self.file_names = df['image_id'].values
-        self.labels = df['label'].values
+    def __init__(self, df, root, transform=None, mosaic_mix = False, soft_labels=None, image_store=None, fast_decode=False,
+                 cache_mb=0, rand_aug=False, repeat_views=1, max_pending_views=64):
+        # df may also be a prebuilt DataIndex shared by several datasets
+        self.index = df if isinstance(df, DataIndex) else DataIndex(df, default_roots(root), soft_labels=soft_labels)
+        # deterministic pipelines keep their uint8 output in shared memory across epochs
+        self.cache = None
+        if cache_mb > 0 and is_deterministic(transform):
+            self.cache = TransformCache(transform, len(self.index), budget_mb=cache_mb)
+            transform = self.cache.prefix
         self.transform = transform
+        # the decoder takes over the leading crop/resize of the transform, except with repeated
+        # views: the decoded image is shared by the views and each of them needs its own crop
+        self.decoder = None
+        if fast_decode and image_store is None:
+            if repeat_views > 1:
+                self.decoder = ImageDecoder(None)
+            else:
+                self.decoder = ImageDecoder(transform)
+                self.transform = self.decoder.transform
         self.mosaic_mix = mosaic_mix
-        self.rand_aug_fn = None #RandAugment()
-        self.distill_soft_target = soft_df 
+        # RandAugment on the decoded uint8 array, before the albumentations pipeline
+        self.rand_aug_fn = RandAugment() if rand_aug else None
         self.root = root
+        self.image_store = image_store
+        # with a RepeatedViewSampler every decoded image is kept until its repeat_views views
+        # are drawn, per worker process and bounded by max_pending_views images
+        self.repeat_views = repeat_views
+        self.max_pending_views = max_pending_views
+        self.pending_views = OrderedDict()
         
     def __len__(self):
-        return len(self.df)
+        return len(self.index)
+
+    def load_view(self, idx):
+        if self.repeat_views <= 1:
+            return self.load_image(idx)
+        entry = self.pending_views.get(idx)
+        if entry is None:
+            entry = self.pending_views[idx] = [self.load_image(idx), 0]
+            if len(self.pending_views) > self.max_pending_views:
+                self.pending_views.popitem(last=False)
+        entry[1] += 1
+        if entry[1] >= self.repeat_views:
+            del self.pending_views[idx]
+        return entry[0]
+
+    def load_image(self, idx):
+        if self.image_store is not None:
+            return self.image_store[self.index.name(idx)]
+        if self.decoder is not None:
+            return self.decoder(self.index.path(idx))
+        image = cv2.imread(self.index.path(idx))
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
     def __getitem__(self, idx):
-        file_name = self.file_names[idx]
-        file_path = f'{self.root}/train_images/{file_name}'
-        image = cv2.imread(file_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        label = torch.tensor(self.labels[idx]).long()
-        if self.rand_aug_fn is not None:
-            image = np.array(self.rand_aug_fn(Image.fromarray(image)))
-        if self.transform:
-            augmented = self.transform(image=image)
-            image = augmented['image']
-        if self.distill_soft_target is not None:
-            try:
-                soft_label = [float(t) for t in soft_target_distill[idx][0].split(" ")]
-                soft_label = torch.tensor(soft_label)
-            except:
-                soft_label = torch.tensor([0., 0., 0., 0., 0.])
+        file_name = self.index.name(idx)
+        label = torch.tensor(self.index.label(idx)).long()
+        image = self.cache.get(idx) if self.cache is not None and self.rand_aug_fn is None else None
+        if image is None:
+            image = self.load_view(idx)
+            if self.rand_aug_fn is not None:
+                image = self.rand_aug_fn(image)
+            if self.transform:
+                augmented = self.transform(image=image)
+                image = augmented['image']
+            if self.cache is not None and self.rand_aug_fn is None:
+                self.cache.put(idx, image)
+        if self.cache is not None:
+            image = self.cache.suffix(image=image)['image']
+        if self.index.soft_labels is not None:
+            soft_label = torch.from_numpy(self.index.soft_labels[idx].copy())
         else:
             soft_label = 0.
         return image, label, soft_label, file_name
     
 
 class TestDataset(Dataset):
-    def __init__(self, df, root, transform=None, valid_test=False, fcrops=False):
-        self.df = df
+    def __init__(self, df, root, transform=None, valid_test=False, image_store=None, fast_decode=False):
+        # validation images are read from train_images, test images from test_images
+        self.index = df if isinstance(df, DataIndex) else DataIndex(df, default_roots(root),
+                                                                    source='train' if valid_test else 'test')
         self.root = root
-        self.file_names = df['image_id'].values
+        self.image_store = image_store
         self.transform = transform
+        self.decoder = None
+        if fast_decode and image_store is None:
+            self.decoder = ImageDecoder(transform)
+            self.transform = self.decoder.transform
         self.valid_test = valid_test
-        self.fcrops = fcrops
-        if self.valid_test:
-            self.labels = df['label'].values  
-        else:
+        if not self.valid_test:
             assert ValueError("Test data does not have annotation, plz check!")
         
     def __len__(self):
-        return len(self.df)
+        return len(self.index)
 
     def __getitem__(self, idx):
-        file_name = self.file_names[idx]
-        if self.valid_test:
-            file_path = f'{self.root}/train_images/{file_name}'
-            #file_path = f'{self.root}/external/extraimages/{file_name}'
+        file_name = self.index.name(idx)
+        if self.image_store is not None:
+            image = self.image_store[file_name]
         else:
-            file_path = f'{self.root}/test_images/{file_name}'
-        image = cv2.imread(file_path)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        if isinstance(self.transform, list):
-            outputs = {'images':[],
-                       'labels':[],
-                       'image_ids':[]}
-            if self.fcrops:
-                for trans in self.transform:
-                    image_aug = transforms.ToPILImage()(image)
-                    image_aug = trans(image_aug)
-                    outputs["images"].append(image_aug)
-                    del image_aug
+            file_path = self.index.path(idx)
+            if self.decoder is not None:
+                image = self.decoder(file_path)
             else:
-                for trans in self.transform:
-                    augmented = trans(image=image)
-                    image_aug = augmented['image']
-                    outputs["images"].append(image_aug)
-                    del image_aug
-
-            if self.valid_test:
-                label = torch.tensor(self.labels[idx]).long()
-                outputs['labels'] = len(self.transform)*[label]
-                outputs['image_ids'].append(file_name)
-                
-            else:
-                outputs['labels'] = len(self.transform)*[-1]
-                
-            return outputs
-        else:
-            augmented = self.transform(image=image)
-            image = augmented['image'] 
-        return image
+                image = cv2.imread(file_path)
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        # one decoded, resized image per sample, the TTA views are made on the device (utils/tta.py)
+        augmented = self.transform(image=image)
+        image = augmented['image']
+        label = torch.tensor(self.index.label(idx)).long() if self.valid_test else -1
+        return dict(images=image, labels=label, image_ids=file_name)
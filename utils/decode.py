@@ -0,0 +1,264 @@
+""" Reduced-resolution and region-of-interest JPEG decoding
+
+Most of the decoded pixels are thrown away by the first transform of every pipeline
+(RandomResizedCrop, CenterCrop + Resize, Resize). ``ImageDecoder`` takes that leading
+op out of the albumentations pipeline and performs it at decode time:
+
+    * the crop window is chosen from the JPEG header before any pixel is decoded,
+    * only the crop window is decoded when libjpeg-turbo is available (lossless crop),
+    * the JPEG DCT scaling (1/2, 1/4) is used whenever the scaled window is still at
+      least as large as the output of the resize,
+    * the decoder writes RGB directly, there is no BGR->RGB swap afterwards.
+
+Backends, fastest first: ``turbojpeg`` (PyTurboJPEG, optional), ``pil`` (draft mode),
+``cv2`` (IMREAD_REDUCED_COLOR_*). Use ``measure_decode_tolerance`` to check how far the
+outputs drift from the full-resolution reference before switching a run over.
+"""
+import io
+import math
+import random
+import struct
+import numpy as np
+import cv2
+import albumentations as A
+from PIL import Image
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+except ImportError:
+    TurboJPEG = None
+
+_SCALES = (4, 2, 1)
+_MCU = 16  # largest iMCU size, lossless crops must start on a multiple of it
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_size_from_stream(f):
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("Not a JPEG stream")
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            raise ValueError("No SOF marker found")
+        marker = byte[0]
+        if marker in _SOF_MARKERS:
+            f.read(3)  # segment length + sample precision
+            h, w = struct.unpack('>HH', f.read(4))
+            return h, w
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue  # markers without payload
+        length = struct.unpack('>H', f.read(2))[0]
+        f.seek(length - 2, 1)
+
+
+def read_jpeg_size(src):
+    """ Returns (height, width) of a file path or encoded bytes by parsing the header only.
+
+    Falls back to PIL for non JPEG files.
+    """
+    try:
+        if isinstance(src, bytes):
+            return _jpeg_size_from_stream(io.BytesIO(src))
+        with open(src, 'rb') as f:
+            return _jpeg_size_from_stream(f)
+    except (ValueError, struct.error):
+        with Image.open(io.BytesIO(src) if isinstance(src, bytes) else src) as img:
+            return img.size[1], img.size[0]
+
+
+def default_backend():
+    if TurboJPEG is not None:
+        try:
+            TurboJPEG()
+            return 'turbojpeg'
+        except (OSError, RuntimeError):
+            pass
+    return 'pil'
+
+
+def choose_scale(window_hw, out_hw, max_scale=4):
+    """ Largest DCT scale denominator that keeps the scaled window at least ``out_hw``. """
+    if out_hw is None:
+        return 1
+    for s in _SCALES:
+        if s <= max_scale and window_hw[0] / s >= out_hw[0] and window_hw[1] / s >= out_hw[1]:
+            return s
+    return 1
+
+
+def sample_resized_crop(h, w, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.)):
+    """ Same sampling as ``A.RandomResizedCrop`` but from the image size only, returns (y, x, ch, cw). """
+    area = h * w
+    for _attempt in range(10):
+        target_area = random.uniform(*scale) * area
+        log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        aspect_ratio = math.exp(random.uniform(*log_ratio))
+        cw = int(round(math.sqrt(target_area * aspect_ratio)))
+        ch = int(round(math.sqrt(target_area / aspect_ratio)))
+        if 0 < cw <= w and 0 < ch <= h:
+            return random.randint(0, h - ch), random.randint(0, w - cw), ch, cw
+    # Fallback to central crop
+    in_ratio = w / h
+    if in_ratio < min(ratio):
+        cw, ch = w, int(round(w / min(ratio)))
+    elif in_ratio > max(ratio):
+        ch, cw = h, int(round(h * max(ratio)))
+    else:
+        ch, cw = h, w
+    return (h - ch) // 2, (w - cw) // 2, ch, cw
+
+
+class _Backend:
+    """ Decodes the window (y, x, h, w) of a file at 1/scale resolution into RGB uint8. """
+    def __init__(self, name):
+        self.name = name
+        self._jpeg = None
+
+    def __getstate__(self):
+        return dict(name=self.name, _jpeg=None)
+
+    def size(self, file_path):
+        return read_jpeg_size(file_path)
+
+    def decode(self, file_path, window, scale=1, full_hw=None):
+        y, x, h, w = window
+        if self.name == 'turbojpeg':
+            if self._jpeg is None:
+                self._jpeg = TurboJPEG()
+            with open(file_path, 'rb') as f:
+                buf = f.read()
+            y0, x0 = y // _MCU * _MCU, x // _MCU * _MCU
+            if full_hw is None:
+                full_hw = _jpeg_size_from_stream(io.BytesIO(buf))
+            if (y0, x0, y + h, x + w) != (0, 0) + tuple(full_hw):
+                buf = self._jpeg.crop(buf, x0, y0, x + w - x0, y + h - y0)
+            image = self._jpeg.decode(buf, pixel_format=TJPF_RGB, scaling_factor=(1, scale))
+            region_h, region_w = y + h - y0, x + w - x0
+        elif self.name == 'pil':
+            with Image.open(file_path) as img:
+                region_w, region_h = img.size
+                img.draft('RGB', (int(math.ceil(region_w / scale)), int(math.ceil(region_h / scale))))
+                image = np.asarray(img.convert('RGB'))
+            y0, x0 = 0, 0
+        else:
+            flag = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4}[scale]
+            image = cv2.imread(file_path, flag)
+            region_h, region_w = full_hw if full_hw is not None else read_jpeg_size(file_path)
+            y0, x0 = 0, 0
+        # the scale actually applied, draft() only reduces JPEG files and rounds the sizes
+        scale_y, scale_x = region_h / image.shape[0], region_w / image.shape[1]
+        ys, xs = int(round((y - y0) / scale_y)), int(round((x - x0) / scale_x))
+        hs, ws = max(1, int(round(h / scale_y))), max(1, int(round(w / scale_x)))
+        image = image[ys:ys + hs, xs:xs + ws]
+        if self.name == 'cv2':
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image
+
+
+def _split_leading(transform):
+    """ Splits an A.Compose into (leading crop/resize ops, remaining A.Compose). """
+    if not isinstance(transform, A.Compose):
+        return None, transform
+    ops = list(transform.transforms)
+    if len(ops) == 0 or not (ops[0].always_apply or ops[0].p == 1):
+        return None, transform
+    if isinstance(ops[0], A.RandomResizedCrop):
+        n = 1
+    elif isinstance(ops[0], A.CenterCrop):
+        n = 2 if len(ops) > 1 and isinstance(ops[1], A.Resize) and (ops[1].always_apply or ops[1].p == 1) else 1
+    elif isinstance(ops[0], A.Resize):
+        n = 1
+    else:
+        return None, transform
+    return ops[:n], A.Compose(ops[n:], p=transform.p)
+
+
+class ImageDecoder:
+    """ Decoder that fuses the leading crop/resize of ``transform`` into the JPEG decode.
+
+    Args:
+        transform (A.Compose or list): pipeline (or TTA list) the decoded image is fed to. The
+            leading op is only fused for a list when every pipeline starts with the same op.
+        backend (str): 'turbojpeg', 'pil' or 'cv2', defaults to the fastest one available
+        max_scale (int): largest DCT scale denominator to use (1, 2 or 4)
+
+    ``decoder.transform`` holds what is left of ``transform`` and must be applied afterwards.
+    """
+    def __init__(self, transform=None, backend=None, max_scale=4):
+        self.backend = _Backend(backend or default_backend())
+        self.max_scale = max_scale
+        transforms = transform if isinstance(transform, list) else [transform]
+        splits = [_split_leading(t) for t in transforms]
+        if len(set(repr(lead) for lead, _ in splits)) == 1:
+            self.lead = splits[0][0]
+            rest = [r for _, r in splits]
+        else:
+            self.lead = None
+            rest = transforms
+        self.transform = rest if isinstance(transform, list) else rest[0]
+
+    def plan(self, h, w):
+        """ Returns (window, output size, interpolation) of the leading op for an image of size (h, w).
+
+        The window is None when the leading op can not be fused (a CenterCrop larger than the image).
+        """
+        if self.lead is None:
+            return (0, 0, h, w), None, cv2.INTER_LINEAR
+        op = self.lead[0]
+        if isinstance(op, A.RandomResizedCrop):
+            window = sample_resized_crop(h, w, op.scale, op.ratio)
+            return window, (op.height, op.width), op.interpolation
+        if isinstance(op, A.CenterCrop):
+            if op.height > h or op.width > w:
+                return None, None, None
+            window = ((h - op.height) // 2, (w - op.width) // 2, op.height, op.width)
+            if len(self.lead) == 2:
+                return window, (self.lead[1].height, self.lead[1].width), self.lead[1].interpolation
+            return window, None, cv2.INTER_LINEAR
+        return (0, 0, h, w), (op.height, op.width), op.interpolation
+
+    def __call__(self, file_path):
+        h, w = self.backend.size(file_path)
+        window, out_hw, interpolation = self.plan(h, w)
+        if window is None:
+            # full decode, the leading ops run (and fail) as in the albumentations pipeline
+            image = self.backend.decode(file_path, (0, 0, h, w), 1, full_hw=(h, w))
+            return A.Compose(self.lead)(image=image)['image']
+        scale = choose_scale(window[2:], out_hw, self.max_scale)
+        image = self.backend.decode(file_path, window, scale, full_hw=(h, w))
+        if out_hw is not None and image.shape[:2] != tuple(out_hw):
+            image = cv2.resize(image, (out_hw[1], out_hw[0]), interpolation=interpolation)
+        return image
+
+
+def measure_decode_tolerance(file_paths, transform, backend=None, max_scale=4):
+    """ Compares the fused decode against a full cv2 decode followed by the same crop and resize.
+
+    :return: dict with the max and mean absolute pixel difference and the mean DCT scale used
+    """
+    decoder = ImageDecoder(transform, backend=backend, max_scale=max_scale)
+    max_abs, sum_abs, sum_scale, n = 0., 0., 0., 0
+    for file_path in file_paths:
+        reference = cv2.cvtColor(cv2.imread(file_path), cv2.COLOR_BGR2RGB)
+        window, out_hw, interpolation = decoder.plan(*reference.shape[:2])
+        if window is None:
+            # not fused, decoded at full resolution like the reference
+            continue
+        y, x, h, w = window
+        reference = reference[y:y + h, x:x + w]
+        scale = choose_scale(window[2:], out_hw, max_scale)
+        image = decoder.backend.decode(file_path, window, scale)
+        if out_hw is not None:
+            reference = cv2.resize(reference, (out_hw[1], out_hw[0]), interpolation=interpolation)
+            image = cv2.resize(image, (out_hw[1], out_hw[0]), interpolation=interpolation)
+        diff = np.abs(reference.astype(np.float32) - image.astype(np.float32))
+        max_abs = max(max_abs, float(diff.max()))
+        sum_abs += float(diff.mean())
+        sum_scale += scale
+        n += 1
+    n = max(n, 1)
+    return dict(max_abs=max_abs, mean_abs=sum_abs / n, mean_scale=sum_scale / n)
@@ -0,0 +1,57 @@
+""" uint8 host-to-device transfer with on-device normalization
+
+With ``A.Normalize`` at the end of the pipeline every sample crosses pinned memory and
+the PCIe bus as float32, four times the bytes of the pixels. ``split_normalize`` drops
+the Normalize op so that ``ToTensorV2`` returns uint8 CHW tensors, and returns the
+``DeviceNormalize`` module that does the dtype conversion, the mean/std normalization
+and the optional channels-last layout on the whole batch after the transfer:
+
+    train_transform, device_normalize = split_normalize(train_transform)
+    device_normalize = device_normalize.to(params["device"])
+    images = device_normalize(images.to(params["device"]))
+"""
+import torch
+import torch.nn as nn
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class DeviceNormalize(nn.Module):
+    """ (x / max_pixel_value - mean) / std on a uint8 NCHW batch, as a single fused multiply-add.
+
+    Float batches are assumed to be normalized already and only get the layout change.
+    """
+    def __init__(self, mean=IMAGENET_MEAN, std=IMAGENET_STD, max_pixel_value=255., channels_last=False):
+        super().__init__()
+        mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.register_buffer('scale', 1. / (std * max_pixel_value))
+        self.register_buffer('bias', -mean / std)
+        self.channels_last = channels_last
+
+    def forward(self, images):
+        if images.dtype == torch.uint8:
+            images = torch.addcmul(self.bias, images.float(), self.scale)
+        if self.channels_last and images.dim() == 4:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+
+def split_normalize(transform, channels_last=False):
+    """ Removes ``A.Normalize`` from an A.Compose (or a list of them, for TTA).
+
+    Returns the uint8 pipeline(s) and the matching ``DeviceNormalize``. Pipelines
+    without a Normalize op are returned unchanged with an ImageNet ``DeviceNormalize``.
+    """
+    import albumentations as A
+    if isinstance(transform, (list, tuple)):
+        splits = [split_normalize(t, channels_last) for t in transform]
+        return [t for t, _ in splits], splits[0][1]
+    normalize = [t for t in transform.transforms if isinstance(t, A.Normalize)]
+    if not normalize:
+        return transform, DeviceNormalize(channels_last=channels_last)
+    norm = normalize[-1]
+    device_normalize = DeviceNormalize(norm.mean, norm.std, norm.max_pixel_value, channels_last=channels_last)
+    ops = [t for t in transform.transforms if not isinstance(t, A.Normalize)]
+    return A.Compose(ops, p=transform.p), device_normalize
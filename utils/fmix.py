@@ -1,21 +1,149 @@
 import math
 import random
+import threading
 import torch
 import numpy as np
-from scipy.stats import beta
 
-def fmix(data, targets, alpha, decay_power, shape, device, max_soft=0.0, reformulate=False):
-    print(type(data))
-    print(type(targets))
-    lam, mask = sample_mask(alpha, decay_power, shape, max_soft, reformulate)
-    indices = torch.randperm(data.size(0))
+def fmix(data, targets, alpha, decay_power, shape, device, max_soft=0.0, reformulate=False, bank=None):
+    """ FMix with one mask and one lambda per sample.
+
+    Returns the mixed batch and (targets, shuffled_targets, lam) where lam has one value
+    per sample, the loss is ``ce(output, targets) * lam + ce(output, shuffled_targets) * (1 - lam)``
+    with a per-sample (reduction='none') criterion. Masks are drawn from ``bank`` (a
+    ``FMixMaskBank``) when it has enough of them, otherwise generated on ``device``.
+    """
+    drawn = bank.draw(len(data), device) if bank is not None else None
+    lam, mask = drawn if drawn is not None else \
+        sample_masks(len(data), alpha, decay_power, shape, max_soft, reformulate, device=device)
+    indices = torch.randperm(data.size(0), device=data.device)
     shuffled_data = data[indices]
     shuffled_targets = targets[indices]
-    x1 = torch.from_numpy(mask).to(device)*data
-    x2 = torch.from_numpy(1-mask).to(device)*shuffled_data
-    targets=(targets, shuffled_targets, lam)
-    
-    return (x1+x2).float(), targets
+    mixed = shuffled_data.lerp_(data, mask.to(data.dtype))
+    targets = (targets, shuffled_targets, lam.to(data.device))
+
+    return mixed.float(), targets
+
+
+def sample_masks(n, alpha, decay_power, shape, max_soft=0.0, reformulate=False, device='cpu'):
+    """ Batched torch version of ``sample_mask`` for 2d shapes, returns lam (n,) and masks (n, 1, h, w). """
+    h, w = (shape, shape) if isinstance(shape, int) else shape
+    lam = torch.as_tensor(sample_lam(alpha, reformulate, size=n), dtype=torch.float32, device=device)
+
+    fy = torch.fft.fftfreq(h, device=device)[:, None]
+    fx = torch.fft.rfftfreq(w, device=device)[None]
+    freqs = torch.sqrt(fx * fx + fy * fy)
+    scale = 1. / freqs.clamp(min=1. / max(h, w)) ** decay_power
+    param = torch.randn(n, *freqs.shape, 2, device=device)
+    spectrum = torch.complex(param[..., 0] * scale, param[..., 1] * scale)
+    masks = torch.fft.irfftn(spectrum, s=(h, w), dim=(-2, -1)).view(n, -1)
+    return lam, binarise_masks(masks, lam, max_soft).view(n, 1, h, w)
+
+
+def binarise_masks(masks, lam, max_soft=0.0):
+    """ Binarises every row of ``masks`` (n, size) so that it has mean lam.
+
+    The thresholds are selected with batched ``topk`` calls on the smaller side of every
+    row (at most half of it) instead of a full sort. With max_soft the
+    ramp between the two thresholds is linear in the mask value.
+    """
+    n, size = masks.shape
+    up = torch.rand(n, device=masks.device) > 0.5
+    num = torch.where(up, torch.ceil(lam * size), torch.floor(lam * size)).long()
+    eff_soft = torch.where((lam < max_soft) | ((1 - lam) < max_soft), torch.min(lam, 1 - lam),
+                           torch.full_like(lam, max_soft))
+    soft = (size * eff_soft).long()
+    num_low, num_high = (num - soft).clamp(0, size), (num + soft).clamp(0, size)
+
+    def threshold(count):
+        # value of the count-th largest element of every row, everything >= it is kept. It is
+        # selected from the smaller side: the count largest or the size - count + 1 smallest
+        value = torch.full((n, 1), float('inf'), dtype=masks.dtype, device=masks.device)
+        small = (count > 0) & (count * 2 <= size)
+        large = (count > 0) & ~small
+        if small.any():
+            top = masks[small].topk(int(count[small].max()), dim=1).values
+            value[small] = top.gather(1, count[small, None] - 1)
+        if large.any():
+            rank = size - count[large, None]
+            bottom = masks[large].topk(int(rank.max()) + 1, dim=1, largest=False).values
+            value[large] = bottom.gather(1, rank)
+        return value
+
+    thr_high = threshold(num_low)
+    thr_low = thr_high if torch.equal(num_low, num_high) else threshold(num_high)
+    hard = (masks >= thr_low).to(masks.dtype)
+    ramp = ((masks - thr_low) / (thr_high - thr_low).clamp(min=1e-12)).clamp(0, 1)
+    ramp = torch.where(masks >= thr_high, torch.ones_like(ramp), ramp)
+    return torch.where((num_low == num_high)[:, None], hard, ramp)
+
+
+class FMixMaskBank:
+    """ Keeps ``size`` precomputed FMix masks, refreshed by a background thread.
+
+    The thread is started by the first ``draw`` (fmix only kicks in after the first
+    epochs), fills the bank once, then regenerates as many masks as were drawn so the
+    bank stays fresh at the rate it is used without burning CPU when idle. Masks are
+    stored as uint8 on the CPU and moved to the device when drawn. ``close`` stops the
+    thread and empties the bank, a later ``draw`` starts it again.
+    """
+    def __init__(self, size, alpha, decay_power, shape, max_soft=0.0, reformulate=False, chunk=16):
+        h, w = (shape, shape) if isinstance(shape, int) else shape
+        self.args = (alpha, decay_power, (h, w), max_soft, reformulate)
+        self.size = size
+        self.chunk = chunk
+        self.masks = torch.zeros(size, 1, h, w, dtype=torch.uint8)
+        self.lams = torch.zeros(size)
+        self.filled = 0
+        self.pending = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.stopped = False
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopped or self.filled < self.size or self.pending > 0)
+                if self.stopped:
+                    return
+                if self.filled < self.size:
+                    idx = torch.arange(self.filled, min(self.filled + self.chunk, self.size))
+                else:
+                    idx = torch.randint(self.size, (min(self.pending, self.chunk),))
+                    self.pending -= len(idx)
+            lam, masks = sample_masks(len(idx), *self.args)
+            with self.cond:
+                self.masks[idx] = (masks * 255).round_().to(torch.uint8)
+                self.lams[idx] = lam
+                self.filled = max(self.filled, int(idx.max()) + 1)
+
+    def draw(self, n, device):
+        """ Returns (lam, masks) of n random masks on ``device``, or None while the bank is filling. """
+        self.start()
+        with self.cond:
+            if self.filled < min(n, self.size):
+                return None
+            idx = torch.randint(self.filled, (n,))
+            masks, lam = self.masks[idx], self.lams[idx]
+            self.pending += n
+            self.cond.notify()
+        return lam.to(device), masks.to(device, non_blocking=True).float().div_(255)
+
+    def close(self):
+        with self.cond:
+            thread, self.thread = self.thread, None
+            self.stopped = True
+            self.cond.notify()
+        if thread is not None:
+            thread.join()
+        self.filled, self.pending = 0, 0
 
 def fftfreqnd(h, w=None, z=None):
     """ Get bin values for discrete fourier transform of size (h, w, z)
@@ -90,16 +218,18 @@ def make_low_freq_image(decay, shape, ch=1):
     return mask
 
 
-def sample_lam(alpha, reformulate=False):
+def sample_lam(alpha, reformulate=False, size=None):
     """ Sample a lambda from symmetric beta distribution with given alpha
 
     :param alpha: Alpha value for beta distribution
     :param reformulate: If True, uses the reformulation of [1].
+    :param size: Number of lambdas, a single float if None
     """
+    from scipy.stats import beta
     if reformulate:
-        lam = beta.rvs(alpha+1, alpha)
+        lam = beta.rvs(alpha+1, alpha, size=size)
     else:
-        lam = beta.rvs(alpha, alpha)
+        lam = beta.rvs(alpha, alpha, size=size)
 
     return lam
 
@@ -0,0 +1,154 @@
+""" Pre-decoded image store
+
+JPEG decoding of the full 800x600 images dominates the data loading cost, so every
+image is decoded once offline, optionally resized so that its shorter side equals
+``size``, and appended to one flat uint8 file per resolution:
+
+    {store_dir}/images_{size}.bin   raw RGB pixels, image after image
+    {store_dir}/images_{size}.csv   image_id, offset, height, width
+
+The datasets memory-map the ``.bin`` file and slice images out of it without copies.
+``size=None`` keeps the native resolution (store tag ``full``).
+"""
+import os
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import cv2
+from tqdm import tqdm
+
+
+def _store_paths(store_dir, size):
+    tag = 'full' if size is None else str(size)
+    return (os.path.join(store_dir, f'images_{tag}.bin'),
+            os.path.join(store_dir, f'images_{tag}.csv'))
+
+
+def _resize_short_side(image, size):
+    if size is None:
+        return image
+    h, w = image.shape[:2]
+    scale = size / min(h, w)
+    if scale == 1.:
+        return image
+    return cv2.resize(image, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def _decode_for_store(args):
+    file_path, sizes = args
+    image = cv2.imread(file_path)
+    if image is None:
+        raise IOError(f"Can not decode image {file_path}")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return [np.ascontiguousarray(_resize_short_side(image, size)) for size in sizes]
+
+
+def _read_index(store_dir, size, overwrite):
+    """ Index of an existing store, an empty one when it is missing or rebuilt. """
+    index_path = _store_paths(store_dir, size)[1]
+    if overwrite or not os.path.exists(index_path):
+        return pd.DataFrame({'image_id': [], 'offset': [], 'height': [], 'width': []})
+    return pd.read_csv(index_path)
+
+
+def build_image_store(df, image_dir, store_dir, sizes=(None,), num_workers=8, overwrite=False):
+    """ Decode every image referenced by ``df`` once and write one store per size.
+
+    Stores that already exist are extended with the images of ``df`` they do not hold
+    yet, so scripts filling the same folder from different frames share it.
+
+    Args:
+        df (DataFrame): frame with an ``image_id`` column, duplicates are stored once
+        image_dir (str): folder holding the JPEG files, e.g. ``{root}/train_images``
+        store_dir (str): output folder
+        sizes (tuple): shorter-side sizes to store, ``None`` keeps the native resolution
+        num_workers (int): decoding processes
+        overwrite (bool): rebuild stores that already exist
+    """
+    image_ids = pd.unique(df['image_id'].values)
+    indexes, missing = {}, {}
+    for size in sizes:
+        index = _read_index(store_dir, size, overwrite)
+        stored = set(index['image_id'].values)
+        todo = [image_id for image_id in image_ids if image_id not in stored]
+        if todo:
+            indexes[size], missing[size] = index, set(todo)
+    if len(missing) == 0:
+        return
+    os.makedirs(store_dir, exist_ok=True)
+    sizes = list(missing)
+    todo_ids = [image_id for image_id in image_ids if any(image_id in missing[s] for s in sizes)]
+    jobs = [(os.path.join(image_dir, image_id), [s for s in sizes if image_id in missing[s]])
+            for image_id in todo_ids]
+
+    bin_files, offsets = [], []
+    for size in sizes:
+        index = indexes[size]
+        # bytes past the last indexed image belong to an interrupted build and are overwritten
+        end = int((index['offset'] + index['height'] * index['width'] * 3).max()) if len(index) else 0
+        bin_path = _store_paths(store_dir, size)[0]
+        f = open(bin_path, 'r+b' if end and os.path.exists(bin_path) else 'wb')
+        f.seek(end)
+        f.truncate()
+        bin_files.append(f)
+        offsets.append(end)
+    added = [{'image_id': [], 'offset': [], 'height': [], 'width': []} for _ in sizes]
+    try:
+        with Pool(num_workers) as pool:
+            stream = pool.imap(_decode_for_store, jobs, chunksize=16)
+            for image_id, (_, job_sizes), images in tqdm(zip(todo_ids, jobs, stream), total=len(jobs),
+                                                         desc="Build image store"):
+                for size, image in zip(job_sizes, images):
+                    k = sizes.index(size)
+                    bin_files[k].write(image.tobytes())
+                    added[k]['image_id'].append(image_id)
+                    added[k]['offset'].append(offsets[k])
+                    added[k]['height'].append(image.shape[0])
+                    added[k]['width'].append(image.shape[1])
+                    offsets[k] += image.nbytes
+    finally:
+        for f in bin_files:
+            f.close()
+    # the index is written last, images missing from the index are considered absent
+    for k, size in enumerate(sizes):
+        index = pd.concat([indexes[size], pd.DataFrame(added[k])], ignore_index=True)
+        index.to_csv(_store_paths(store_dir, size)[1], index=False)
+
+
+class ImageStore:
+    """ Read-only view on a store written by ``build_image_store``.
+
+    Only the index is pickled to DataLoader workers, every worker maps the pixel
+    file lazily on first access. ``store[image_id]`` returns a HWC uint8 RGB view.
+    """
+    def __init__(self, store_dir, size=None):
+        self.size = size
+        self.bin_path, index_path = _store_paths(store_dir, size)
+        index = pd.read_csv(index_path)
+        self.lookup = dict(zip(index['image_id'].values, range(len(index))))
+        self.offsets = index['offset'].values.astype(np.int64)
+        self.shapes = index[['height', 'width']].values.astype(np.int64)
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.bin_path, dtype=np.uint8, mode='r')
+        return self._data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, image_id):
+        return image_id in self.lookup
+
+    def __getitem__(self, image_id):
+        i = self.lookup[image_id]
+        h, w = self.shapes[i]
+        start = self.offsets[i]
+        return self.data[start:start + h * w * 3].reshape(h, w, 3)
@@ -0,0 +1,170 @@
+""" Single-decode multi-model inference engine
+
+An ensemble is a list of members ``(architecture, checkpoint, input resolution)``. The
+loader decodes every image once into a uint8 tensor at the source resolution; on the
+device ``InferenceEngine`` centre-crops (or resizes) the batch once per distinct member
+resolution, normalizes it, builds the TTA views once per resolution and fans the
+stacked views out to every member of that resolution:
+
+    engine = InferenceEngine([("resnest26d", "weights/r26_fold0.pth", 512),
+                              ("tf_efficientnet_b4_ns", "weights/b4_fold0.pth", 512)],
+                             device="cuda", views=("identity", "hflip", "vflip", "rot90"))
+    logits = engine(images)                                   # (models, views, N, classes)
+    logits, labels, image_ids = engine.predict(loader)        # whole loader
+    logits, labels, image_ids = engine.predict_cached(df, make_loader, cache, signature, hashes)
+
+``predict_cached`` serves the logits stored in a ``PredictionCache`` and only decodes the
+images, and runs the members, that have no entry (see utils/prediction_cache.py).
+
+The crop follows the ``CenterCrop(size) + Resize(size)`` pipelines of the scripts:
+images at least ``size`` large are centre-cropped, smaller ones are resized.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+from .checkpoint_store import read_weights, read_meta, init_empty
+from .device_normalize import DeviceNormalize
+from .tta import BatchTTA
+from .prediction_cache import cached_logits
+
+
+def create_member_model(arch, num_classes=5, drop_rate=0.2):
+    """ timm backbone with the head and regularization settings of the training script. """
+    import timm
+    kwargs = dict(drop_path_rate=0.3) if "efficientnet" in arch else {}
+    return timm.create_model(arch, pretrained=False, num_classes=num_classes, drop_rate=drop_rate, **kwargs)
+
+
+def load_state_dict(checkpoint, map_location='cpu'):
+    """ Model weights of a training checkpoint or exported file, without the DataParallel ``module.`` prefix. """
+    return read_weights(checkpoint, map_location)[0]
+
+
+def load_member(arch, checkpoint, device, num_classes=5, channels_last=False):
+    if checkpoint is None:
+        model = create_member_model(arch, num_classes)
+    else:
+        model = init_empty(lambda: create_member_model(arch, num_classes), load_state_dict(checkpoint))
+    # fp16 exports are computed in fp32
+    model = model.float().to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model.eval()
+
+
+def load_members(members, device, num_classes=5, channels_last=False, num_threads=8):
+    """ ``load_member`` of every ``(arch, checkpoint)``, built in parallel threads. """
+    with ThreadPoolExecutor(max(1, min(num_threads, len(members)))) as pool:
+        return list(pool.map(lambda m: load_member(m[0], m[1], device, num_classes, channels_last), members))
+
+
+def resolve_member(member):
+    """ Fills the architecture and image size of an exported checkpoint from its metadata. """
+    name, model, image_size = member
+    if not isinstance(model, nn.Module) and model is not None and (name is None or image_size is None):
+        meta = read_meta(model)
+        name = meta['arch'] if name is None else name
+        image_size = meta['image_size'] if image_size is None else image_size
+    return name, model, image_size
+
+
+def center_crop_or_resize(images, size):
+    """ (N, C, size, size) centre crop of a batch, resized when the batch is smaller than ``size``. """
+    if size is None:
+        # members that take the batch as decoded, e.g. five crops of the full image
+        return images
+    h, w = images.shape[-2:]
+    if h >= size and w >= size:
+        top, left = int(round((h - size) / 2.)), int(round((w - size) / 2.))
+        return images[..., top:top + size, left:left + size]
+    resized = F.interpolate(images.float(), size=(size, size), mode='bilinear', align_corners=False)
+    # uint8 batches stay uint8 so that DeviceNormalize still normalizes them
+    return resized.round().clamp_(0, 255).to(torch.uint8) if images.dtype == torch.uint8 else resized
+
+
+class InferenceEngine(nn.Module):
+    """ Runs every ensemble member on one decoded batch.
+
+    Args:
+        members (list): ``(architecture, checkpoint, image_size)`` tuples, or
+            ``(name, nn.Module, image_size)`` for models that are already built. The
+            architecture and size of exported checkpoints may be None, see checkpoint_store.py
+        device (str): inference device
+        views (tuple): TTA views, see ``utils.tta.VIEWS``
+        five_crop (int): five-crop size applied before the views, None for no cropping
+        normalize (DeviceNormalize): normalization of the uint8 batch, ImageNet by default
+        num_classes (int): number of classes of the checkpoints
+        channels_last (bool): channels-last models and inputs
+    """
+    def __init__(self, members, device='cuda', views=('identity',), five_crop=None, normalize=None,
+                 num_classes=5, channels_last=False):
+        super().__init__()
+        members = [resolve_member(m) for m in members]
+        self.device = torch.device(device)
+        self.names = [m[0] for m in members]
+        self.image_sizes = [m[2] for m in members]
+        # checkpoint paths, None for the members given as modules
+        self.checkpoints = [None if isinstance(m[1], nn.Module) else m[1] for m in members]
+        self.num_classes = num_classes
+        loaded = iter(load_members([m for m in members if not isinstance(m[1], nn.Module)], self.device,
+                                   num_classes, channels_last))
+        self.models = nn.ModuleList([m[1].to(self.device).eval() if isinstance(m[1], nn.Module) else next(loaded)
+                                     for m in members])
+        self.normalize = (normalize or DeviceNormalize()).to(self.device)
+        self.tta = BatchTTA(views, five_crop=five_crop, channels_last=channels_last)
+        # member indices per distinct resolution, in order of first appearance
+        self.groups = {}
+        for i, size in enumerate(self.image_sizes):
+            self.groups.setdefault(size, []).append(i)
+
+    @property
+    def num_views(self):
+        return self.tta.num_views
+
+    @torch.no_grad()
+    def forward(self, images, members=None):
+        """ (models, views, N, classes) logits of a uint8 (or normalized float) NCHW batch.
+
+        ``members`` restricts the forward to these member indices, in that order.
+        """
+        members = list(range(len(self.models))) if members is None else list(members)
+        images = images.to(self.device, non_blocking=True)
+        logits = {}
+        for size, indices in self.groups.items():
+            indices = [i for i in indices if i in members]
+            if not indices:
+                continue
+            views = self.tta.expand(self.normalize(center_crop_or_resize(images, size)))
+            for i in indices:
+                logits[i] = self.models[i](views).float().view(self.num_views, len(images), -1)
+        return torch.stack([logits[i] for i in members])
+
+    def predict(self, loader, desc="Inference"):
+        """ Logits of the whole loader on the CPU, with the labels and image ids of the batches. """
+        logits, labels, image_ids = [], [], []
+        for data in tqdm(loader, desc=desc):
+            logits.append(self(data["images"]).cpu())
+            labels.append(torch.as_tensor(data["labels"]))
+            image_ids.extend(data["image_ids"])
+        return torch.cat(logits, dim=2), torch.cat(labels), image_ids
+
+    def predict_cached(self, df, make_loader, cache, signature, image_hashes, desc="Inference"):
+        """ ``predict`` of ``make_loader(df)`` with the logits of ``cache`` reused.
+
+        Args:
+            df (DataFrame): ``image_id`` [and ``label``] rows, in output order
+            make_loader (callable): DataLoader of a subset of the rows of ``df``
+            cache (PredictionCache): store, None computes everything
+            signature (str): ``transform_signature`` of the loader pipeline and the views
+            image_hashes (list): content hash of every row, see ``PredictionCache.frame_hashes``
+        """
+        def compute(rows, members):
+            loader = make_loader(df.iloc[rows].reset_index(drop=True))
+            return torch.cat([self(data["images"], members).cpu() for data in tqdm(loader, desc=desc)], dim=2)
+
+        keys = [None if cache is None or ckpt is None else cache.checkpoint_hash(ckpt) for ckpt in self.checkpoints]
+        logits = cached_logits(cache, keys, image_hashes, signature, compute, self.num_views, self.num_classes)
+        labels = torch.tensor(df['label'].values, dtype=torch.long) if 'label' in df else torch.full((len(df),), -1)
+        return logits, labels, list(df['image_id'].values)
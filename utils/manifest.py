@@ -0,0 +1,148 @@
+""" Persisted dataset manifest
+
+One table for every image the scripts touch, with the k-fold assignment, the image
+size read from the JPEG header, the file size, a content hash and an ``ok`` flag for
+files that are missing or truncated. It is saved column by column in a ``.npz`` file
+and loaded back into a DataFrame in a few milliseconds, so the entry scripts no
+longer recompute the folds or find broken images in the middle of an epoch.
+
+    sources = {'train': (train, f'{root}/train_images'),
+               'external': (train_external, f'{root}/train_images')}
+    manifest = build_manifest(sources, 'manifest.npz')
+    folds = manifest[manifest.source == 'train'].reset_index(drop=True)
+"""
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """ blake2b-128 hex digest of the file content. """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_image(file_path):
+    """ Returns (height, width, nbytes, content hash, ok) without decoding any pixel. """
+    # decode.py pulls in albumentations, not needed by the users of file_hash
+    from .decode import read_jpeg_size
+    try:
+        with open(file_path, 'rb') as f:
+            buf = f.read()
+        height, width = read_jpeg_size(buf)
+    except (OSError, ValueError):
+        return 0, 0, 0, '', False
+    ok = buf[-2:] == b'\xff\xd9' or not buf.startswith(b'\xff\xd8')  # truncated JPEG check
+    return height, width, len(buf), hashlib.blake2b(buf, digest_size=16).hexdigest(), ok
+
+
+def assign_folds(labels, n_splits=5, seed=42):
+    """ Stratified fold id per row, identical to the StratifiedKFold loop of the scripts. """
+    from sklearn.model_selection import StratifiedKFold
+    folds = np.empty(len(labels), dtype=np.int8)
+    skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    for n, (_, val_index) in enumerate(skf.split(np.zeros(len(labels)), labels)):
+        folds[val_index] = n
+    return folds
+
+
+def build_manifest(sources, out_path, fold_source='train', n_splits=5, seed=42, num_workers=16, overwrite=False):
+    """ Scan every source and save the manifest at ``out_path``.
+
+    An existing manifest is reused when it was built with the same fold settings, the same
+    fold source frame and holds every requested image of the other sources with its label.
+
+    Args:
+        sources (dict): source name -> (DataFrame with ``image_id`` [and ``label``], image folder)
+        out_path (str): ``.npz`` output file
+        fold_source (str): source that gets the stratified folds, other sources get fold -1
+        n_splits (int): number of folds
+        seed (int): StratifiedKFold seed
+        num_workers (int): scanning threads
+    """
+    settings = dict(fold_source=fold_source, n_splits=n_splits, seed=seed)
+    if os.path.exists(out_path) and not overwrite:
+        if _matches(out_path, sources, settings):
+            return load_manifest(out_path)
+        # written with fewer sources (e.g. by the pred script), other labels (a new pseudo-label
+        # round) or other fold settings, reusing it would drop rows or train on stale labels / folds
+        print(f"Manifest: {out_path} does not match the requested images, labels or folds, rebuilding it")
+    frames = []
+    for name, (df, image_dir) in sources.items():
+        frame = pd.DataFrame({
+            'image_id': df['image_id'].values,
+            'label': _labels(df),
+            'source': name,
+            'fold': np.full(len(df), -1, dtype=np.int8),
+            'path': [os.path.join(image_dir, f) for f in df['image_id'].values],
+        })
+        if name == fold_source:
+            frame['fold'] = assign_folds(frame['label'].values, n_splits, seed)
+        frames.append(frame)
+    manifest = pd.concat(frames, axis=0, ignore_index=True)
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        scans = list(tqdm(pool.map(scan_image, manifest['path'].values, chunksize=64),
+                          total=len(manifest), desc="Scan images"))
+    height, width, nbytes, content_hash, ok = zip(*scans) if scans else ([],) * 5
+    manifest['height'] = np.array(height, dtype=np.int32)
+    manifest['width'] = np.array(width, dtype=np.int32)
+    manifest['nbytes'] = np.array(nbytes, dtype=np.int64)
+    manifest['hash'] = np.array(content_hash)
+    manifest['ok'] = np.array(ok, dtype=bool)
+    manifest = manifest.drop(columns='path')
+    if not manifest['ok'].all():
+        print(f"Manifest: {(~manifest['ok']).sum()} missing or broken images, they are flagged with ok=False")
+
+    columns = {c: manifest[c].to_numpy() for c in manifest.columns}
+    columns = {c: v.astype(str) if v.dtype.kind == 'O' else v for c, v in columns.items()}
+    columns.update({_SETTING + k: np.array(v) for k, v in settings.items()})
+    np.savez(out_path, **columns)
+    return load_manifest(out_path)
+
+
+# prefix of the fold settings saved next to the columns
+_SETTING = 'setting_'
+
+
+def _labels(df):
+    return df['label'].values.astype(np.int8) if 'label' in df else np.full(len(df), -1, dtype=np.int8)
+
+
+def _matches(path, sources, settings):
+    """ True when the manifest at ``path`` was built with ``settings`` and holds every
+    (source, image_id, label) of ``sources``, the fold source row for row. """
+    with np.load(path) as data:
+        stored = {k: data[_SETTING + k].item() for k in settings if _SETTING + k in data.files}
+    if stored != settings:
+        return False
+    manifest = load_manifest(path, drop_broken=False)
+    for name, (df, _) in sources.items():
+        rows = manifest[manifest['source'] == name]
+        ids, labels = df['image_id'].values.astype(str), _labels(df)
+        if name == settings['fold_source']:
+            # the folds are a function of the whole frame, it must be the same
+            if not (np.array_equal(rows['image_id'].values.astype(str), ids)
+                    and np.array_equal(rows['label'].values, labels)):
+                return False
+            continue
+        stored_labels = dict(zip(rows['image_id'].values, rows['label'].values))
+        if any(stored_labels.get(i) != l for i, l in zip(ids, labels)):
+            return False
+    return True
+
+
+def load_manifest(path, drop_broken=True):
+    with np.load(path) as data:
+        manifest = pd.DataFrame({c: data[c] for c in data.files if not c.startswith(_SETTING)})
+    for c in ('image_id', 'source', 'hash'):
+        manifest[c] = manifest[c].astype(object)
+    if drop_broken:
+        manifest = manifest[manifest['ok']].reset_index(drop=True)
+    return manifest
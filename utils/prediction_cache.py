@@ -0,0 +1,150 @@
+""" Content-addressed cache of per-view model logits
+
+The (views, classes) logits of an image are stored in a sqlite file under the triple
+(image content hash, checkpoint content hash, transform signature), so renaming files
+or checkpoints keeps the hits and swapping one checkpoint only invalidates the rows of
+that model. Content hashes are the blake2b-128 digests of ``utils.manifest.file_hash``
+(the manifest ``hash`` column); the hash of every file is memoized by path, size and
+mtime so it is read once.
+
+    cache = PredictionCache("predictions.sqlite")
+    signature = transform_signature(val_transform, tta.views)
+    logits, labels, image_ids = engine.predict_cached(val_folds, make_loader, cache, signature,
+                                                      cache.frame_hashes(val_folds, f'{root}/train_images'))
+
+``cached_logits`` serves the hits and calls the model only for the (members, images)
+that are missing.
+"""
+import os
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from .manifest import file_hash
+
+
+def transform_signature(*parts):
+    """ Short digest of the reprs of everything that changes the logits of a checkpoint. """
+    return hashlib.blake2b('\n'.join(repr(p) for p in parts).encode(), digest_size=8).hexdigest()
+
+
+class PredictionCache:
+    """ sqlite store of float32 (views, classes) logits.
+
+    Args:
+        path (str): sqlite file, created if missing
+        num_workers (int): threads hashing the files that are not memoized yet
+    """
+    def __init__(self, path, num_workers=16):
+        self.path = path
+        self.num_workers = num_workers
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS logits (image TEXT, model TEXT, transform TEXT,
+                views INTEGER, classes INTEGER, data BLOB, PRIMARY KEY (image, model, transform));
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT);
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def image_hashes(self, paths):
+        """ Content hash of every file, hashing only the new or modified ones. """
+        stats = [os.stat(p) for p in paths]
+        keys = [os.path.abspath(p) for p in paths]
+        memo = {}
+        for chunk in range(0, len(keys), 500):
+            part = keys[chunk:chunk + 500]
+            memo.update((path, (size, mtime, h)) for path, size, mtime, h in self.db.execute(
+                f'SELECT path, size, mtime, hash FROM files WHERE path IN ({",".join("?" * len(part))})', part))
+        todo = [i for i, (k, s) in enumerate(zip(keys, stats))
+                if memo.get(k, (None, None))[:2] != (s.st_size, s.st_mtime_ns)]
+        if todo:
+            with ThreadPoolExecutor(self.num_workers) as pool:
+                hashes = list(pool.map(file_hash, [paths[i] for i in todo]))
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    [(keys[i], stats[i].st_size, stats[i].st_mtime_ns, h)
+                                     for i, h in zip(todo, hashes)])
+            for i, h in zip(todo, hashes):
+                memo[keys[i]] = (stats[i].st_size, stats[i].st_mtime_ns, h)
+        return [memo[k][2] for k in keys]
+
+    def frame_hashes(self, df, image_dir):
+        """ Content hash of every row of ``df``, the manifest ``hash`` column when it has one. """
+        if 'hash' in df:
+            return list(df['hash'].values)
+        return self.image_hashes([os.path.join(image_dir, f) for f in df['image_id'].values])
+
+    def checkpoint_hash(self, checkpoint):
+        return self.image_hashes([checkpoint])[0]
+
+    def get(self, image_hashes, model, signature):
+        """ Returns the found mask (N,) and the (N, views, classes) logits, None if nothing is found. """
+        positions = {}
+        for i, h in enumerate(image_hashes):
+            positions.setdefault(h, []).append(i)
+        found = np.zeros(len(image_hashes), dtype=bool)
+        values = None
+        unique = list(positions)
+        for chunk in range(0, len(unique), 500):
+            part = unique[chunk:chunk + 500]
+            rows = self.db.execute(
+                f'SELECT image, views, classes, data FROM logits WHERE model = ? AND transform = ? '
+                f'AND image IN ({",".join("?" * len(part))})', [model, signature] + part)
+            for image, views, classes, data in rows:
+                if values is None:
+                    values = np.zeros((len(image_hashes), views, classes), dtype=np.float32)
+                index = positions[image]
+                values[index] = np.frombuffer(data, dtype=np.float32).reshape(views, classes)
+                found[index] = True
+        return found, values
+
+    def put(self, image_hashes, model, signature, logits):
+        """ Stores the (N, views, classes) logits of ``image_hashes``. """
+        logits = np.ascontiguousarray(np.asarray(logits, dtype=np.float32))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO logits VALUES (?, ?, ?, ?, ?, ?)',
+                                [(h, model, signature, logits.shape[1], logits.shape[2], logits[i].tobytes())
+                                 for i, h in enumerate(image_hashes)])
+
+
+def cached_logits(cache, model_keys, image_hashes, signature, compute, num_views, num_classes):
+    """ (models, views, N, classes) logits, computed only where the cache has no entry.
+
+    Args:
+        cache (PredictionCache): store, None computes everything
+        model_keys (list): checkpoint hash of every model, None for models that are never cached
+        image_hashes (list): content hash of the N images
+        signature (str): ``transform_signature`` of the pipeline and views
+        compute (callable): ``compute(rows, members)`` returns the (len(members), views, len(rows),
+            classes) logits of the given models on the given images
+    """
+    num_images = len(image_hashes)
+    logits = torch.zeros(len(model_keys), num_views, num_images, num_classes)
+    missing = np.ones((len(model_keys), num_images), dtype=bool)
+    if cache is not None:
+        for i, key in enumerate(model_keys):
+            if key is None:
+                continue
+            found, values = cache.get(image_hashes, key, signature)
+            if values is not None:
+                logits[i][:, found] = torch.from_numpy(values[found]).transpose(0, 1)
+            missing[i] = ~found
+        print(f"Prediction cache: {int((~missing).sum())}/{missing.size} hits")
+    members = np.flatnonzero(missing.any(1))
+    rows = np.flatnonzero(missing.any(0))
+    if len(rows) == 0:
+        return logits
+    computed = compute(rows, members).float().cpu()
+    for j, i in enumerate(members):
+        logits[i][:, rows] = computed[j]
+        if cache is not None and model_keys[i] is not None:
+            new = missing[i, rows]
+            cache.put([image_hashes[r] for r in rows[new]], model_keys[i], signature,
+                      computed[j][:, torch.from_numpy(new)].transpose(0, 1).numpy())
+    return logits
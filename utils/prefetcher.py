@@ -0,0 +1,149 @@
+""" Background batch prefetcher
+
+Wraps a DataLoader so that the next ``depth`` batches are already on the device while
+the current step runs. On CUDA the copies are issued on a side stream from pinned
+memory and the compute stream waits on an event per batch; on other devices a
+background thread pulls batches from the loader into a bounded queue.
+
+``data_wait`` is the time the training loop spent blocked on the input pipeline
+during the last pass, ``wait_ratio`` the same as a fraction of the pass. A ratio
+close to 0 means the loader keeps up with the model.
+
+    loader = Prefetcher(train_loader, params["device"], depth=2)
+    for images, target, _, _ in loader:
+        ...
+    print(f"data wait {loader.data_wait:.1f}s ({100 * loader.wait_ratio:.1f}%)")
+"""
+import queue
+import threading
+import time
+from collections import deque
+import torch
+
+
+def to_device(batch, device, non_blocking=True):
+    """ Moves every tensor of a (nested) batch to ``device``. """
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(v, device, non_blocking) for v in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class Prefetcher:
+    """ Iterates over ``loader`` with the next ``depth`` batches staged on ``device``.
+
+    Args:
+        loader (DataLoader): source loader, ``pin_memory=True`` makes the CUDA copies asynchronous
+        device (str or torch.device): target device
+        depth (int): number of batches staged ahead of the current one
+    """
+    _END = object()
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+        self.data_wait = 0.
+        self.elapsed = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def wait_ratio(self):
+        return self.data_wait / self.elapsed if self.elapsed > 0 else 0.
+
+    def __iter__(self):
+        self.data_wait, self.elapsed = 0., 0.
+        if self.device.type == 'cuda' and torch.cuda.is_available():
+            return self._iter_cuda()
+        return self._iter_thread()
+
+    def _iter_cuda(self):
+        start = time.perf_counter()
+        copy_stream = torch.cuda.Stream(self.device)
+        compute_stream = torch.cuda.current_stream(self.device)
+        it = iter(self.loader)
+        staged = deque()
+
+        def stage():
+            t0 = time.perf_counter()
+            batch = next(it, self._END)
+            self.data_wait += time.perf_counter() - t0
+            if batch is self._END:
+                return False
+            with torch.cuda.stream(copy_stream):
+                batch = to_device(batch, self.device)
+                event = torch.cuda.Event()
+                event.record(copy_stream)
+            staged.append((batch, event))
+            return True
+
+        for _ in range(self.depth):
+            if not stage():
+                break
+        while staged:
+            batch, event = staged.popleft()
+            compute_stream.wait_event(event)
+            # the memory was allocated on the copy stream but is used on the compute stream
+            _record_stream(batch, compute_stream)
+            stage()
+            self.elapsed = time.perf_counter() - start
+            yield batch
+        self.elapsed = time.perf_counter() - start
+
+    def _iter_thread(self):
+        start = time.perf_counter()
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    if not put(to_device(batch, self.device, non_blocking=False)):
+                        return
+            except Exception as e:  # re-raised in the consumer
+                put(e)
+                return
+            put(self._END)
+
+        worker = threading.Thread(target=produce, daemon=True)
+        worker.start()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                batch = staged.get()
+                self.data_wait += time.perf_counter() - t0
+                if batch is self._END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                self.elapsed = time.perf_counter() - start
+                yield batch
+        finally:
+            stop.set()
+            worker.join()
+            self.elapsed = time.perf_counter() - start
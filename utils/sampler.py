@@ -0,0 +1,145 @@
+""" Streaming class-balanced sampler
+
+Replaces the ``balance_data`` resampling of the training frame: instead of building a
+new, duplicated DataFrame once per run, the sampler draws ``rate * count`` indices per
+class lazily every epoch. Rates above 1 repeat every sample of the class and top up
+with a random subset, rates below 1 take a random subset, so the epoch is reproducible
+from (seed, epoch) and the rates can be changed between epochs with ``set_rates``.
+"""
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def balance_rates(labels, mode="undersampling", num_classes=5):
+    """ Per-class rates reproducing the ``balance_data`` modes. """
+    counts = np.bincount(np.asarray(labels), minlength=num_classes).astype(np.float64)
+    if mode == "undersampling":
+        rates = np.ones(num_classes)
+        rates[1], rates[3], rates[4] = 0.7, 2. / 3., 1.3
+        return rates
+    # up-sampling of every class relative to the size of class 3
+    targets = counts[3] * np.array([1. / 4., 1. / 3., 1. / 3., 1., 1. / 3.])
+    return targets / np.maximum(counts, 1.)
+
+
+class ClassBalancedSampler(Sampler):
+    """ Draws ``int(rate * count)`` samples of every class per epoch.
+
+    Args:
+        labels (array): label of every dataset item
+        rates (list or dict): per-class sampling rate, computed from ``mode`` if None
+        mode (str): "undersampling" or "upsampling", see ``balance_rates``
+        seed (int): base seed, combined with the epoch
+        num_replicas (int): number of distributed processes, read from torch.distributed if None
+        rank (int): rank of this process, read from torch.distributed if None
+    """
+    def __init__(self, labels, rates=None, mode="undersampling", seed=42, num_replicas=None, rank=None):
+        self.labels = np.asarray(labels).astype(np.int64)
+        self.num_classes = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.class_indices = [np.nonzero(self.labels == c)[0] for c in range(self.num_classes)]
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.set_rates(balance_rates(self.labels, mode, self.num_classes) if rates is None else rates)
+
+    def set_rates(self, rates):
+        if isinstance(rates, dict):
+            rates = [rates.get(c, 1.) for c in range(self.num_classes)]
+        self.rates = np.asarray(rates, dtype=np.float64)
+        self.class_sizes = [int(len(idx) * r) for idx, r in zip(self.class_indices, self.rates)]
+        self.total_size = int(np.ceil(sum(self.class_sizes) / self.num_replicas)) * self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _draw(self, rng):
+        indices = []
+        for idx, n in zip(self.class_indices, self.class_sizes):
+            if n == 0 or len(idx) == 0:
+                continue
+            repeats, rest = divmod(n, len(idx))
+            indices.append(np.tile(idx, repeats))
+            indices.append(rng.choice(idx, rest, replace=False))
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        rng.shuffle(indices)
+        # pad so that every replica gets the same number of samples
+        if len(indices) and len(indices) < self.total_size:
+            indices = np.concatenate([indices, indices[:self.total_size - len(indices)]])
+        return indices[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        return iter(self._draw(rng).tolist())
+
+    def __len__(self):
+        return self.total_size // self.num_replicas
+
+
+class RepeatedViewSampler(Sampler):
+    """ Repeats every index of ``sampler`` ``num_views`` times for repeated augmentation.
+
+    With a ``TrainDataset(repeat_views=num_views)`` the image is decoded once and every
+    repeat gets its own random augmentation. The repeats either follow each other (same
+    batch) or, with ``spread``, land in ``num_views`` different batches that the
+    DataLoader hands to the same worker, which is where the decoded image is kept. In the
+    same-batch layout a ``batch_size`` multiple of ``num_views`` keeps all the views of an
+    image in one batch, otherwise the image is decoded again for the views cut off.
+
+    Args:
+        sampler (Sampler): base order of the items, e.g. a RandomSampler or ClassBalancedSampler
+        num_views (int): augmented views per decoded image
+        batch_size (int): batch size of the DataLoader
+        num_workers (int): number of DataLoader workers, batches are dealt to them round-robin
+        spread (bool): place the views of an image in different batches instead of the same one
+        keep_length (bool): draw len(sampler) samples per epoch, i.e. only the first
+            len(sampler) / num_views images of the base order, instead of num_views * len(sampler)
+        seed (int): base seed of the order within the batches, combined with the epoch
+    """
+    def __init__(self, sampler, num_views=2, batch_size=32, num_workers=0, spread=False, keep_length=True, seed=42):
+        self.sampler = sampler
+        self.num_views = num_views
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.spread = spread
+        self.keep_length = keep_length
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def _spread(self, indices, rng):
+        # a round is num_workers * num_views batches, worker w serves batches w, w + num_workers, ...
+        # and sees the same batch_size images in each of its num_views batches
+        out = []
+        step = self.num_workers * self.batch_size
+        for start in range(0, len(indices), step):
+            chunk = indices[start:start + step]
+            groups = [chunk[w * self.batch_size:(w + 1) * self.batch_size] for w in range(self.num_workers)]
+            for _ in range(self.num_views):
+                for group in groups:
+                    out.append(rng.permutation(group))
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.int64)
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = np.fromiter(iter(self.sampler), dtype=np.int64)
+        if self.keep_length:
+            indices = indices[:int(np.ceil(len(indices) / self.num_views))]
+        if self.spread:
+            indices = self._spread(indices, rng)
+        else:
+            indices = np.repeat(indices, self.num_views)
+        return iter(indices[:len(self)].tolist())
+
+    def __len__(self):
+        n = len(self.sampler)
+        return n if self.keep_length else n * self.num_views
@@ -0,0 +1,163 @@
+""" Sequential packed-shard dataset format
+
+Random reads of ~21k small JPEG files are slow on network and spinning disks. The
+packer copies the encoded bytes of every image referenced by a fold DataFrame into a
+few large shard files, read back front to back by ``ShardDataset``:
+
+    {out_dir}/{name}-00000.bin   concatenated JPEG files
+    {out_dir}/{name}.csv         image_id, label, shard, offset, length
+
+Randomness comes from shuffling the shard order every epoch plus a shuffle buffer
+over the decoded samples, which is close enough to a full shuffle for training.
+"""
+import os
+import random
+import numpy as np
+import pandas as pd
+import cv2
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+
+def _shard_path(out_dir, name, shard):
+    return os.path.join(out_dir, f'{name}-{shard:05d}.bin')
+
+
+def pack_shards(df, image_dir, out_dir, name='train', shard_size_mb=64, overwrite=False):
+    """ Pack the images of ``df`` (``image_id`` and optional ``label`` columns) into shards.
+
+    Args:
+        df (DataFrame): e.g. train.csv merged with train_external.csv and the pseudo label csv
+        image_dir (str): folder holding the JPEG files
+        out_dir (str): output folder
+        name (str): shard name prefix
+        shard_size_mb (int): a new shard is started once this size is reached
+    """
+    index_path = os.path.join(out_dir, f'{name}.csv')
+    if os.path.exists(index_path) and not overwrite:
+        return index_path
+    os.makedirs(out_dir, exist_ok=True)
+    df = df.drop_duplicates('image_id')
+    labels = df['label'].values if 'label' in df else np.full(len(df), -1)
+    index = {'image_id': [], 'label': [], 'shard': [], 'offset': [], 'length': []}
+    shard, offset = 0, 0
+    out = open(_shard_path(out_dir, name, shard), 'wb')
+    try:
+        for image_id, label in tqdm(zip(df['image_id'].values, labels), total=len(df), desc="Pack shards"):
+            with open(os.path.join(image_dir, image_id), 'rb') as f:
+                buf = f.read()
+            if offset > 0 and offset + len(buf) > shard_size_mb * 2**20:
+                out.close()
+                shard, offset = shard + 1, 0
+                out = open(_shard_path(out_dir, name, shard), 'wb')
+            out.write(buf)
+            index['image_id'].append(image_id)
+            index['label'].append(int(label))
+            index['shard'].append(shard)
+            index['offset'].append(offset)
+            index['length'].append(len(buf))
+            offset += len(buf)
+    finally:
+        out.close()
+    pd.DataFrame(index).to_csv(index_path, index=False)
+    return index_path
+
+
+class ShardDataset(IterableDataset):
+    """ Streams the samples of ``df`` out of packed shards, a drop-in for ``TrainDataset``.
+
+    Every DataLoader worker reads a disjoint subset of the shards, or of ranges of the
+    shards when there are fewer shards than workers. Yields the same
+    (image, label, soft_label, image_id) tuples as ``TrainDataset``; call ``set_epoch``
+    before each epoch to get a new shard order.
+
+    Args:
+        out_dir (str): folder written by ``pack_shards``
+        df (DataFrame): rows to stream, labels are taken from it (pseudo labels may differ
+            from the packed ones); repeated image ids are streamed repeatedly
+        transform (A.Compose): albumentations pipeline
+        name (str): shard name prefix
+        shuffle (bool): shuffle shards and samples
+        buffer_size (int): size of the sample shuffle buffer
+        seed (int): base seed, combined with the epoch
+    """
+    def __init__(self, out_dir, df, transform=None, name='train', shuffle=True, buffer_size=256, seed=42):
+        self.out_dir = out_dir
+        self.name = name
+        self.transform = transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+        index = pd.read_csv(os.path.join(out_dir, f'{name}.csv')).set_index('image_id')
+        missing = set(df['image_id'].values) - set(index.index)
+        assert len(missing) == 0, f"{len(missing)} images are not packed in {out_dir}, re-run pack_shards"
+        rows = index.loc[df['image_id'].values]
+        self.file_names = df['image_id'].values
+        self.labels = df['label'].values
+        self.shards = rows['shard'].values
+        self.offsets = rows['offset'].values
+        self.lengths = rows['length'].values
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def _iter_shard(self, shard, rng, part=0, num_parts=1):
+        # part ``part`` of ``num_parts`` contiguous ranges of the shard, only its bytes are read
+        items = np.nonzero(self.shards == shard)[0]
+        items = items[np.argsort(self.offsets[items], kind='stable')]
+        items = np.array_split(items, num_parts)[part]
+        if len(items) == 0:
+            return
+        start = self.offsets[items[0]]
+        with open(_shard_path(self.out_dir, self.name, shard), 'rb') as f:
+            f.seek(start)
+            data = f.read(self.offsets[items[-1]] + self.lengths[items[-1]] - start)
+        if self.shuffle:
+            rng.shuffle(items)
+        for i in items:
+            yield i, data[self.offsets[i] - start:self.offsets[i] - start + self.lengths[i]]
+
+    def _sample(self, i, buf):
+        image = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if self.transform:
+            image = self.transform(image=image)['image']
+        label = torch.tensor(self.labels[i]).long()
+        return image, label, 0., self.file_names[i]
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        shards = sorted(set(self.shards.tolist()))
+        if self.shuffle:
+            rng.shuffle(shards)
+        num_parts = 1
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # with fewer shards than workers every shard is split into sample ranges, so no worker is idle
+            num_parts = -(-worker_info.num_workers // max(1, len(shards)))
+            rng = random.Random(self.seed + self.epoch * 1000 + worker_info.id)
+        units = [(shard, part) for shard in shards for part in range(num_parts)]
+        if worker_info is not None:
+            units = units[worker_info.id::worker_info.num_workers]
+
+        buffer = []
+        for shard, part in units:
+            for i, buf in self._iter_shard(shard, rng, part, num_parts):
+                if not self.shuffle or self.buffer_size <= 1:
+                    yield self._sample(i, buf)
+                    continue
+                if len(buffer) < self.buffer_size:
+                    buffer.append((i, buf))
+                    continue
+                k = rng.randrange(len(buffer))
+                item, buffer[k] = buffer[k], (i, buf)
+                yield self._sample(*item)
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield self._sample(*item)
@@ -0,0 +1,59 @@
+""" Precomputed soft-label store for distillation
+
+The out-of-fold predictions in ``error_analysis/val_{model}_{fold}_pred.csv`` hold one
+space separated probability string per image. They are parsed once into a float32
+array saved next to its image ids:
+
+    {path}.npy       float32 (N, num_classes)
+    {path}_ids.csv   image_id of every row
+
+``SoftLabelStore`` memory-maps the array, datasets look their rows up once at
+construction so the per-sample fetch is a single row read.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+
+def parse_prob(prob):
+    """ Parses '0.1 0.2 ...' (or the numpy repr '[0.1 0.2 ...]') into a float32 array. """
+    return np.array(str(prob).strip('[]').split(), dtype=np.float32)
+
+
+def build_soft_label_store(csv_paths, path, overwrite=False):
+    """ Merges the prediction csv files (image_id, prob) into one store at ``path``. """
+    if os.path.exists(f'{path}.npy') and not overwrite:
+        return path
+    preds = pd.concat([pd.read_csv(p) for p in csv_paths], axis=0)
+    preds = preds.drop_duplicates('image_id', keep='last').reset_index(drop=True)
+    probs = np.stack([parse_prob(p) for p in preds['prob'].values]).astype(np.float32)
+    np.save(f'{path}.npy', probs)
+    preds[['image_id']].to_csv(f'{path}_ids.csv', index=False)
+    return path
+
+
+class SoftLabelStore:
+    def __init__(self, path):
+        self.path = path
+        self.image_ids = pd.read_csv(f'{path}_ids.csv')['image_id'].values
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(f'{self.path}.npy', mmap_mode='r')
+        return self._data
+
+    @property
+    def num_classes(self):
+        return self.data.shape[1]
+
+    def rows(self, image_ids):
+        """ Row of every image id in the store, -1 when the image has no soft label. """
+        lookup = pd.Series(np.arange(len(self.image_ids)), index=self.image_ids)
+        return lookup.reindex(image_ids).fillna(-1).values.astype(np.int64)
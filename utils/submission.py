@@ -0,0 +1,83 @@
+""" Streaming k-fold ensemble test inference
+
+Every fold checkpoint of every backbone is one member of an ``InferenceEngine``; the test
+images are streamed through it batch by batch and the logits are reduced on the fly, over
+the TTA views of each member, then over the folds of each backbone, then over the
+backbones. Rows are appended to the submission file every ``chunk_size`` images, so only
+one chunk of predictions is ever held in memory whatever the size of the pool:
+
+    engine = InferenceEngine([(arch, ckpt, size) for arch, (size, ckpts) in ensemble.items()
+                              for ckpt in ckpts], device="cuda", views=("identity", "hflip"))
+    write_submission(engine, test_loader, "submission.csv")
+
+``write_predictions`` takes any in-order stream of (logits, image ids), e.g. the shards
+of ``utils.cpu_pool.iter_cpu_pool`` on CPU boxes.
+"""
+import os
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+
+def reduce_ensemble(logits, members, view_reduction='gmean', weights=None):
+    """ (N, classes) probabilities of (models, views, N, classes) logits.
+
+    Args:
+        members (list): backbone name of every model, the folds of a backbone are averaged first
+        view_reduction (str): "gmean" (geometric mean of the view probabilities) or "mean"
+        weights (dict): weight of every backbone in the final average, uniform if None
+    """
+    if view_reduction == 'gmean':
+        probs = F.log_softmax(logits.float(), dim=3).mean(1).exp()
+    else:
+        probs = F.softmax(logits.float(), dim=3).mean(1)
+    backbones = list(dict.fromkeys(members))
+    per_backbone = torch.stack([probs[[i for i, m in enumerate(members) if m == b]].mean(0) for b in backbones])
+    w = torch.tensor([1. if weights is None else weights[b] for b in backbones], device=probs.device)
+    return (per_backbone * w.view(-1, 1, 1)).sum(0) / w.sum()
+
+
+def _append_rows(f, image_ids, preds):
+    f.write(''.join(f'{image_id},{pred}\n' for image_id, pred in zip(image_ids, preds)))
+    f.flush()
+
+
+def write_predictions(batches, members, path, chunk_size=1024, view_reduction='gmean', weights=None):
+    """ Writes ``image_id,label`` rows of the (logits, image ids) ``batches`` to ``path``.
+
+    Args:
+        batches (iterable): (models, views, n, classes) logits and the n image ids, in submission order
+        members (list): backbone name of every model, see ``reduce_ensemble``
+        chunk_size (int): number of images predicted before their rows are appended
+        view_reduction (str): reduction over the TTA views, see ``reduce_ensemble``
+        weights (dict): backbone weights, see ``reduce_ensemble``
+
+    Returns the number of rows written.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = f'{path}.tmp'
+    image_ids, preds, count = [], [], 0
+    with open(tmp, 'w') as f:
+        f.write('image_id,label\n')
+        for logits, batch_ids in batches:
+            probs = reduce_ensemble(logits, members, view_reduction, weights)
+            preds.extend(probs.argmax(1).tolist())
+            image_ids.extend(batch_ids)
+            if len(image_ids) >= chunk_size:
+                _append_rows(f, image_ids, preds)
+                count += len(image_ids)
+                image_ids, preds = [], []
+        _append_rows(f, image_ids, preds)
+        count += len(image_ids)
+    # an interrupted run leaves the .tmp file, never a truncated submission
+    os.replace(tmp, path)
+    return count
+
+
+def write_submission(engine, loader, path, **kwargs):
+    """ Writes the predictions of ``engine`` (all the fold checkpoints of all the backbones) on the
+    uint8 TestDataset batches of ``loader`` to ``path``, see ``write_predictions``. """
+    batches = ((engine(data["images"]), data["image_ids"]) for data in tqdm(loader, desc="Submission"))
+    return write_predictions(batches, engine.names, path, **kwargs)
@@ -0,0 +1,105 @@
+""" Shared-memory cache of deterministic transform outputs
+
+The validation pipeline (CenterCrop, Resize, Normalize) produces the same pixels for
+the same image every epoch. ``TransformCache`` splits such a pipeline into the uint8
+part (everything before Normalize / ToTensorV2) and the tail, and keeps the uint8
+output in shared memory. The cache is allocated in the main process, so all DataLoader
+workers of all epochs read and fill the same slots. When the memory budget is
+exhausted the least recently used slot is evicted.
+"""
+import multiprocessing as mp
+import numpy as np
+import torch
+import albumentations as A
+from albumentations.pytorch import ToTensorV2
+
+# ops that give the same output for the same input when applied with p=1
+_DETERMINISTIC = (A.CenterCrop, A.Crop, A.Resize, A.LongestMaxSize, A.SmallestMaxSize, A.PadIfNeeded,
+                  A.HorizontalFlip, A.VerticalFlip, A.Transpose, A.ToGray, A.Normalize, ToTensorV2)
+_TAIL = (A.Normalize, ToTensorV2)
+
+
+def _always(t):
+    return t.always_apply or t.p == 1
+
+
+def is_deterministic(transform):
+    """ True if ``transform`` is an A.Compose made only of deterministic ops applied with p=1. """
+    if not isinstance(transform, A.Compose) or transform.p != 1:
+        return False
+    return all(isinstance(t, _DETERMINISTIC) and _always(t) for t in transform.transforms)
+
+
+def _output_shape(ops):
+    for t in reversed(ops):
+        if isinstance(t, (A.CenterCrop, A.Crop, A.Resize)):
+            return (t.height, t.width, 3) if hasattr(t, 'height') else (t.y_max - t.y_min, t.x_max - t.x_min, 3)
+    return None
+
+
+class TransformCache:
+    """ LRU cache of the uint8 output of a deterministic pipeline, shared by all workers.
+
+    Args:
+        transform (A.Compose): deterministic pipeline, see ``is_deterministic``
+        num_items (int): dataset length, items are keyed by their dataset index
+        budget_mb (int): shared memory budget for the cached images
+        item_shape (tuple): HWC shape of the cached images, inferred from the last crop/resize if None
+
+    ``prefix`` is the cached part of the pipeline and ``suffix`` must be applied to every
+    image coming out of the cache.
+    """
+    def __init__(self, transform, num_items, budget_mb=4096, item_shape=None):
+        assert is_deterministic(transform), "Only deterministic pipelines can be cached"
+        ops = list(transform.transforms)
+        n = len(ops)
+        while n > 0 and isinstance(ops[n - 1], _TAIL):
+            n -= 1
+        self.prefix = A.Compose(ops[:n])
+        self.suffix = A.Compose(ops[n:])
+        self.item_shape = tuple(item_shape or _output_shape(ops[:n]) or ())
+        assert len(self.item_shape) == 3, "Can not infer the cached image shape, pass item_shape"
+
+        num_slots = min(num_items, int(budget_mb * 2**20 // int(np.prod(self.item_shape))))
+        self.slots = torch.zeros((num_slots,) + self.item_shape, dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((num_items,), -1, dtype=torch.int64).share_memory_()
+        self.owner = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+        self.clock = torch.zeros(2, dtype=torch.int64).share_memory_()  # [tick, number of used slots]
+        self.lock = mp.Lock()
+
+    def __len__(self):
+        return int(self.clock[1])
+
+    def _tick(self):
+        self.clock[0] += 1
+        return self.clock[0]
+
+    def get(self, idx):
+        """ Returns a private copy of the cached uint8 image of item ``idx`` or None. """
+        if len(self.slots) == 0:
+            return None
+        with self.lock:
+            slot = int(self.slot_of[idx])
+            if slot < 0:
+                return None
+            self.last_used[slot] = self._tick()
+            return self.slots[slot].numpy().copy()
+
+    def put(self, idx, image):
+        if len(self.slots) == 0 or tuple(image.shape) != self.item_shape or image.dtype != np.uint8:
+            return image
+        with self.lock:
+            if int(self.slot_of[idx]) >= 0:
+                return image
+            if int(self.clock[1]) < len(self.slots):
+                slot = int(self.clock[1])
+                self.clock[1] += 1
+            else:
+                slot = int(torch.argmin(self.last_used))
+                self.slot_of[self.owner[slot]] = -1
+            self.slots[slot].numpy()[...] = image
+            self.owner[slot] = idx
+            self.slot_of[idx] = slot
+            self.last_used[slot] = self._tick()
+        return image
@@ -0,0 +1,161 @@
+""" Per-transform cost profiler for albumentations pipelines
+
+``TransformProfiler`` returns an instrumented copy of an A.Compose (or of a list of
+them, for TTA) where every op, including the children of OneOf / SomeOf, records its
+calls, how often it was actually applied, its wall time and the image size it saw.
+The counters live in shared memory allocated in the main process, one row per
+DataLoader worker, so the main process reads the totals of all workers without any
+message passing:
+
+    profiler = TransformProfiler(train_transform)
+    train_dataset = TrainDataset(train_folds, root, transform=profiler.transform)
+    for epoch in ...:
+        ...
+        profiler.report(epoch)   # prints the table and resets the counters
+
+Image-only ops (blur, colour, dropout, ...) that run before the last resize / crop of
+the pipeline are flagged: they see more pixels than they need to and would be cheaper
+after it.
+"""
+import copy
+import time
+import numpy as np
+import torch
+import albumentations as A
+from albumentations.core.composition import BaseCompose
+from torch.utils.data import get_worker_info
+
+# ops that change the image size
+_RESIZE = (A.Resize, A.RandomResizedCrop, A.RandomSizedCrop, A.CenterCrop, A.RandomCrop, A.Crop,
+           A.LongestMaxSize, A.SmallestMaxSize)
+
+# columns of the counters
+_CALLS, _APPLIED, _SECONDS, _PIXELS_IN, _PIXELS_OUT = range(5)
+
+
+class _Timed:
+    """ Stands in for one op of a pipeline and adds its cost to the profiler counters. """
+    def __init__(self, transform, profiler, slot):
+        self.transform = transform
+        self.profiler = profiler
+        self.slot = slot
+
+    def __getattr__(self, name):
+        # p, always_apply, add_targets, _to_dict, ... of the wrapped op
+        transform = self.__dict__.get('transform')
+        if transform is None:
+            raise AttributeError(name)
+        return getattr(transform, name)
+
+    def __repr__(self):
+        return repr(self.transform)
+
+    def __call__(self, *args, **data):
+        image = data.get('image')
+        start = time.perf_counter()
+        out = self.transform(*args, **data)
+        seconds = time.perf_counter() - start
+        row = self.profiler.counters[self.profiler.worker_row()][self.slot]
+        row[_CALLS] += 1
+        row[_SECONDS] += seconds
+        if image is not None:
+            row[_APPLIED] += out['image'] is not image
+            row[_PIXELS_IN] += image.shape[0] * image.shape[1]
+            if isinstance(out['image'], np.ndarray):
+                row[_PIXELS_OUT] += out['image'].shape[0] * out['image'].shape[1]
+        return out
+
+
+class TransformProfiler:
+    """ Instrumented copy of ``transform`` with per-op counters shared by all workers.
+
+    Args:
+        transform (A.Compose or list): pipeline or TTA list of pipelines, left untouched
+        max_workers (int): number of DataLoader workers the counters have a row for
+
+    ``transform`` is the instrumented pipeline (or list) to hand to the dataset.
+    """
+    def __init__(self, transform, max_workers=32):
+        self.names, self.depths, self.flags = [], [], []
+        self.max_workers = max_workers
+        if isinstance(transform, (list, tuple)):
+            self.transform = [self._wrap_compose(t, f'tta{i}/', 0) for i, t in enumerate(transform)]
+        else:
+            self.transform = self._wrap_compose(transform, '', 0)
+        # row 0 is the main process, row i + 1 worker i
+        self.shared = torch.zeros((max_workers + 1, len(self.names), 5), dtype=torch.float64).share_memory_()
+        self._counters = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_counters'] = None
+        return state
+
+    @property
+    def counters(self):
+        # numpy view of the shared counters, made in each process after unpickling
+        if self._counters is None:
+            self._counters = self.shared.numpy()
+        return self._counters
+
+    def worker_row(self):
+        info = get_worker_info()
+        return 0 if info is None else 1 + info.id % self.max_workers
+
+    def _wrap_compose(self, compose, prefix, depth):
+        compose = copy.deepcopy(compose)
+        ops = compose.transforms.transforms
+        last_resize = max([i for i, t in enumerate(ops) if isinstance(t, _RESIZE)], default=-1)
+        slots = []
+        for i, t in enumerate(ops):
+            slots.append(len(self.names))
+            self.names.append(prefix + type(t).__name__)
+            self.depths.append(depth)
+            self.flags.append(None)
+            if isinstance(t, BaseCompose):
+                t = self._wrap_compose(t, prefix, depth + 1)
+            ops[i] = _Timed(t, self, slots[-1])
+        for i in range(last_resize):
+            if _image_only(ops[i].transform):
+                self.flags[slots[i]] = slots[last_resize]
+        return compose
+
+    def reset(self):
+        self.shared.zero_()
+
+    def totals(self):
+        """ (num_ops, 5) counters summed over the main process and all workers. """
+        return self.counters.sum(0)
+
+    def table(self):
+        totals = self.totals()
+        top = np.array([d == 0 for d in self.depths])
+        total_seconds = totals[top, _SECONDS].sum()
+        lines = [f'{"transform":<32}{"calls":>9}{"applied":>9}{"total s":>10}{"ms/call":>9}{"share":>8}']
+        for name, depth, flag, row in zip(self.names, self.depths, self.flags, totals):
+            calls = max(row[_CALLS], 1)
+            line = (f'{"  " * depth + name:<32}{int(row[_CALLS]):>9}{100 * row[_APPLIED] / calls:>8.1f}%'
+                    f'{row[_SECONDS]:>10.2f}{1000 * row[_SECONDS] / calls:>9.2f}'
+                    f'{100 * row[_SECONDS] / max(total_seconds, 1e-12):>7.1f}%')
+            if flag is not None and row[_CALLS] > 0:
+                resize = totals[flag]
+                # input size of the op vs output size of the resize / crop
+                saving = (row[_PIXELS_IN] / calls) / max(resize[_PIXELS_OUT] / max(resize[_CALLS], 1), 1)
+                line += f'  <- could run after {self.names[flag]} ({saving:.1f}x fewer pixels)'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def report(self, epoch=None, reset=True):
+        header = 'Transform cost' if epoch is None else f'Epoch: {epoch}. Transform cost'
+        print(f'{header}, {int(self.totals()[:, _CALLS].max(initial=0))} images')
+        print(self.table())
+        if reset:
+            self.reset()
+
+
+def _image_only(t):
+    if isinstance(t, _Timed):
+        t = t.transform
+    if isinstance(t, BaseCompose):
+        return all(_image_only(c) for c in t.transforms)
+    return isinstance(t, A.ImageOnlyTransform) and not isinstance(t, (A.Normalize, A.ToFloat, A.FromFloat))
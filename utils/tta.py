@@ -0,0 +1,87 @@
+""" Batched on-device test-time augmentation
+
+The dataset returns one decoded, resized tensor per image and ``BatchTTA`` builds the
+views on the device: optional five crops (corners and centre, in torchvision FiveCrop
+order), then flips / 90 degree rotations of every crop. All the views of a batch go
+through the model in one stacked forward of size views x batch and the per-view
+probabilities are reduced with a geometric or arithmetic mean:
+
+    tta = BatchTTA(("identity", "hflip", "vflip", "rot90"), normalize=device_normalize)
+    probs = tta(model, images.to(device))                  # (N, num_classes)
+    logits = tta.view_logits(model, images.to(device))     # (views, N, num_classes)
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+VIEWS = {
+    'identity': lambda x: x,
+    'hflip': lambda x: x.flip(3),
+    'vflip': lambda x: x.flip(2),
+    'rot90': lambda x: x.rot90(1, (2, 3)),
+    'rot180': lambda x: x.rot90(2, (2, 3)),
+    'rot270': lambda x: x.rot90(3, (2, 3)),
+    'transpose': lambda x: x.transpose(2, 3),
+}
+
+
+def five_crop(images, size):
+    """ (5, N, C, size, size) top-left, top-right, bottom-left, bottom-right and centre crops. """
+    h, w = images.shape[-2:]
+    assert h >= size and w >= size, f"Crop size {size} larger than the {h}x{w} images"
+    top, left = int(round((h - size) / 2.)), int(round((w - size) / 2.))
+    return torch.stack([images[..., :size, :size], images[..., :size, w - size:],
+                        images[..., h - size:, :size], images[..., h - size:, w - size:],
+                        images[..., top:top + size, left:left + size]])
+
+
+class BatchTTA(nn.Module):
+    """ TTA views of a batch evaluated in a single forward.
+
+    Args:
+        views (tuple): names in ``VIEWS``, applied to every crop
+        five_crop (int): crop size of the five crops, no cropping if None
+        reduction (str): "gmean" (geometric mean of the probabilities) or "mean"
+        normalize (nn.Module): DeviceNormalize applied to the batch before the views
+        channels_last (bool): stacked views in channels-last layout
+        max_batch (int): split the stacked forward in chunks of at most this size
+    """
+    def __init__(self, views=('identity', 'hflip', 'vflip', 'rot90'), five_crop=None, reduction='gmean',
+                 normalize=None, channels_last=False, max_batch=None):
+        super().__init__()
+        assert reduction in ('gmean', 'mean'), f"Unknown reduction {reduction}"
+        self.views = tuple(views)
+        self.five_crop = five_crop
+        self.reduction = reduction
+        self.normalize = normalize
+        self.channels_last = channels_last
+        self.max_batch = max_batch
+
+    @property
+    def num_views(self):
+        return len(self.views) * (5 if self.five_crop else 1)
+
+    def expand(self, images):
+        """ (views * N, C, h, w) batch of all the views, view-major. """
+        if self.normalize is not None:
+            images = self.normalize(images)
+        crops = five_crop(images, self.five_crop).flatten(0, 1) if self.five_crop else images
+        views = torch.cat([VIEWS[v](crops) for v in self.views])
+        if self.channels_last:
+            views = views.contiguous(memory_format=torch.channels_last)
+        return views
+
+    def view_logits(self, model, images):
+        """ (views, N, num_classes) logits of every view. """
+        views = self.expand(images)
+        if self.max_batch is None or len(views) <= self.max_batch:
+            logits = model(views)
+        else:
+            logits = torch.cat([model(chunk) for chunk in views.split(self.max_batch)])
+        return logits.view(self.num_views, len(images), -1)
+
+    def forward(self, model, images):
+        logits = self.view_logits(model, images)
+        if self.reduction == 'gmean':
+            return F.log_softmax(logits.float(), dim=2).mean(0).exp()
+        return F.softmax(logits.float(), dim=2).mean(0)